@@ -0,0 +1,90 @@
+'''
+Single-file storage for a set of named numpy arrays plus picklable metadata,
+laid out so the arrays can be memory-mapped read-only (and their pages shared
+between processes) instead of being read in.
+
+Layout: MAGIC, an 8-byte little-endian header length, the pickled header,
+then each array's raw bytes at an ALIGNMENT-aligned offset.
+'''
+
+import cPickle as pickle
+import os
+import struct
+import tempfile
+
+import numpy
+
+MAGIC = "NLPARRAYS1\n"
+ALIGNMENT = 64
+
+def _aligned(offset):
+	return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_arrays(path, arrays, metadata=None):
+	"""
+	Writes arrays (a dict of name => numpy array) and metadata to path. The
+	file is written next to path and renamed into place, so readers never see
+	a partial file.
+	"""
+	arrays = dict((name, numpy.ascontiguousarray(array)) for name, array in arrays.iteritems())
+
+	# Offsets depend on the header length, which depends on the offsets, so
+	# lay the arrays out relative to the end of the header and fix up after
+	layout, offset = [], 0
+	for name in sorted(arrays):
+		array = arrays[name]
+		offset = _aligned(offset)
+		layout.append((name, array.dtype.str, array.shape, offset))
+		offset += array.nbytes
+
+	header = pickle.dumps({'metadata' : metadata, 'arrays' : layout}, protocol=pickle.HIGHEST_PROTOCOL)
+	data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+	directory = os.path.dirname(os.path.abspath(path))
+	descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+
+	try:
+		with os.fdopen(descriptor, "wb") as output:
+			output.write(MAGIC)
+			output.write(struct.pack("<Q", len(header)))
+			output.write(header)
+
+			for name, _, _, array_offset in layout:
+				output.seek(data_start + array_offset)
+				output.write(arrays[name].tostring())
+
+		# mkstemp creates the file private to the user; give it the usual mode
+		umask = os.umask(0)
+		os.umask(umask)
+		os.chmod(temp_path, 0666 & ~umask)
+
+		os.rename(temp_path, path)
+	except:
+		os.remove(temp_path)
+		raise
+
+def read_arrays(path, mmap=True):
+	"""
+	Returns (arrays, metadata) as written by write_arrays. With mmap, the
+	arrays are read-only views onto the file.
+	"""
+	with open(path, "rb") as input:
+		if input.read(len(MAGIC)) != MAGIC:
+			raise IOError("%s is not an array file" % path)
+
+		header_length, = struct.unpack("<Q", input.read(8))
+		header = pickle.loads(input.read(header_length))
+		data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+		arrays = dict()
+		for name, dtype, shape, offset in header['arrays']:
+			dtype = numpy.dtype(dtype)
+			count = int(numpy.prod(shape)) if shape else 1
+
+			if mmap and count:
+				arrays[name] = numpy.memmap(path, dtype=dtype, mode='r', offset=data_start + offset, shape=shape)
+			else:
+				input.seek(data_start + offset)
+				arrays[name] = numpy.fromfile(input, dtype=dtype, count=count).reshape(shape)
+
+	return arrays, header['metadata']
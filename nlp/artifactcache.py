@@ -0,0 +1,216 @@
+'''
+On-disk cache for expensive, picklable training artifacts. Entries are keyed
+by a hash of everything the artifact depends on (the data, the class that
+produces it and its hyperparameters), so a changed corpus or setting never
+picks up a stale artifact.
+'''
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+from time import time
+
+DEFAULT_DIRECTORY = "cache"
+DEFAULT_MAX_BYTES = 1 << 30
+
+# Entries are pickles (lookup) or files written by their producer
+# (lookup_file), e.g. mapped corpora
+ENTRY_SUFFIXES = (".pickle", ".corpus")
+
+def make_key(*parts):
+	"""
+	Hashes parts (picklable values: strings, numbers, tuples, classes...) into
+	a cache key. Classes hash by module and name.
+	"""
+	return hashlib.sha1(pickle.dumps(parts, protocol=2)).hexdigest()
+
+def fingerprint_files(path):
+	"""
+	Returns a digest of the names, sizes and modification times of the files
+	under path, a cheap stand-in for hashing a corpus's contents
+	"""
+	digest = hashlib.sha1()
+
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for name in sorted(files):
+			file_path = os.path.join(root, name)
+			info = os.stat(file_path)
+			digest.update("%s\0%d\0%d\n" % (os.path.relpath(file_path, path), info.st_size, int(info.st_mtime)))
+
+	return digest.hexdigest()
+
+class ArtifactCache(object):
+	"""
+	Directory of pickled artifacts, one file per key. Writes are atomic (a
+	temporary file renamed into place) and the least recently used entries
+	are removed once the directory holds more than max_bytes. Artifacts
+	read straight from their own files, like memory-mapped corpora, are
+	entries too (see lookup_file).
+	"""
+
+	def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, verbose=True):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.verbose = verbose
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def _log(self, message):
+		if self.verbose: print message
+
+	def path(self, key, suffix=".pickle"):
+		return os.path.join(self.directory, key + suffix)
+
+	def __contains__(self, key):
+		return os.path.exists(self.path(key))
+
+	def lookup(self, key, compute, description="artifact"):
+		"""
+		Returns the artifact stored under key, calling compute() (and storing
+		the result) if there isn't one
+		"""
+		path = self.path(key)
+
+		if os.path.exists(path):
+			start = time()
+			try:
+				with open(path, "rb") as pickle_file:
+					value = pickle.load(pickle_file)
+			except Exception, e:
+				# A truncated or incompatible entry is as good as a miss
+				self._log("Discarding unreadable cache entry for %s (%s)" % (description, e))
+				self._remove(path)
+			else:
+				# Mark the entry recently used for eviction
+				os.utime(path, None)
+				self.hits += 1
+				self._log("Cache hit for %s: %f" % (description, time() - start))
+				return value
+
+		self.misses += 1
+		start = time()
+		value = compute()
+		self._log("Cache miss for %s, computed in %f" % (description, time() - start))
+		self.store(key, value)
+
+		return value
+
+	def lookup_file(self, key, write, suffix, description="artifact"):
+		"""
+		Returns the path of the file entry stored under key, calling
+		write(path) to create it if there isn't one. suffix is one of
+		ENTRY_SUFFIXES.
+		"""
+		if suffix not in ENTRY_SUFFIXES: raise ValueError("Unknown cache entry suffix %r" % suffix)
+		path = self.path(key, suffix)
+
+		if os.path.exists(path):
+			os.utime(path, None)
+			self.hits += 1
+			self._log("Cache hit for %s" % description)
+			return path
+
+		self.misses += 1
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		start = time()
+		descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+		os.close(descriptor)
+		try:
+			write(temp_path)
+			os.rename(temp_path, path)
+		except:
+			self._remove(temp_path)
+			raise
+		self._log("Cache miss for %s, written in %f" % (description, time() - start))
+
+		# The caller is about to read it, so it stays even if it alone is too big
+		self.evict(keep=path)
+		return path
+
+	def store(self, key, value):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+		try:
+			with os.fdopen(descriptor, "wb") as pickle_file:
+				pickle.dump(value, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+			os.rename(temp_path, self.path(key))
+		except:
+			self._remove(temp_path)
+			raise
+
+		self.evict()
+
+	def _entries(self):
+		"""
+		Returns (last used, size, path) for each entry, oldest first
+		"""
+		if not os.path.isdir(self.directory): return []
+
+		entries = []
+		for name in os.listdir(self.directory):
+			if not name.endswith(ENTRY_SUFFIXES) or name.startswith("."): continue
+
+			path = os.path.join(self.directory, name)
+			try:
+				info = os.stat(path)
+			except OSError:
+				continue
+			entries.append((info.st_mtime, info.st_size, path))
+
+		entries.sort()
+		return entries
+
+	def evict(self, keep=None):
+		"""
+		Removes least recently used entries (other than the one at path
+		keep) until the cache fits in max_bytes
+		"""
+		entries = self._entries()
+		total = sum(size for _, size, _ in entries)
+
+		for _, size, path in entries:
+			if total <= self.max_bytes: break
+			if path == keep: continue
+
+			self._remove(path)
+			total -= size
+			self.evictions += 1
+			self._log("Evicted cache entry %s" % os.path.basename(path))
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+	def clear(self):
+		for _, _, path in self._entries():
+			self._remove(path)
+
+	def stats(self):
+		entries = self._entries()
+		return {'entries' : len(entries), 'bytes' : sum(size for _, size, _ in entries),
+				'max_bytes' : self.max_bytes, 'hits' : self.hits,
+				'misses' : self.misses, 'evictions' : self.evictions}
+
+_default_cache = None
+
+def default_cache():
+	"""
+	Returns the process-wide cache, in $NLP_CACHE_DIR (default ./cache) and
+	limited to $NLP_CACHE_MAX_BYTES (default 1GB)
+	"""
+	global _default_cache
+
+	if _default_cache is None:
+		_default_cache = ArtifactCache(os.environ.get("NLP_CACHE_DIR", DEFAULT_DIRECTORY),
+									   int(os.environ.get("NLP_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
+
+	return _default_cache
@@ -0,0 +1,111 @@
+'''
+Int-encoded store for tagged corpora. Words and tags are flat int32 arrays
+of vocabulary and tagset ids, and sentence i is tokens offsets[i] up to
+offsets[i+1]. Stored with arrayfile, so a loaded corpus is memory-mapped
+and every trainer and evaluator reading it shares the same pages.
+'''
+
+from array import array
+
+import numpy
+
+from arrayfile import read_arrays, write_arrays
+
+class Corpus(object):
+	"""
+	Tagged sentences, (tags, words) pairs like PennTreebankReader reads.
+	corpus[i] decodes sentence i; corpus[begin:end] is a corpus of those
+	sentences sharing this one's arrays, which is how splits are made.
+	"""
+
+	def __init__(self, vocabulary, tagset, words, tags, offsets):
+		self.vocabulary = vocabulary
+		self.tagset = tagset
+		self.words = words
+		self.tags = tags
+		self.offsets = offsets
+
+	@classmethod
+	def from_sentences(cls, tagged_sentences):
+		"""
+		Encodes an iterable of (tags, words) pairs, giving words and tags ids
+		in order of first appearance
+		"""
+		word_ids, tag_ids = dict(), dict()
+		words, tags, offsets = array('i'), array('i'), [0]
+
+		for sentence_tags, sentence_words in tagged_sentences:
+			for word in sentence_words:
+				words.append(word_ids.setdefault(word, len(word_ids)))
+			for tag in sentence_tags:
+				tags.append(tag_ids.setdefault(tag, len(tag_ids)))
+
+			if len(words) != len(tags):
+				raise ValueError("Sentence %d has %d tags for %d words" %
+								 (len(offsets) - 1, len(sentence_tags), len(sentence_words)))
+			offsets.append(len(words))
+
+		def by_id(ids):
+			names = [None] * len(ids)
+			for name, idx in ids.iteritems(): names[idx] = name
+			return names
+
+		return cls(by_id(word_ids), by_id(tag_ids), numpy.frombuffer(words, dtype=numpy.int32).copy(),
+				   numpy.frombuffer(tags, dtype=numpy.int32).copy(), numpy.array(offsets, dtype=numpy.int64))
+
+	def write(self, path):
+		"""
+		Writes the corpus (just this slice's sentences) to path
+		"""
+		begin, end = self.offsets[0], self.offsets[-1]
+		arrays = {
+			'words' : self.words[begin:end],
+			'tags' : self.tags[begin:end],
+			'offsets' : self.offsets - begin,
+		}
+		write_arrays(path, arrays, {'vocabulary' : self.vocabulary, 'tagset' : self.tagset})
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Maps a corpus written by write
+		"""
+		arrays, metadata = read_arrays(path)
+		return cls(metadata['vocabulary'], metadata['tagset'], arrays['words'], arrays['tags'], arrays['offsets'])
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	@property
+	def word_ids(self):
+		"""
+		The word ids of every token in this corpus's sentences
+		"""
+		return self.words[self.offsets[0]:self.offsets[-1]]
+
+	@property
+	def tag_ids(self):
+		return self.tags[self.offsets[0]:self.offsets[-1]]
+
+	def sentence_ids(self, index):
+		"""
+		Returns sentence index as (tag ids, word ids) arrays
+		"""
+		if index < 0: index += len(self)
+		if not 0 <= index < len(self): raise IndexError("Sentence %d of %d" % (index, len(self)))
+
+		begin, end = self.offsets[index], self.offsets[index+1]
+		return self.tags[begin:end], self.words[begin:end]
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(len(self))
+			if step != 1: raise ValueError("Corpus slices must be contiguous")
+			return Corpus(self.vocabulary, self.tagset, self.words, self.tags, self.offsets[start:max(start, stop)+1])
+
+		tag_ids, word_ids = self.sentence_ids(index)
+		return [self.tagset[tag] for tag in tag_ids.tolist()], [self.vocabulary[word] for word in word_ids.tolist()]
+
+	def __iter__(self):
+		for index in xrange(len(self)):
+			yield self[index]
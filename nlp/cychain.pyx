@@ -0,0 +1,1109 @@
+# Generic chain model decoders (viterbi, beam search, forward-backward) over
+# local (positions x states) scores and sparse state transitions
+import threading
+
+import numpy
+
+from quantize import quantize_scores, dequantize_scores
+
+include "stdlib.pxi"
+include "math.pxi"
+
+cdef extern from "max-plus.h" nogil:
+	int max_plus(double *prev, double *row, int width, double *best)
+	int max_plus_float(double *prev, float *row, int width, double scale, double *best)
+	int max_plus_int16(double *prev, short *row, int width, double scale, double *best)
+	int max_plus_scalar(double *prev, int *pred_idx, double *pred_scores, int count, double *best)
+
+# Transitions are kept twice:
+#
+# As edges grouped by destination (pred_indptr / pred_prev / pred_scores, the
+# edge id is the index into these) plus each source's outgoing edge ids
+# (succ_indptr / succ_edge), for beam search, forward-backward and
+# per-position edge scores. pred_probs is exp(pred_scores), for the
+# probability space forward-backward kernel.
+#
+# As predecessor spans for the static viterbi kernel: state s compares
+# prev_scores[span_start[s]:span_start[s]+span_width[s]] against a dense row
+# of span_scores starting at row_offsets[s] (see max-plus.h). Rows are padded
+# to BLOCK entries and the table is ALIGNMENT-byte aligned. Spans are short
+# when states are ordered so each state's predecessors are contiguous. The
+# table is stored at span_type precision: doubles, floats, or int16 fixed
+# point (entry * span_scale, see quantize.py), so a smaller table can be
+# streamed through the kernel.
+DEF BLOCK = 4
+DEF ALIGNMENT = 32
+
+DEF SPAN_DOUBLE = 0
+DEF SPAN_FLOAT = 1
+DEF SPAN_INT16 = 2
+
+SPAN_PRECISIONS = {'float64' : SPAN_DOUBLE, 'float32' : SPAN_FLOAT, 'int16' : SPAN_INT16}
+
+ctypedef struct Transitions:
+	int state_count
+	int edge_count
+
+	int *pred_indptr
+	int *pred_prev
+	int *edge_next
+	double *pred_scores
+	double *pred_probs
+
+	int *succ_indptr
+	int *succ_edge
+
+	int *span_start
+	int *span_width
+	int *row_offsets
+	void *span_scores
+	int span_type
+	double span_scale
+
+cdef class ChainDecoder:
+	"""
+	Decoder for chains over state_count states, with transitions given as
+	parallel arrays of (previous state, next state, score). Local scores
+	(emissions, feature scores...) are passed per call as a (positions x
+	states) array; position 0 scores the start of the chain.
+
+	precision ('float64', 'float32' or 'int16', with an optional fixed
+	scale) is how viterbi's transition table is stored; every decoder sees
+	the scores rounded to it.
+	"""
+	cdef Transitions transitions
+	cdef readonly int state_count, transition_count
+
+	# Per-thread ChainWorkspace
+	cdef object _local
+
+	def __cinit__(self, *args, **kwargs):
+		self.transitions.pred_indptr = NULL
+		self.transitions.pred_prev = NULL
+		self.transitions.edge_next = NULL
+		self.transitions.pred_scores = NULL
+		self.transitions.pred_probs = NULL
+		self.transitions.succ_indptr = NULL
+		self.transitions.succ_edge = NULL
+		self.transitions.span_start = NULL
+		self.transitions.span_width = NULL
+		self.transitions.row_offsets = NULL
+		self.transitions.span_scores = NULL
+
+	def __dealloc__(self):
+		free(self.transitions.pred_indptr)
+		free(self.transitions.pred_prev)
+		free(self.transitions.edge_next)
+		free(self.transitions.pred_scores)
+		free(self.transitions.pred_probs)
+		free(self.transitions.succ_indptr)
+		free(self.transitions.succ_edge)
+		free(self.transitions.span_start)
+		free(self.transitions.span_width)
+		free(self.transitions.row_offsets)
+		free(self.transitions.span_scores)
+
+	def __init__(self, int state_count, prev_states, next_states, scores, precision='float64', scale=None):
+		if precision not in SPAN_PRECISIONS:
+			raise ValueError("Unknown transition precision %r" % (precision,))
+
+		prev_states = numpy.asarray(prev_states, dtype=numpy.int32)
+		next_states = numpy.asarray(next_states, dtype=numpy.int32)
+		scores = numpy.asarray(scores, dtype=numpy.float64)
+
+		# The ids index the C transition tables unchecked from here on
+		if state_count < 0: raise ValueError("state_count must not be negative")
+		if not len(prev_states) == len(next_states) == len(scores):
+			raise ValueError("prev_states, next_states and scores must be the same length")
+		for states in (prev_states, next_states):
+			if len(states) and (states.min() < 0 or states.max() >= state_count):
+				raise ValueError("transition states must be in [0, %d)" % state_count)
+
+		# -inf transitions are no transition at all
+		legal = scores > float("-inf")
+		prev_states, next_states, scores = prev_states[legal], next_states[legal], scores[legal]
+
+		table, scale = quantize_scores(scores, precision, scale)
+		scores = dequantize_scores(table, scale)
+
+		order = numpy.lexsort((prev_states, next_states))
+		prev_states, next_states, scores = prev_states[order], next_states[order], scores[order]
+
+		self.state_count = state_count
+		self.transition_count = len(scores)
+		self._local = threading.local()
+
+		cdef Transitions *t = &self.transitions
+		cdef int i, k, width
+		cdef int offset = 0
+		cdef int edge_count = self.transition_count
+		cdef double ninf = log(0)
+		cdef void *span_scores = NULL
+
+		t.state_count = state_count
+		t.edge_count = edge_count
+		t.pred_indptr = <int*>malloc((state_count + 1) * sizeof(int))
+		t.pred_prev = <int*>malloc(max(edge_count, 1) * sizeof(int))
+		t.edge_next = <int*>malloc(max(edge_count, 1) * sizeof(int))
+		t.pred_scores = <double*>malloc(max(edge_count, 1) * sizeof(double))
+		t.pred_probs = <double*>malloc(max(edge_count, 1) * sizeof(double))
+		t.succ_indptr = <int*>malloc((state_count + 1) * sizeof(int))
+		t.succ_edge = <int*>malloc(max(edge_count, 1) * sizeof(int))
+		t.span_start = <int*>malloc(max(state_count, 1) * sizeof(int))
+		t.span_width = <int*>malloc(max(state_count, 1) * sizeof(int))
+		t.row_offsets = <int*>malloc(max(state_count, 1) * sizeof(int))
+
+		if not (t.pred_indptr and t.pred_prev and t.edge_next and t.pred_scores and t.pred_probs and t.succ_indptr
+				and t.succ_edge and t.span_start and t.span_width and t.row_offsets):
+			raise MemoryError()
+
+		cdef int[:] prev_view = prev_states
+		cdef int[:] next_view = next_states
+		cdef double[:] score_view = scores
+		cdef int[:] pred_indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(next_states, minlength=state_count)))).astype(numpy.int32)
+		cdef int[:] succ_order = numpy.argsort(prev_states, kind="mergesort").astype(numpy.int32)
+		cdef int[:] succ_indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(prev_states, minlength=state_count)))).astype(numpy.int32)
+
+		for i in range(state_count + 1):
+			t.pred_indptr[i] = pred_indptr[i]
+			t.succ_indptr[i] = succ_indptr[i]
+
+		for k in range(edge_count):
+			t.pred_prev[k] = prev_view[k]
+			t.edge_next[k] = next_view[k]
+			t.pred_scores[k] = score_view[k]
+			t.pred_probs[k] = exp(score_view[k])
+			t.succ_edge[k] = succ_order[k]
+
+		# Spans run from each state's first to its last predecessor
+		for i in range(state_count):
+			if t.pred_indptr[i+1] > t.pred_indptr[i]:
+				t.span_start[i] = t.pred_prev[t.pred_indptr[i]]
+				width = t.pred_prev[t.pred_indptr[i+1] - 1] - t.span_start[i] + 1
+			else:
+				t.span_start[i] = 0
+				width = 0
+
+			t.span_width[i] = width
+			t.row_offsets[i] = offset
+			offset += (width + BLOCK - 1) / BLOCK * BLOCK
+
+		# Lay the rows out in doubles, then store them at precision
+		rows = numpy.empty(max(offset, BLOCK))
+		rows.fill(ninf)
+		cdef double[:] row_view = rows
+
+		for i in range(state_count):
+			for k in range(t.pred_indptr[i], t.pred_indptr[i+1]):
+				row_view[t.row_offsets[i] + t.pred_prev[k] - t.span_start[i]] = t.pred_scores[k]
+
+		table = quantize_scores(rows, precision, scale)[0]
+		if posix_memalign(&span_scores, ALIGNMENT, table.nbytes) != 0:
+			raise MemoryError()
+
+		cdef const unsigned char[:] table_bytes = table.view(numpy.uint8)
+		memcpy(span_scores, &table_bytes[0], table.nbytes)
+		t.span_scores = span_scores
+		t.span_type = SPAN_PRECISIONS[precision]
+		t.span_scale = scale
+
+	@classmethod
+	def from_matrix(cls, transitions, precision='float64', scale=None):
+		"""
+		Builds a decoder from a dense (states x states) array of scores for
+		moving from the row state to the column state (-inf for none)
+		"""
+		transitions = numpy.asarray(transitions, dtype=numpy.float64)
+		prev_states, next_states = numpy.nonzero(transitions > float("-inf"))
+
+		return cls(transitions.shape[0], prev_states, next_states, transitions[prev_states, next_states],
+				   precision=precision, scale=scale)
+
+	def edges(self):
+		"""
+		Returns (previous states, next states) arrays in edge id order, the
+		column order edge_scores arguments use
+		"""
+		cdef int k
+		prev_states = numpy.empty(self.transition_count, dtype=numpy.int32)
+		next_states = numpy.empty(self.transition_count, dtype=numpy.int32)
+
+		for k in range(self.transition_count):
+			prev_states[k] = self.transitions.pred_prev[k]
+			next_states[k] = self.transitions.edge_next[k]
+
+		return prev_states, next_states
+
+	def predecessors(self, int state):
+		"""
+		Returns the (previous state, transition score) pairs for state
+		"""
+		cdef int k
+		return [(self.transitions.pred_prev[k], self.transitions.pred_scores[k])
+				for k in range(self.transitions.pred_indptr[state], self.transitions.pred_indptr[state+1])]
+
+	def workspace(self):
+		"""
+		Returns the calling thread's decoding workspace, creating it on first use
+		"""
+		workspace = getattr(self._local, 'workspace', None)
+		if workspace is None:
+			workspace = ChainWorkspace(self.state_count)
+			self._local.workspace = workspace
+
+		return workspace
+
+	cdef double *_edge_scores(self, object edge_scores, int length) except? NULL:
+		if edge_scores is None: return NULL
+
+		cdef const double[:, ::1] view = edge_scores
+		if view.shape[0] < length or view.shape[1] != self.transition_count:
+			raise ValueError("edge_scores must be (positions x %d)" % self.transition_count)
+		if self.transition_count == 0: return NULL
+
+		return <double*>&view[0, 0]
+
+	def viterbi(self, local_scores, int start=-1, int stop=-1, edge_scores=None):
+		"""
+		Returns (path, score), the best state sequence for local_scores and
+		its score. With start, the chain must begin there; with stop, it
+		must end there. edge_scores, a (positions x transition_count) array
+		in edges() order, replaces the transition scores for moving into
+		each position.
+
+		If no path reaches a state on the way back, decoding falls back on
+		the best local score at that position. States with a -inf local
+		score are not considered at all, so masking local scores is how
+		callers restrict the candidates at a position.
+		"""
+		cdef const double[:, ::1] local = local_scores
+		cdef int length = local.shape[0]
+		self._check(local, start, stop)
+
+		cdef ChainWorkspace workspace = self.workspace()
+		workspace.reserve(length)
+		cdef double *edges = self._edge_scores(edge_scores, length)
+		cdef double score
+
+		with nogil:
+			viterbi(length, start, &self.transitions, <double*>&local[0, 0], edges,
+					workspace.lattice, workspace.backpointers)
+			score = backtrack(length, stop, self.state_count, <double*>&local[0, 0],
+							  workspace.lattice, workspace.backpointers, workspace.path)
+
+		return workspace.path_array(length), score
+
+	def beam(self, local_scores, int beam_size, int start=-1, int stop=-1, edge_scores=None):
+		"""
+		As viterbi, but only extends the beam_size best states at each
+		position
+		"""
+		cdef const double[:, ::1] local = local_scores
+		cdef int length = local.shape[0]
+		self._check(local, start, stop)
+		if beam_size < 1: raise ValueError("beam_size must be positive")
+
+		cdef ChainWorkspace workspace = self.workspace()
+		workspace.reserve(length)
+		cdef double *edges = self._edge_scores(edge_scores, length)
+		cdef double score
+
+		with nogil:
+			beam(length, start, min(beam_size, self.state_count), &self.transitions, <double*>&local[0, 0], edges,
+				 workspace.lattice, workspace.backpointers, workspace.active)
+			score = backtrack(length, stop, self.state_count, <double*>&local[0, 0],
+							  workspace.lattice, workspace.backpointers, workspace.path)
+
+		return workspace.path_array(length), score
+
+	def forward_backward(self, local_scores, int start=-1, int stop=-1, edge_scores=None):
+		"""
+		Returns (log partition, posteriors), where posteriors[pos, state] is
+		the marginal probability of the chain being in state at pos
+		"""
+		cdef const double[:, ::1] local = local_scores
+		cdef int length = local.shape[0]
+		self._check(local, start, stop)
+
+		alpha = numpy.empty((length, self.state_count))
+		beta = numpy.empty((length, self.state_count))
+		cdef double[:, ::1] alpha_view = alpha
+		cdef double[:, ::1] beta_view = beta
+		cdef double *edges = self._edge_scores(edge_scores, length)
+		cdef double log_z
+		cdef double[::1] scratch = numpy.empty(max(self.state_count, 1))
+
+		with nogil:
+			if edges == NULL:
+				log_z = forward_backward_scaled(length, start, stop, &self.transitions, <double*>&local[0, 0],
+												&alpha_view[0, 0], &beta_view[0, 0], &scratch[0])
+			else:
+				log_z = forward_backward(length, start, stop, &self.transitions, <double*>&local[0, 0], edges,
+										 &alpha_view[0, 0], &beta_view[0, 0])
+
+		if log_z == float("-inf"):
+			return log_z, numpy.zeros((length, self.state_count))
+		return log_z, numpy.exp(alpha + beta - log_z)
+
+	def _check(self, local, int start, int stop):
+		if local.shape[0] < 1:
+			raise ValueError("can't decode an empty chain")
+		if local.shape[1] != self.state_count:
+			raise ValueError("local_scores must have %d columns" % self.state_count)
+		if start >= self.state_count or stop >= self.state_count:
+			raise ValueError("start / stop out of range")
+
+
+cdef class StreamingDecoder:
+	"""
+	Incremental viterbi over a ChainDecoder's (static) transitions. Local
+	score rows are pushed one position at a time; a position's state is
+	committed as soon as every surviving path agrees on it, or once it is
+	lag positions old (the best path's state wins, and paths disagreeing
+	with it are dropped). Memory is O(states x lag).
+	"""
+	cdef ChainDecoder decoder
+	cdef readonly int lag, start, pending
+	cdef int state_count, oldest
+
+	# Scores of the newest position (normalized so the best is 0)
+	cdef double *scores
+	cdef double *next_scores
+	# (lag + 1) rows of backpointers for the pending positions, a ring
+	# starting at oldest; -1 roots a path
+	cdef int *ring
+	# Scratch: frontier sets and ancestors (state_count each)
+	cdef int *frontier
+	cdef int *marks
+	cdef int *ancestors
+	cdef int stamp
+	cdef bint started
+
+	def __cinit__(self, ChainDecoder decoder, int start=-1, int lag=8):
+		if lag < 1: raise ValueError("lag must be positive")
+		if start >= decoder.state_count: raise ValueError("start out of range")
+
+		self.decoder = decoder
+		self.state_count = decoder.state_count
+		self.lag = lag
+		self.start = start
+
+		cdef int count = max(self.state_count, 1)
+		self.scores = <double*>malloc(count * sizeof(double))
+		self.next_scores = <double*>malloc(count * sizeof(double))
+		self.ring = <int*>malloc((lag + 1) * count * sizeof(int))
+		self.frontier = <int*>malloc(count * sizeof(int))
+		self.marks = <int*>malloc(count * sizeof(int))
+		self.ancestors = <int*>malloc(count * sizeof(int))
+
+		if not (self.scores and self.next_scores and self.ring and self.frontier and self.marks and self.ancestors):
+			raise MemoryError()
+
+		self.reset()
+
+	def __dealloc__(self):
+		free(self.scores)
+		free(self.next_scores)
+		free(self.ring)
+		free(self.frontier)
+		free(self.marks)
+		free(self.ancestors)
+
+	def reset(self):
+		"""
+		Drops any pending positions and starts a new chain
+		"""
+		cdef int state
+		self.pending = 0
+		self.oldest = 0
+		self.stamp = 0
+		self.started = False
+
+		for state in range(self.state_count):
+			self.scores[state] = log(0)
+			self.marks[state] = 0
+		if self.start >= 0:
+			self.scores[self.start] = 0.0
+
+	cdef int *row(StreamingDecoder self, int index) nogil:
+		# Backpointers of the index'th pending position
+		return self.ring + ((self.oldest + index) % (self.lag + 1)) * self.state_count
+
+	def push(self, local_row):
+		"""
+		Adds the local scores (one per state) of the next position. Returns
+		the states committed as a result, oldest first.
+		"""
+		cdef const double[::1] local = local_row
+		if local.shape[0] != self.state_count:
+			raise ValueError("local_row must have %d entries" % self.state_count)
+
+		committed = []
+		if not self.started and self.start < 0:
+			# Unanchored chains start anywhere
+			self._restart(<double*>&local[0])
+		elif not self._step(<double*>&local[0]):
+			# Nothing can follow any surviving state: settle what we have and
+			# start the chain over here
+			committed.extend(self._trace(self._best(), self.pending))
+			self._restart(<double*>&local[0])
+
+		if self.pending > self.lag:
+			committed.append(self._force_commit())
+
+		committed.extend(self._commit_converged())
+		return committed
+
+	def finish(self, int stop=-1):
+		"""
+		Ends the chain in stop (or its best state), returning the remaining
+		states
+		"""
+		if not -1 <= stop < self.state_count: raise ValueError("stop out of range")
+		if stop < 0 or self.scores[stop] == log(0):
+			stop = self._best()
+
+		committed = self._trace(stop, self.pending)
+		self.reset()
+		return committed
+
+	cdef int _best(StreamingDecoder self) nogil:
+		cdef int state, best = 0
+		for state in range(self.state_count):
+			if self.scores[state] > self.scores[best]:
+				best = state
+		return best
+
+	cdef void _restart(StreamingDecoder self, double *local) nogil:
+		cdef int state
+		cdef int *backpointers = self.row(self.pending)
+
+		for state in range(self.state_count):
+			self.scores[state] = local[state]
+			backpointers[state] = -1
+
+		self.pending += 1
+		self.started = True
+		self._normalize()
+
+	cdef bint _step(StreamingDecoder self, double *local) nogil:
+		"""
+		Advances the scores by one position; returns False (leaving them
+		alone) if no state is reachable
+		"""
+		cdef Transitions *t = &self.decoder.transitions
+		cdef int state, last
+		cdef double score, top = log(0)
+		cdef int *backpointers = self.row(self.pending)
+		cdef double *swap
+
+		for state in range(self.state_count):
+			if local[state] == log(0):
+				# Excluded here, whatever the predecessors
+				self.next_scores[state] = local[state]
+				backpointers[state] = -2
+				continue
+
+			last = span_max_plus(t, self.scores, state, &score)
+			self.next_scores[state] = score + local[state]
+			backpointers[state] = t.span_start[state] + last if last >= 0 else -2
+			if self.next_scores[state] > top: top = self.next_scores[state]
+
+		if top == log(0): return False
+
+		self.pending += 1
+		self.started = True
+		swap = self.scores
+		self.scores = self.next_scores
+		self.next_scores = swap
+		self._normalize()
+		return True
+
+	cdef void _normalize(StreamingDecoder self) nogil:
+		# Keep scores from drifting over an unbounded stream
+		cdef int state
+		cdef double top = log(0)
+
+		for state in range(self.state_count):
+			if self.scores[state] > top: top = self.scores[state]
+		if top == log(0): return
+
+		for state in range(self.state_count):
+			self.scores[state] -= top
+
+	cdef list _trace(StreamingDecoder self, int state, int count):
+		"""
+		Returns the states of the count oldest pending positions on the path
+		ending in state at the newest one, and pops them
+		"""
+		cdef int index
+		cdef list states = [0] * self.pending
+
+		for index in range(self.pending - 1, -1, -1):
+			states[index] = state
+			state = self.row(index)[state]
+			if state < 0 and index > 0:
+				# Dead path: nothing better to offer than staying put
+				state = states[index]
+
+		self.oldest = (self.oldest + count) % (self.lag + 1)
+		self.pending -= count
+		return states[:count]
+
+	cdef int _force_commit(StreamingDecoder self) except -1:
+		"""
+		Commits the oldest position's state on the best path and drops the
+		paths that disagree with it
+		"""
+		cdef int state, best = 0, index, committed
+
+		for state in range(self.state_count):
+			self.ancestors[state] = state
+			if self.scores[state] > self.scores[best]:
+				best = state
+
+		for index in range(self.pending - 1, 0, -1):
+			for state in range(self.state_count):
+				if self.ancestors[state] >= 0:
+					self.ancestors[state] = self.row(index)[self.ancestors[state]]
+
+		committed = self.ancestors[best]
+		for state in range(self.state_count):
+			if self.ancestors[state] != committed:
+				self.scores[state] = log(0)
+
+		self.oldest = (self.oldest + 1) % (self.lag + 1)
+		self.pending -= 1
+		return committed
+
+	cdef list _commit_converged(StreamingDecoder self):
+		"""
+		Commits every position up to the newest one all surviving paths pass
+		through the same state at
+		"""
+		cdef int state, index, count = 0, next_count
+		cdef int *backpointers
+
+		for state in range(self.state_count):
+			if self.scores[state] > log(0):
+				self.frontier[count] = state
+				count += 1
+
+		if count == 0: return []
+		if count == 1: return self._trace(self.frontier[0], self.pending)
+
+		for index in range(self.pending - 1, 0, -1):
+			backpointers = self.row(index)
+			self.stamp += 1
+			next_count = 0
+
+			for state in range(count):
+				state = backpointers[self.frontier[state]]
+				if state >= 0 and self.marks[state] != self.stamp:
+					self.marks[state] = self.stamp
+					self.frontier[next_count] = state
+					next_count += 1
+
+			count = next_count
+			if count == 1:
+				# Every path goes through frontier[0] at position index - 1
+				return self._trace_to(index - 1, self.frontier[0])
+			if count == 0:
+				return []
+
+		return []
+
+	cdef list _trace_to(StreamingDecoder self, int index, int state):
+		cdef int position
+		cdef list states = [0] * (index + 1)
+
+		for position in range(index, -1, -1):
+			states[position] = state
+			if position > 0:
+				state = self.row(position)[state]
+
+		self.oldest = (self.oldest + index + 1) % (self.lag + 1)
+		self.pending -= index + 1
+		return states
+
+
+cdef class ChainWorkspace:
+	"""
+	Scratch buffers for one decoding thread, grown on demand and reused
+	across calls
+	"""
+	cdef readonly int capacity, state_count
+
+	# All (positions x state_count), row-major
+	cdef double *lattice
+	cdef int *backpointers
+
+	# (positions)
+	cdef int *path
+	# (state_count)
+	cdef int *active
+
+	# Caller-filled local scores (see local_scores)
+	cdef object _local_scores
+
+	def __cinit__(self, int state_count):
+		self.capacity = 0
+		self.state_count = state_count
+		self.lattice = NULL
+		self.backpointers = NULL
+		self.path = NULL
+		self.active = <int*>malloc(max(state_count, 1) * sizeof(int))
+		self._local_scores = numpy.empty((0, state_count))
+
+	def __dealloc__(self):
+		free(self.lattice)
+		free(self.backpointers)
+		free(self.path)
+		free(self.active)
+
+	cdef void reserve(ChainWorkspace self, int length) except *:
+		if length <= self.capacity: return
+
+		# Grow geometrically so a stream of slightly longer sentences doesn't
+		# realloc every call
+		cdef int capacity = max(length, 2 * self.capacity)
+		cdef size_t cells = capacity * self.state_count
+
+		self.lattice = <double*>realloc(self.lattice, cells * sizeof(double))
+		self.backpointers = <int*>realloc(self.backpointers, cells * sizeof(int))
+		self.path = <int*>realloc(self.path, capacity * sizeof(int))
+
+		if not (self.lattice and self.backpointers and self.path and self.active):
+			raise MemoryError()
+
+		self.capacity = capacity
+
+	def local_scores(self, int length):
+		"""
+		Returns a (length x state_count) array to fill with local scores,
+		reusing the same storage across calls
+		"""
+		self.reserve(length)
+		if self._local_scores.shape[0] < self.capacity:
+			self._local_scores = numpy.empty((self.capacity, self.state_count))
+
+		return self._local_scores[:length]
+
+	cdef object path_array(ChainWorkspace self, int length):
+		cdef int pos
+		path = numpy.empty(length, dtype=numpy.int32)
+		cdef int[:] view = path
+
+		for pos in range(length):
+			view[pos] = self.path[pos]
+
+		return path
+
+	def lattice_row(self, int pos):
+		"""
+		Returns (scores, backpointers) at pos from the last decode, with
+		backpointers of state_count or more for unreachable states
+		"""
+		cdef int state
+		scores = [self.lattice[pos * self.state_count + state] for state in range(self.state_count)]
+		backpointers = [self.backpointers[pos * self.state_count + state] for state in range(self.state_count)]
+
+		return scores, backpointers
+
+
+cdef inline void first_row(int start, int state_count, double *local, double *lattice) nogil:
+	cdef int state
+	cdef double ninf = log(0)
+
+	if start < 0:
+		memcpy(lattice, local, state_count * sizeof(double))
+	else:
+		for state in range(state_count):
+			lattice[state] = ninf
+		lattice[start] = local[start]
+
+cdef void viterbi(int length, int start, Transitions *transitions, double *local, double *edge_scores,
+				  double *lattice, int *backpointers) nogil:
+	"""
+	Fills lattice / backpointers (positions x states). A backpointer of
+	state_count (or more) means no predecessor could reach the state.
+	States with a -inf local score are skipped, so masking local scores
+	restricts the candidate states at a position.
+	"""
+	cdef int state_count = transitions.state_count
+	cdef int edge_count = transitions.edge_count
+	cdef int pos, state, last, k
+	cdef double score, candidate
+	cdef double ninf = log(0)
+	cdef double *prev_scores
+	cdef double *curr_scores
+	cdef double *edges
+	cdef double *local_row
+	cdef int *backtrack
+	# Local copies, so the compiler knows stores to the lattice can't move them
+	cdef int *span_start = transitions.span_start
+
+	first_row(start, state_count, local, lattice)
+
+	for pos in range(1, length):
+		prev_scores = lattice + (pos-1) * state_count
+		curr_scores = lattice + pos * state_count
+		backtrack = backpointers + pos * state_count
+		local_row = local + pos * state_count
+
+		if edge_scores == NULL:
+			for state in range(state_count):
+				if local_row[state] == ninf:
+					curr_scores[state] = ninf
+					backtrack[state] = state_count + 1
+					continue
+
+				last = span_max_plus(transitions, prev_scores, state, &score)
+
+				backtrack[state] = span_start[state] + last if last >= 0 else state_count + 1
+				curr_scores[state] = score + local_row[state]
+		else:
+			# Per-position scores: gather over each state's edges
+			edges = edge_scores + pos * edge_count
+			for state in range(state_count):
+				if local_row[state] == ninf:
+					curr_scores[state] = ninf
+					backtrack[state] = state_count + 1
+					continue
+
+				last = -1
+				score = ninf
+				for k in range(transitions.pred_indptr[state], transitions.pred_indptr[state+1]):
+					candidate = prev_scores[transitions.pred_prev[k]] + edges[k]
+					if candidate > score:
+						score = candidate
+						last = transitions.pred_prev[k]
+
+				backtrack[state] = last if last >= 0 else state_count + 1
+				curr_scores[state] = score + local_row[state]
+
+cdef void beam(int length, int start, int beam_size, Transitions *transitions, double *local,
+			   double *edge_scores, double *lattice, int *backpointers, int *active) nogil:
+	"""
+	As viterbi, but each position only extends the beam_size best states of
+	the one before
+	"""
+	cdef int state_count = transitions.state_count
+	cdef int edge_count = transitions.edge_count
+	cdef int pos, state, k, edge, next_state, active_count, i
+	cdef double score, transition
+	cdef double ninf = log(0)
+	cdef double *prev_scores
+	cdef double *curr_scores
+	cdef int *backtrack
+
+	first_row(start, state_count, local, lattice)
+
+	for pos in range(1, length):
+		prev_scores = lattice + (pos-1) * state_count
+		curr_scores = lattice + pos * state_count
+		backtrack = backpointers + pos * state_count
+
+		active_count = top_states(prev_scores, state_count, beam_size, active)
+
+		for state in range(state_count):
+			curr_scores[state] = ninf
+			backtrack[state] = state_count + 1
+
+		for i in range(active_count):
+			state = active[i]
+			for k in range(transitions.succ_indptr[state], transitions.succ_indptr[state+1]):
+				edge = transitions.succ_edge[k]
+				next_state = transitions.edge_next[edge]
+				if edge_scores == NULL:
+					transition = transitions.pred_scores[edge]
+				else:
+					transition = edge_scores[pos * edge_count + edge]
+
+				score = prev_scores[state] + transition
+				# Ties go to the lowest previous state, as in viterbi
+				if score > curr_scores[next_state] or \
+						(score == curr_scores[next_state] and score > ninf and state < backtrack[next_state]):
+					curr_scores[next_state] = score
+					backtrack[next_state] = state
+
+		for state in range(state_count):
+			curr_scores[state] += local[pos * state_count + state]
+
+cdef inline int span_max_plus(Transitions *transitions, double *prev_scores, int state, double *best) nogil:
+	"""
+	max_plus over state's predecessor span, reading the span table at its
+	precision
+	"""
+	cdef double *prev = prev_scores + transitions.span_start[state]
+	cdef int offset = transitions.row_offsets[state]
+	cdef int width = transitions.span_width[state]
+
+	if transitions.span_type == SPAN_FLOAT:
+		return max_plus_float(prev, <float*>transitions.span_scores + offset, width, transitions.span_scale, best)
+	elif transitions.span_type == SPAN_INT16:
+		return max_plus_int16(prev, <short*>transitions.span_scores + offset, width, transitions.span_scale, best)
+	return max_plus(prev, <double*>transitions.span_scores + offset, width, best)
+
+cdef int top_states(double *scores, int state_count, int beam_size, int *active) nogil:
+	"""
+	Writes the (up to) beam_size best reachable states to active and returns
+	how many there are. Keeps active as a min-heap on score while scanning.
+	"""
+	cdef int count = 0
+	cdef int state, pos, child, smallest, swap
+	cdef double ninf = log(0)
+
+	for state in range(state_count):
+		if scores[state] == ninf: continue
+
+		if count < beam_size:
+			# Sift the new state up
+			pos = count
+			active[pos] = state
+			count += 1
+			while pos > 0 and scores[active[(pos-1) / 2]] > scores[active[pos]]:
+				swap = active[pos]
+				active[pos] = active[(pos-1) / 2]
+				active[(pos-1) / 2] = swap
+				pos = (pos-1) / 2
+		elif scores[state] > scores[active[0]]:
+			# Replace the worst and sift it down
+			active[0] = state
+			pos = 0
+			while True:
+				smallest = pos
+				for child in range(2*pos + 1, min(2*pos + 3, count)):
+					if scores[active[child]] < scores[active[smallest]]:
+						smallest = child
+				if smallest == pos: break
+				swap = active[pos]
+				active[pos] = active[smallest]
+				active[smallest] = swap
+				pos = smallest
+
+	return count
+
+cdef double backtrack(int length, int stop, int state_count, double *local, double *lattice,
+					  int *backpointers, int *path) nogil:
+	"""
+	Writes the best path ending in stop (or the best final state) to path
+	and returns its score
+	"""
+	cdef int pos, state, current
+	cdef double score, top_score
+	cdef double ninf = log(0)
+	cdef double *last_row = lattice + (length-1) * state_count
+
+	current = stop
+	if current < 0:
+		current = 0
+		for state in range(state_count):
+			if last_row[state] > last_row[current]:
+				current = state
+
+	path[length-1] = current
+	for pos in range(length-1, 0, -1):
+		current = backpointers[pos * state_count + current]
+
+		if current >= state_count:
+			# Unreachable; take the best local score here instead
+			current = 0
+			top_score = ninf
+			for state in range(state_count):
+				score = local[pos * state_count + state]
+				if score > top_score:
+					top_score = score
+					current = state
+
+		path[pos-1] = current
+
+	return last_row[path[length-1]]
+
+cdef inline double log_add(double a, double b) nogil:
+	if a == log(0): return b
+	if b == log(0): return a
+	if a > b: return a + log(1.0 + exp(b - a))
+	return b + log(1.0 + exp(a - b))
+
+cdef double forward_backward(int length, int start, int stop, Transitions *transitions, double *local,
+							 double *edge_scores, double *alpha, double *beta) nogil:
+	"""
+	Fills alpha / beta (positions x states) with forward and backward log
+	scores and returns the log partition. Each sum is taken relative to its
+	largest term, so there is one exp per edge and one log per state.
+	"""
+	cdef int state_count = transitions.state_count
+	cdef int edge_count = transitions.edge_count
+	cdef int pos, state, k, edge, next_state
+	cdef double total, top, term
+	cdef double ninf = log(0)
+	cdef double *prev_alpha
+	cdef double *next_beta
+	cdef double *next_local
+	cdef double *edges
+
+	first_row(start, state_count, local, alpha)
+
+	for pos in range(1, length):
+		prev_alpha = alpha + (pos-1) * state_count
+		edges = transitions.pred_scores if edge_scores == NULL else edge_scores + pos * edge_count
+
+		for state in range(state_count):
+			top = ninf
+			if local[pos * state_count + state] > ninf:
+				for k in range(transitions.pred_indptr[state], transitions.pred_indptr[state+1]):
+					term = prev_alpha[transitions.pred_prev[k]] + edges[k]
+					if term > top: top = term
+
+			if top == ninf:
+				alpha[pos * state_count + state] = ninf
+				continue
+
+			total = 0.0
+			for k in range(transitions.pred_indptr[state], transitions.pred_indptr[state+1]):
+				total += exp(prev_alpha[transitions.pred_prev[k]] + edges[k] - top)
+			alpha[pos * state_count + state] = top + log(total) + local[pos * state_count + state]
+
+	for state in range(state_count):
+		beta[(length-1) * state_count + state] = 0.0 if stop < 0 or state == stop else ninf
+
+	for pos in range(length-2, -1, -1):
+		next_beta = beta + (pos+1) * state_count
+		next_local = local + (pos+1) * state_count
+		edges = transitions.pred_scores if edge_scores == NULL else edge_scores + (pos+1) * edge_count
+
+		for state in range(state_count):
+			top = ninf
+			for k in range(transitions.succ_indptr[state], transitions.succ_indptr[state+1]):
+				edge = transitions.succ_edge[k]
+				next_state = transitions.edge_next[edge]
+				term = edges[edge] + next_local[next_state] + next_beta[next_state]
+				if term > top: top = term
+
+			if top == ninf:
+				beta[pos * state_count + state] = ninf
+				continue
+
+			total = 0.0
+			for k in range(transitions.succ_indptr[state], transitions.succ_indptr[state+1]):
+				edge = transitions.succ_edge[k]
+				next_state = transitions.edge_next[edge]
+				total += exp(edges[edge] + next_local[next_state] + next_beta[next_state] - top)
+			beta[pos * state_count + state] = top + log(total)
+
+	total = ninf
+	for state in range(state_count):
+		total = log_add(total, alpha[(length-1) * state_count + state] + beta[(length-1) * state_count + state])
+
+	return total
+
+cdef double forward_backward_scaled(int length, int start, int stop, Transitions *transitions, double *local,
+									double *alpha, double *beta, double *scratch) nogil:
+	"""
+	forward_backward for static transitions, summed in probability space:
+	each row of log scores is shifted by its max and exponentiated once per
+	state, so the inner loops multiply by pred_probs with no exp / log per
+	edge. Fills the same log scores. scratch holds state_count doubles.
+	"""
+	cdef int state_count = transitions.state_count
+	cdef int pos, state, k, edge
+	cdef double top, weight
+	cdef double ninf = log(0)
+	cdef double *row
+	cdef double *prev
+
+	first_row(start, state_count, local, alpha)
+
+	for pos in range(1, length):
+		prev = alpha + (pos-1) * state_count
+		top = ninf
+		for state in range(state_count):
+			if prev[state] > top: top = prev[state]
+		for state in range(state_count):
+			scratch[state] = exp(prev[state] - top) if top > ninf else 0.0
+
+		row = local + pos * state_count
+		for state in range(state_count):
+			weight = 0.0
+			if row[state] > ninf:
+				for k in range(transitions.pred_indptr[state], transitions.pred_indptr[state+1]):
+					weight = weight + scratch[transitions.pred_prev[k]] * transitions.pred_probs[k]
+			alpha[pos * state_count + state] = top + log(weight) + row[state] if weight > 0.0 else ninf
+
+	for state in range(state_count):
+		beta[(length-1) * state_count + state] = 0.0 if stop < 0 or state == stop else ninf
+
+	for pos in range(length-2, -1, -1):
+		# Backward scores of the next position, with its local scores
+		prev = beta + (pos+1) * state_count
+		row = local + (pos+1) * state_count
+		top = ninf
+		for state in range(state_count):
+			if prev[state] + row[state] > top: top = prev[state] + row[state]
+		for state in range(state_count):
+			scratch[state] = exp(prev[state] + row[state] - top) if top > ninf else 0.0
+
+		for state in range(state_count):
+			weight = 0.0
+			for k in range(transitions.succ_indptr[state], transitions.succ_indptr[state+1]):
+				edge = transitions.succ_edge[k]
+				weight = weight + transitions.pred_probs[edge] * scratch[transitions.edge_next[edge]]
+			beta[pos * state_count + state] = top + log(weight) if weight > 0.0 else ninf
+
+	top = ninf
+	for state in range(state_count):
+		top = log_add(top, alpha[(length-1) * state_count + state] + beta[(length-1) * state_count + state])
+
+	return top
+
+def benchmark_max_plus(int label_count=2000, int width=45, int iterations=20):
+	"""
+	Times the blocked max_plus kernel against the scalar gather kernel over
+	iterations viterbi steps of label_count states with width predecessors
+	each. Returns (blocked seconds, scalar seconds).
+	"""
+	from random import random
+	from time import time
+
+	cdef int i, k, step
+	cdef double best
+	# Checksums keep the calls live and check the kernels agree
+	cdef double blocked_total = 0.0, scalar_total = 0.0
+	cdef long blocked_args = 0, scalar_args = 0
+	cdef double *prev_scores = <double*>malloc(label_count * sizeof(double))
+	cdef double *rows = <double*>malloc(label_count * width * sizeof(double))
+	cdef int *pred_idx = <int*>malloc(label_count * width * sizeof(int))
+	cdef int *starts = <int*>malloc(label_count * sizeof(int))
+
+	for i in range(label_count):
+		prev_scores[i] = -100.0 * random()
+		starts[i] = (i % (label_count / width)) * width
+		for k in range(width):
+			rows[i * width + k] = -10.0 * random()
+			pred_idx[i * width + k] = starts[i] + k
+
+	start = time()
+	with nogil:
+		for step in range(iterations):
+			for i in range(label_count):
+				blocked_args += starts[i] + max_plus(prev_scores + starts[i], rows + i * width, width, &best)
+				blocked_total += best
+	blocked = time() - start
+
+	start = time()
+	with nogil:
+		for step in range(iterations):
+			for i in range(label_count):
+				scalar_args += max_plus_scalar(prev_scores, pred_idx + i * width, rows + i * width, width, &best)
+				scalar_total += best
+	scalar = time() - start
+
+	free(prev_scores)
+	free(rows)
+	free(pred_idx)
+	free(starts)
+
+	assert blocked_total == scalar_total and blocked_args == scalar_args, "max_plus kernels disagree"
+
+	return blocked, scalar
@@ -1,201 +1,459 @@
 # cython viterbi decoding & scoring
+from functools import partial
 from itertools import izip
-from counter import Counter
+from multiprocessing.pool import ThreadPool
+import time
 
-include "stdlib.pxi"
-include "math.pxi"
-
-cdef enum bool_:
-	false = 0
-	true = 1
+import numpy
+cimport cython
 
-# class cyHMM:
-# 	# encoding / decoding dictionaries
-# 	cdef object label_idx
-# 	cdef object idx_label[]
+from cychain import ChainDecoder, StreamingDecoder
+from quantize import INT16_NINF, dequantize_scores
+from utilities import LRUCache
 
-# 	# scores, indexed by encoded label / emission
-# 	cdef double emission_scores[][]
-# 	cdef double transition_scores[][]
+include "stdlib.pxi"
+include "math.pxi"
 
 cdef class CyHMM:
+	"""
+	Decodes a HiddenMarkovModel with cychain.ChainDecoder. States are ordered
+	so the legal predecessors of a state (every X::A for state A::B) are
+	contiguous, which keeps the decoder's predecessor spans dense.
+	"""
 	cdef readonly object label_idx, idx_label
-	cdef double **transition_idx_scores
 	cdef int label_count
 
-	cdef double *zero_scores
-
-	def __init__(self, labels, transition_scores):
-	#	state = cyHMM()
+	# idx_history[idx] is the label-id tuple of state idx (see StateSpace),
+	# idx_tag[idx] its last label
+	cdef object idx_history, idx_tag
+	# idx_history as a (states x label_history_size) array
+	cdef object history_table
+	# state_space id => idx (-1 if not decoded)
+	cdef object idx_of_state
+
+	cdef readonly object decoder
+
+	# A fallback model with precomputed signature rows (see
+	# unknownwords.UnknownWordModel) and those rows in decoder order
+	cdef object unknown_model, unknown_rows
+	# Known emissions' scores in decoder order (built from the score tables
+	# in emission_source): emission id e's states and scores are
+	# emission_idx / emission_values[emission_indptr[e]:emission_indptr[e+1]].
+	# Values keep the table's precision (see quantize.py) and emission_scale
+	cdef object emission_source, emission_indptr, emission_idx, emission_values
+	cdef double emission_scale
+	# Other fallback distributions as rows in decoder order, by the id of
+	# the distribution (many emissions share one, e.g. a uniform fallback)
+	cdef object fallback_rows
+
+	# Per-state count of incoming transitions, the average outgoing count and
+	# the decoder's measured speed in lattice operations (edges and states
+	# visited) per second, for budgeted decoding (0 until measured)
+	cdef object in_degrees
+	cdef double out_degree
+	cdef readonly double operation_rate
+
+	def __init__(self, labels, state_space, transitions, fallback_cache_size=10000, transition_scale=1.0):
+		"""
+		Builds the decoder over the states named in labels, taking transition
+		scores from transitions, a dense (states x labels) array indexed like
+		state_space.push_table (see HiddenMarkovModel.score_tables). A
+		float32 or int16 (fixed point, times transition_scale) table is
+		decoded at that precision.
+		"""
 		self.label_idx = dict()
-		self.idx_label = list()
 
-		for idx, label in enumerate(labels):
+		# Group states by the history they extend (so A::B sits next to all
+		# the other states ending in B, which are exactly its successors'
+		# predecessors)
+		states = dict((label, state_space.state_of(label)) for label in labels)
+		histories = dict((label, state_space.histories[states[label]]) for label in labels)
+		self.idx_label = sorted(labels, key=lambda label: (histories[label][1:], histories[label]))
+		self.idx_history = [histories[label] for label in self.idx_label]
+		self.idx_tag = [state_space.labels[history[-1]] for history in self.idx_history]
+		self.history_table = numpy.array(self.idx_history, dtype=numpy.int32).reshape(len(labels), -1)
+
+		for idx, label in enumerate(self.idx_label):
 			self.label_idx[label] = idx
-			self.idx_label.append(label)
 
 		self.label_count = len(labels)
-
-		cdef int i
-		cdef double ninf = log(0)
-		self.zero_scores = <double*>malloc(self.label_count * sizeof(double))
-
-		for i in range(self.label_count):
-			self.zero_scores[i] = ninf
-
-		self.transition_idx_scores = <double **>malloc(len(labels) * sizeof(double*))
-		for transition in labels:
-			t_idx = self.label_idx[transition]
-			self.transition_idx_scores[t_idx] = <double *>malloc(len(labels) * sizeof(double))
-
-			for next in labels:
-				n_idx = self.label_idx[next]
-				if transition in transition_scores and next in transition_scores[transition]:
-					self.transition_idx_scores[t_idx][n_idx] = transition_scores[transition][next]
-				else:
-					self.transition_idx_scores[t_idx][n_idx] = float("-inf")
-
-	cdef void add_score_vectors(CyHMM self, double *dst, double *a, double *b, int length):
-		cdef int i
-		for i in range(length):
-			dst[i] = a[i] + b[i]
-
-	cdef int** forward(CyHMM self, object hmm, object emission_sequence, int *arg_maxes, bool_ debug) except *:
-		# Backtracking pointers - backtrack[position] = {state : prev, ...}
-		cdef int **backpointers = <int**>malloc(len(emission_sequence) * sizeof(int*))
-		cdef size_t scores_len = self.label_count * sizeof(double)
-		cdef int pos, i, label_idx
-
-		# These two should really be outside of the forward def'n
+		self.fallback_rows = LRUCache(fallback_cache_size)
+
+		self.idx_of_state = numpy.empty(len(state_space), dtype=numpy.int32)
+		self.idx_of_state.fill(-1)
+		self.idx_of_state[[states[label] for label in self.idx_label]] = numpy.arange(self.label_count)
+
+		# Only keep transitions that were observed and are consistent with the
+		# history encoded in the state (A::B can only be reached from X::A,
+		# which is what push_table encodes)
+		table = numpy.asarray(transitions)
+		transitions = dequantize_scores(table, transition_scale)
+		prev_states, next_labels = numpy.nonzero(transitions > float("-inf"))
+		next_states = state_space.push_table[prev_states, next_labels]
+		reachable = next_states >= 0
+		prev_states, next_labels, next_states = prev_states[reachable], next_labels[reachable], next_states[reachable]
+
+		prev_idx = self.idx_of_state[prev_states]
+		next_idx = self.idx_of_state[next_states]
+		decoded = (prev_idx >= 0) & (next_idx >= 0)
+
+		self.decoder = ChainDecoder(self.label_count, prev_idx[decoded], next_idx[decoded],
+									transitions[prev_states[decoded], next_labels[decoded]],
+									precision=table.dtype.name, scale=transition_scale)
+
+		self.in_degrees = numpy.bincount(next_idx[decoded], minlength=self.label_count).astype(numpy.float64)
+		self.out_degree = float(self.decoder.transition_count) / max(self.label_count, 1)
+
+		# Calibrated here, so no budgeted labelling pays for it
+		self.operation_rate = 0.0
+		self.measure_operation_rate()
+
+	property transition_count:
+		def __get__(self):
+			return self.decoder.transition_count
+
+	def predecessors(self, label):
+		"""
+		Returns the (previous state, transition score) pairs the decoder
+		considers when arriving in label
+		"""
+		return [(self.idx_label[prev], score) for prev, score in self.decoder.predecessors(self.label_idx[label])]
+
+	def workspace(self):
+		"""
+		Returns the calling thread's decoding workspace
+		"""
+		return self.decoder.workspace()
+
+	def _unknown_rows(self, model):
+		"""
+		Returns model's signature rows with columns in decoder order (-inf for
+		states the model never saw)
+		"""
+		if model is not self.unknown_model:
+			columns = dict((label, column) for column, label in enumerate(model.labels))
+			rows = numpy.empty((model.log_rows.shape[0], self.label_count))
+			rows.fill(log(0))
+
+			for label_idx, label in enumerate(self.idx_label):
+				if label in columns:
+					rows[:, label_idx] = model.log_rows[:, columns[label]]
+
+			self.unknown_model, self.unknown_rows = model, rows
+
+		return self.unknown_rows
+
+	def _fallback_row(self, scores, key):
+		# Keeping scores alive keeps its id from being reused
+		return scores, numpy.array([scores[label] for label in self.idx_label], dtype=numpy.float64)
+
+	@cython.boundscheck(False)
+	@cython.wraparound(False)
+	cdef void fill_emissions(CyHMM self, object hmm, object emission_sequence, double[:, ::1] emissions) except *:
+		cdef int pos, label_idx, signature, emission_id, k
 		cdef double ninf = log(0)
-		cdef double *curr_scores, *prev_scores, *swap
-
-		curr_scores = <double*>malloc(scores_len * sizeof(double))
-		prev_scores = <double*>malloc(scores_len * sizeof(double))
-		memcpy(prev_scores, self.zero_scores, scores_len * sizeof(double))
-
-		# Manually unroll first iteration so we don't risk branch mispredict
-		# (indented to signify it really belongs below)
-			# Pack curr_scores with just the reduced start history
-		cdef int start_label = self.label_idx[hmm.start_label]
-		prev_scores[start_label] = 0.0
-		backpointers[0] = <int*>malloc(self.label_count * sizeof(int))
-
-		# loop vars
-		cdef int last_label
-		cdef int *backtrack
-		cdef double score = ninf
-		cdef double label_score = ninf
-		cdef double top_score = ninf
-
-		if debug == true:
-			print "LABEL :: %s" % emission_sequence
-
-		for pos in range(1, len(emission_sequence)):
-			# loop vars
-			backpointers[pos] = <int*>malloc(self.label_count * sizeof(int))
-			backtrack = backpointers[pos]
-			emission = emission_sequence[pos]
-			top_score = ninf
-
-			if debug == true:
-				print "** ENTERING POS %d     :: %s" % (pos, emission)
-
-			# Wipe out scores
-			memcpy(curr_scores, self.zero_scores, scores_len)
-			
-			if debug == true:
-				print " >> PREVIOUS SCORES    :: %s" % [(self.idx_label[history], prev_scores[history]) for history in range(self.label_count) if prev_scores[history] > float("-inf")]
-
+		cdef double[:, ::1] unknown_rows = None
+		cdef double[::1] fallback_row
+		# const, as compiled models' tables are read-only maps
+		cdef const int[::1] indptr, idx
+		cdef const double[::1] values = None
+		cdef const float[::1] float_values = None
+		cdef const short[::1] fixed_values = None
+		cdef short fixed_ninf = INT16_NINF
+		cdef double scale
+
+		transitions, emission_vocabulary, emission_keys, emission_scores = hmm.score_tables()
+		if emission_keys is not self.emission_source:
+			self._emission_table(emission_keys, emission_scores, transitions.shape[0], len(emission_vocabulary),
+								 hmm.score_scales[1])
+		indptr, idx, scale = self.emission_indptr, self.emission_idx, self.emission_scale
+
+		table = self.emission_values
+		if table.dtype == numpy.float32: float_values = table
+		elif table.dtype == numpy.int16: fixed_values = table
+		else: values = table
+
+		fallback = hmm.fallback_emissions_model
+		if hasattr(fallback, "log_rows"):
+			unknown_rows = self._unknown_rows(fallback)
+
+		for pos, emission in enumerate(emission_sequence):
+			emission_id = emission_vocabulary.get(emission, -1)
+
+			if emission_id < 0 and unknown_rows is not None:
+				# One precomputed row per signature
+				signature = fallback.signature(emission)
+				for label_idx in range(self.label_count):
+					emissions[pos, label_idx] = unknown_rows[signature, label_idx]
+				continue
+
+			if emission_id < 0:
+				# Unknown emissions go through the model's fallback
+				scores = hmm.emission_scores(emission)
+				fallback_row = self.fallback_rows.lookup(id(scores), partial(self._fallback_row, scores))[1]
+				for label_idx in range(self.label_count):
+					emissions[pos, label_idx] = fallback_row[label_idx]
+				continue
+
+			# Only the states seen with a known emission score above -inf,
+			# which is at least as tight as hmm.tag_dictionary, and the decoder
+			# skips the rest
 			for label_idx in range(self.label_count):
-# 				if debug == true:
-# 					print "    ++ LABEL          :: %s" % self.idx_label[label_idx]
-				# Pick max / argmax of sums
-				last_label = self.label_count + 1
-				score = ninf
-
-				for i in range(self.label_count):
-					label_score = prev_scores[i] + self.transition_idx_scores[label_idx][i]
-					if label_score > score:
-						last_label = i
-						score = label_score
-
-				backtrack[label_idx] = last_label
-				curr_scores[label_idx] = score
-
-			if debug == true:
-				print " >> PREVIOUS           :: %s" % [(self.idx_label[label_idx], self.idx_label[backtrack[label_idx]], prev_scores[backtrack[label_idx]]) for label_idx in range(self.label_count) if backtrack[label_idx] < self.label_count]
-				print " ++ TRANSITIONS        ::",
-				if hmm.label_emissions.get(emission):
-					print ["%s => %s :: %f" % (self.idx_label[backtrack[label_idx]], self.idx_label[label_idx], curr_scores[label_idx]) for label_idx in range(self.label_count) if self.idx_label[label_idx] in hmm.label_emissions[emission] and backtrack[label_idx] < self.label_count]
-				else:
-					print ["%s => %s :: %f" % (self.idx_label[backtrack[label_idx]], self.idx_label[label_idx], curr_scores[label_idx]) for label_idx in range(self.label_count) if backtrack[label_idx] < self.label_count]
-
-			emission_scores = hmm.emission_scores(emission)
-			arg_maxes[pos] = 0
-			for label_idx in range(self.label_count):
-				label = self.idx_label[label_idx]
-				score = emission_scores[label]
-				curr_scores[label_idx] += score
-
-				if score > top_score:
-					top_score = score
-					arg_maxes[pos] = label_idx
-
-			if debug == true:
-				print " ++ EMISSION SCORES    :: %s" % emission_scores.items()
-
-			if debug == true: print "=> EXITING WITH SCORES :: %s" % [(self.idx_label[label], curr_scores[label]) for label in range(self.label_count) if curr_scores[label] > ninf]
-
-			# And set up for the next iteration
-			swap = prev_scores
-			prev_scores = curr_scores
-			curr_scores = swap # will be obliterated in the beginning of the loop
+				emissions[pos, label_idx] = ninf
+
+			if values is not None:
+				for k in range(indptr[emission_id], indptr[emission_id+1]):
+					emissions[pos, idx[k]] = values[k]
+			elif float_values is not None:
+				for k in range(indptr[emission_id], indptr[emission_id+1]):
+					emissions[pos, idx[k]] = float_values[k]
+			else:
+				for k in range(indptr[emission_id], indptr[emission_id+1]):
+					emissions[pos, idx[k]] = ninf if fixed_values[k] == fixed_ninf else fixed_values[k] * scale
+
+	def _emission_table(self, emission_keys, emission_scores, state_count, vocabulary_size, scale=1.0):
+		# Known emissions are contiguous runs of the sorted emission_keys
+		# (emission id * state_count + state)
+		emission_ids = emission_keys // state_count
+		states = emission_keys % state_count
+
+		idx = numpy.empty(len(states), dtype=numpy.int32)
+		idx.fill(-1)
+		known = states < len(self.idx_of_state)
+		idx[known] = self.idx_of_state[states[known]]
+		decoded = idx >= 0
+
+		self.emission_indptr = numpy.searchsorted(emission_ids[decoded],
+												  numpy.arange(vocabulary_size + 1)).astype(numpy.int32)
+		self.emission_idx = idx[decoded]
+		self.emission_values = numpy.ascontiguousarray(emission_scores[decoded])
+		if self.emission_values.dtype not in (numpy.float32, numpy.int16):
+			self.emission_values = self.emission_values.astype(numpy.float64)
+		self.emission_scale = scale
+		# Last, so other threads never see a half-built table as current
+		self.emission_source = emission_keys
+
+	@cython.boundscheck(False)
+	@cython.wraparound(False)
+	cdef void _mask(CyHMM self, double[:, ::1] emissions, object tag_mask) except *:
+		# Drops the states with a label in their history that tag_mask rules
+		# out where it was emitted
+		cdef const int[:, ::1] history = self.history_table
+		cdef const unsigned char[:, ::1] mask = numpy.ascontiguousarray(tag_mask, dtype=bool).view(numpy.uint8)
+		cdef int length = min(emissions.shape[0], mask.shape[0])
+		cdef int history_size = history.shape[1]
+		cdef int pos, state, back
+		cdef double ninf = log(0)
 
-		free(curr_scores)
-		free(prev_scores)
+		with nogil:
+			for pos in range(length):
+				for state in range(self.label_count):
+					if emissions[pos, state] == ninf: continue
+					for back in range(min(history_size, pos+1)):
+						if not mask[pos-back, history[state, history_size-1-back]]:
+							emissions[pos, state] = ninf
+							break
+
+	def local_scores(self, hmm, emission_sequence, tag_mask=None):
+		"""
+		Returns the (workspace) local scores for decoding the padded
+		emission_sequence. tag_mask, a (positions x state_space labels)
+		boolean array, rules out a label at a position where it is False
+		(positions past its end are unconstrained).
+		"""
+		emissions = self.workspace().local_scores(len(emission_sequence))
+		self.fill_emissions(hmm, emission_sequence, emissions)
+		if tag_mask is not None:
+			self._mask(emissions, tag_mask)
+
+		# The chain is anchored in the start state, which emits nothing
+		emissions[0, self.label_idx[hmm.start_label]] = 0.0
+		return emissions
+
+	def state_posteriors(self, hmm, emission_sequence):
+		"""
+		Returns the (padded positions x states, in idx_label order) marginals
+		of the states given emission_sequence, or None if no path reaches the
+		stop state
+		"""
+		emission_sequence = list(hmm._pad_sequence(emission_sequence))
+		emissions = self.local_scores(hmm, emission_sequence)
 
-		return backpointers
+		log_z, posteriors = self.decoder.forward_backward(emissions, start=self.label_idx[hmm.start_label],
+														  stop=self.label_idx[hmm.stop_label])
+		if log_z == log(0): return None
+		return posteriors
 
-	def label(self, hmm, emission_sequence, debug=False, return_score=False):
+	def label(self, hmm, emission_sequence, debug=False, return_score=False, beam_size=None, tag_mask=None):
 		# This needs to perform viterbi decoding on the the emission sequence
 		emission_length = len(emission_sequence)
 		emission_sequence = list(hmm._pad_sequence(emission_sequence))
 
-		cdef bool_ c_debug = false
-		if debug:
-			c_debug = true
-
-		cdef int *arg_maxes = <int*>malloc(len(emission_sequence) * sizeof(int))
-		cdef int **backtrack = self.forward(hmm, emission_sequence, arg_maxes, c_debug)
-		cdef int pos, current_idx
+		cdef int start_idx = self.label_idx[hmm.start_label]
+		cdef int stop_idx = self.label_idx[hmm.stop_label]
 
-		# Now decode
-		states = list()
-		current = hmm.stop_label
-		current_idx = self.label_idx[current]
-		if debug:
-			print "Starting at stop label %s (idx %d)" % (current, current_idx)
+		emissions = self.local_scores(hmm, emission_sequence, tag_mask)
 
-		for pos in range(len(emission_sequence)-1, 0, -1):
-			current_idx = backtrack[pos][current_idx]
-			free(backtrack[pos])
+		if beam_size:
+			path, score = self.decoder.beam(emissions, beam_size, start=start_idx, stop=stop_idx)
+		else:
+			path, score = self.decoder.viterbi(emissions, start=start_idx, stop=stop_idx)
 
-			if current_idx >= self.label_count:
-				current_idx = arg_maxes[pos]
+		if debug:
+			self.debug_lattice(emission_sequence, path)
 
-			current = self.idx_label[current_idx]
+		# Pop all the extra start & stop states
+		states = [self.idx_tag[idx] for idx in path[1:].tolist()]
+		states = states[:emission_length]
 
-			if debug:
-				print "pos %d => %s (idx %d)" % (pos, current, current_idx)
-			states.append(current.split('::')[-1])
+		if return_score:
+			return states, score
+		return states
 
-		free(backtrack)
-		free(arg_maxes)
+	def measure_operation_rate(self, int length=32, int repeats=3):
+		"""
+		Times exact decoding of a lattice where every state is live and sets
+		(and returns) operation_rate from the fastest run
+		"""
+		emissions = numpy.zeros((length, self.label_count))
+		operations = length * float(self.decoder.transition_count)
+		best = float("inf")
+
+		for _ in range(repeats):
+			began = time.time()
+			self.decoder.viterbi(emissions)
+			best = min(best, time.time() - began)
+
+		self.operation_rate = operations / max(best, 1e-9)
+		return self.operation_rate
+
+	def label_within(self, hmm, emission_sequence, max_operations=None, max_seconds=None, tag_mask=None):
+		"""
+		Anytime labelling. Decodes exactly if the lattice's projected cost (the
+		edges into live states) fits both budgets, else with the widest beam
+		that fits, else greedily (a beam of one: each position takes the best
+		transition + emission out of the last). Time spent filling the
+		lattice counts against max_seconds, which is converted to operations
+		at operation_rate, measured when the model is built. Returns (states, score, mode, beam_size), where
+		mode is 'exact', 'beam' or 'greedy' and beam_size is None if exact.
+		"""
+		began = time.time()
+		emission_length = len(emission_sequence)
+		emission_sequence = list(hmm._pad_sequence(emission_sequence))
 
-		# Pop all the extra stop states
-		states.reverse()
-		states = states[1:]
-		states = states[:emission_length]
+		cdef int start_idx = self.label_idx[hmm.start_label]
+		cdef int stop_idx = self.label_idx[hmm.stop_label]
+		cdef int length = len(emission_sequence)
+
+		emissions = self.local_scores(hmm, emission_sequence, tag_mask)
+
+		budget = float("inf") if max_operations is None else float(max_operations)
+		if max_seconds is not None:
+			budget = min(budget, (max_seconds - (time.time() - began)) * self.operation_rate)
+
+		operations = float(numpy.dot((emissions > log(0)).sum(axis=0), self.in_degrees))
+		decode_began = time.time()
+		if operations <= budget:
+			beam_size = None
+			path, score = self.decoder.viterbi(emissions, start=start_idx, stop=stop_idx)
+		else:
+			# Each position scans every state for the beam, then extends it
+			if self.out_degree > 0:
+				beam_size = int((budget / length - self.label_count) / self.out_degree)
+				beam_size = max(1, min(beam_size, self.label_count))
+			else:
+				beam_size = 1
+			operations = length * (self.label_count + beam_size * self.out_degree)
+			path, score = self.decoder.beam(emissions, beam_size, start=start_idx, stop=stop_idx)
+
+		decoding = time.time() - decode_began
+		if decoding > 0 and self.operation_rate:
+			self.operation_rate = 0.9 * self.operation_rate + 0.1 * operations / decoding
+
+		if beam_size is None: mode = 'exact'
+		elif beam_size == 1: mode = 'greedy'
+		else: mode = 'beam'
+
+		states = [self.idx_tag[idx] for idx in path[1:].tolist()]
+		return states[:emission_length], score, mode, beam_size
+
+	def label_many(self, hmm, emission_sequences, threads=None, beam_size=None):
+		"""
+		Labels each of emission_sequences, decoding on a pool of threads (the
+		decoder runs without the GIL)
+		"""
+		pool = ThreadPool(threads)
+
+		try:
+			return pool.map(lambda emission_sequence: self.label(hmm, emission_sequence, beam_size=beam_size),
+							emission_sequences)
+		finally:
+			pool.close()
+
+	def debug_lattice(self, emission_sequence, path):
+		workspace = self.workspace()
+
+		print "LABEL :: %s" % emission_sequence
+		for pos in range(1, len(emission_sequence)):
+			scores, backpointers = workspace.lattice_row(pos)
+			print "** POS %d     :: %s" % (pos, emission_sequence[pos])
+
+			for label_idx, (score, prev) in enumerate(izip(scores, backpointers)):
+				if prev < self.label_count and score > float("-inf"):
+					print "   %s => %s :: %f" % (self.idx_label[prev], self.idx_label[label_idx], score)
+
+		print "PATH :: %s" % [self.idx_label[idx] for idx in path]
+
+
+cdef class StreamingLabeller:
+	"""
+	Tags emissions pushed one at a time, without waiting for the end of the
+	sequence (see HiddenMarkovModel.streaming_labeller)
+	"""
+	cdef CyHMM cyhmm
+	cdef object hmm, stream, emissions
+	cdef int stop_idx
+
+	# Emissions pushed / tagged since the last finish
+	cdef readonly int pushed, tagged
+
+	def __init__(self, CyHMM cyhmm, hmm, int lag):
+		self.cyhmm = cyhmm
+		self.hmm = hmm
+		self.stream = StreamingDecoder(cyhmm.decoder, start=cyhmm.label_idx[hmm.start_label], lag=lag)
+		self.stop_idx = cyhmm.label_idx[hmm.stop_label]
+		self.emissions = numpy.empty((1, cyhmm.label_count))
+		self.pushed = 0
+		self.tagged = 0
+
+	def _step(self, emission):
+		self.cyhmm.fill_emissions(self.hmm, [emission], self.emissions)
+		return self.stream.push(self.emissions[0])
+
+	def _tags(self, states):
+		# Anything past the pushed emissions is stop padding
+		states = states[:self.pushed - self.tagged]
+		self.tagged += len(states)
+		return [self.cyhmm.idx_tag[idx] for idx in states]
+
+	def push(self, emission):
+		"""
+		Adds the next emission, returning the tags that became certain (or
+		reached the lag) as a result
+		"""
+		self.pushed += 1
+		return self._tags(self._step(emission))
+
+	def finish(self):
+		"""
+		Ends the sequence, returning the remaining tags. The labeller can
+		then be reused for the next sequence.
+		"""
+		states = list()
+		for emission in list(self.hmm._pad_sequence([]))[1:]:
+			states.extend(self._step(emission))
+		states.extend(self.stream.finish(self.stop_idx))
 
-		return states
+		tags = self._tags(states)
+		self.pushed = self.tagged = 0
+		return tags
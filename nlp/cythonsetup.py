@@ -4,5 +4,6 @@ from distutils.extension import Extension
 from Cython.Distutils import build_ext
 
 setup(cmdclass = {'build_ext': build_ext}, ext_modules = [Extension("cymaxent", ["cymaxent.pyx"]),
+														  Extension("cychain", ["cychain.pyx"], depends=["max-plus.h"]),
 														  Extension("cyhmm", ["cyhmm.pyx"]),
 														  Extension("future_math", ["future_math.pyx"])])
@@ -0,0 +1,160 @@
+'''
+Parallel tagger evaluation. Test sentences are tagged in chunks over a
+process pool, and the results are int-coded so accuracy, the confusion
+matrix and unknown word accuracy are array operations. Also measures
+throughput and per-sentence latency.
+'''
+
+from functools import partial
+from itertools import izip
+from multiprocessing import Pool
+from time import time
+
+import numpy
+
+# The tagger worker processes label with, inherited when the pool forks
+_worker_tagger = None
+
+def _set_worker_tagger(tagger):
+	global _worker_tagger
+	_worker_tagger = tagger
+
+def _tag_chunk(tagger, (begin, emission_sequences)):
+	guesses, latencies = list(), list()
+
+	for emissions in emission_sequences:
+		start = time()
+		guesses.append(tagger.label(emissions))
+		latencies.append(time() - start)
+
+	return begin, guesses, latencies
+
+def _worker_tag_chunk(chunk):
+	return _tag_chunk(_worker_tagger, chunk)
+
+class Evaluation(object):
+	"""
+	A tagger's results on a test set. Labels are int-coded by labels:
+	gold and guessed are per-token label ids and unknown marks the tokens
+	whose emission the tagger never saw. confusion[gold, guess] counts
+	tokens. Latencies are per sentence, in seconds; seconds is the wall
+	time of the whole run.
+	"""
+
+	def __init__(self, labels, gold, guessed, unknown, latencies, seconds):
+		self.labels = labels
+		self.gold = gold
+		self.guessed = guessed
+		self.unknown = unknown
+		self.latencies = latencies
+		self.seconds = seconds
+
+		label_count = len(labels)
+		self.confusion = numpy.bincount(gold * label_count + guessed,
+										minlength=label_count * label_count).reshape(label_count, label_count)
+
+	@property
+	def tokens(self):
+		return len(self.gold)
+
+	@property
+	def sentences(self):
+		return len(self.latencies)
+
+	@property
+	def accuracy(self):
+		return float(numpy.trace(self.confusion)) / max(self.tokens, 1)
+
+	@property
+	def unknown_accuracy(self):
+		"""
+		Accuracy on tokens with unknown emissions (None if there are none)
+		"""
+		if not self.unknown.any(): return None
+		return float((self.gold == self.guessed)[self.unknown].mean())
+
+	@property
+	def tokens_per_second(self):
+		return self.tokens / self.seconds if self.seconds > 0 else float("inf")
+
+	def latency(self, percentile):
+		"""
+		Returns the percentile (0-100) per-sentence latency in seconds
+		"""
+		if not self.latencies.size: return 0.0
+		return float(numpy.percentile(self.latencies, percentile))
+
+	def confusions(self, count=10):
+		"""
+		Returns the count most frequent (gold label, guessed label, tokens)
+		mistakes
+		"""
+		mistakes = self.confusion.copy()
+		numpy.fill_diagonal(mistakes, 0)
+		order = numpy.argsort(mistakes, axis=None)[::-1][:count]
+
+		return [(self.labels[index // len(self.labels)], self.labels[index % len(self.labels)], int(mistakes.flat[index]))
+				for index in order.tolist() if mistakes.flat[index] > 0]
+
+	def report(self):
+		lines = ["%d correct (%.3f%% of %d)" % (numpy.trace(self.confusion), 100.0 * self.accuracy, self.tokens)]
+
+		if self.unknown.any():
+			lines.append("Unknown words: %.3f%% of %d" % (100.0 * self.unknown_accuracy, self.unknown.sum()))
+
+		lines.append("Speed: %.0f tokens/sec (%d sentences in %f)" % (self.tokens_per_second, self.sentences, self.seconds))
+		lines.append("Latency: p50 %.2fms, p99 %.2fms" % (1000.0 * self.latency(50), 1000.0 * self.latency(99)))
+
+		for gold, guess, count in self.confusions(5):
+			lines.append("  %s => %s: %d" % (gold, guess, count))
+
+		return "\n".join(lines)
+
+def evaluate(tagger, labeled_sentences, processes=None, known_emissions=None, chunk_size=32):
+	"""
+	Tags labeled_sentences ((labels, emissions) pairs, as
+	PennTreebankReader reads them) with tagger.label and returns an
+	Evaluation. Chunks of chunk_size sentences are tagged over a pool of
+	processes (all cores by default; 1 tags in this process). Workers
+	inherit the tagger when the pool forks, so it is never pickled, and a
+	compiled model's tables stay shared. Tokens whose emission isn't in
+	known_emissions count as unknown.
+	"""
+	sentences = [(list(labels), list(emissions)) for labels, emissions in labeled_sentences]
+	chunks = [(begin, [emissions for _, emissions in sentences[begin:begin+chunk_size]])
+			  for begin in xrange(0, len(sentences), chunk_size)]
+
+	start = time()
+	if processes == 1:
+		results = map(partial(_tag_chunk, tagger), chunks)
+	else:
+		pool = Pool(processes, initializer=_set_worker_tagger, initargs=(tagger,))
+		try:
+			results = pool.map(_worker_tag_chunk, chunks)
+		finally:
+			pool.close()
+			pool.join()
+	seconds = time() - start
+
+	guesses = [None] * len(sentences)
+	latencies = numpy.zeros(len(sentences))
+	for begin, chunk_guesses, chunk_latencies in results:
+		guesses[begin:begin+len(chunk_guesses)] = chunk_guesses
+		latencies[begin:begin+len(chunk_latencies)] = chunk_latencies
+
+	# Int-code the tokens; a missing guess is a label of its own
+	label_idx = dict()
+	gold, guessed, unknown = list(), list(), list()
+	for (labels, emissions), guess in izip(sentences, guesses):
+		guess = list(guess) + [None] * (len(labels) - len(guess))
+		for label, guessed_label, emission in izip(labels, guess, emissions):
+			gold.append(label_idx.setdefault(label, len(label_idx)))
+			guessed.append(label_idx.setdefault(guessed_label, len(label_idx)))
+			unknown.append(known_emissions is not None and emission not in known_emissions)
+
+	labels = [None] * len(label_idx)
+	for label, idx in label_idx.iteritems():
+		labels[idx] = label
+
+	return Evaluation(labels, numpy.array(gold, dtype=numpy.int64), numpy.array(guessed, dtype=numpy.int64),
+					  numpy.array(unknown, dtype=bool), latencies, seconds)
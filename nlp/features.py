@@ -1,9 +1,36 @@
 from copy import copy
+from zlib import crc32
 
-def ngrams(datum, size, start_token=None, stop_token=None):
+def feature_hash(feature, buckets):
 	"""
-	pull apart datum into component chunks
+	Returns the (bucket, sign) of a feature, a string or a sequence of
+	strings like an ngram, among buckets buckets. The hash is crc32, so it
+	is the same in every process and on every platform.
 	"""
+	if not isinstance(feature, basestring): feature = "\x1f".join(feature)
+	code = crc32(feature) & 0xffffffff
+	return (code >> 1) % buckets, (1.0 if code & 1 else -1.0)
+
+def hashed_features(features, buckets, signed=False):
+	"""
+	The hashing trick: yields (bucket, value) for each of features, value
+	1.0 or, if signed, the feature's sign so collisions cancel out in
+	expectation
+	"""
+	for feature in features:
+		bucket, sign = feature_hash(feature, buckets)
+		yield bucket, (sign if signed else 1.0)
+
+def ngrams(datum, size, start_token=None, stop_token=None, buckets=None, signed=False):
+	"""
+	pull apart datum into component chunks; with buckets, the chunks are
+	hashed into (bucket, value) pairs by hashed_features
+	"""
+	chunks = _ngrams(datum, size, start_token, stop_token)
+	if buckets: return hashed_features(chunks, buckets, signed)
+	return chunks
+
+def _ngrams(datum, size, start_token, stop_token):
 	if start_token:
 		histories = [[start_token for _ in xrange(sub_size)] for sub_size in xrange(1, size+1)]
 	else:
@@ -2,25 +2,56 @@
 
 __using_cython_viterbi__ = True
 
-from itertools import izip, islice, repeat
+from copy import copy
+import hashlib
+from itertools import izip, repeat
 from math import log, exp
-import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
 import random
 import sys
-from time import time
 
+import numpy
+from scipy import sparse
+
+from arrayfile import read_arrays, write_arrays
+from artifactcache import default_cache, make_key
 from countermap import CounterMap
 from counter import Counter
 import cyhmm
-from utilities import permutations, memoized
+from quantize import quantize_scores, dequantize_scores
+from statespace import StateSpace
+from utilities import LRUCache
 
 START_LABEL = "<START>"
 STOP_LABEL = "<STOP>"
 UNK_LABEL = "<UNK>"
 
+class CollapsedFallback(object):
+	"""
+	A fallback emissions model over collapsed labels, for models without
+	their own collapsed(): each label_of(label)'s probability is the sum of
+	model's probabilities of the labels mapped to it
+	"""
+
+	def __init__(self, model, label_of):
+		self.model = model
+		self.label_of = label_of
+
+	def label_distribution(self, emission):
+		probabilities = Counter()
+		for label, score in self.model.label_distribution(emission).iteritems():
+			probabilities[self.label_of(label)] += exp(score)
+
+		distribution = Counter()
+		distribution.default = float("-inf")
+		for label, probability in probabilities.iteritems():
+			distribution[label] = log(probability) if probability > 0.0 else float("-inf")
+		return distribution
+
 class HiddenMarkovModel:
-	def __init__(self, label_history_size=2):
+	def __init__(self, label_history_size=2, emission_cache_size=10000, cache=None, tag_dictionary_threshold=5,
+				 coarse_threshold=None):
 		# Distribution over next state given current state
 		self.labels = list()
 		self.label_history_size = label_history_size
@@ -28,14 +59,63 @@ class HiddenMarkovModel:
 		self.reverse_transition = CounterMap() # same as transitions but indexed in reverse (useful for decoding)
 
 		self.fallback_emissions_model = None
+		self.fallback_training_limit = None
+		# The first fallback_training_limit (state, emission) pairs in corpus
+		# order, which a limited fallback model is trained on
+		self.fallback_pairs = list()
 		self.fallback_transition = None
 		self.fallback_reverse_transition = None
+		# Whether train smoothed transitions; partial_fit does the same
+		self.use_linear_smoothing = True
+
+		# Integer encoding of the label histories used as states
+		self.state_space = StateSpace(label_history_size, START_LABEL, STOP_LABEL)
+
+		# Raw counts, kept so partial_fit can add to them
+		self.emission_counts = CounterMap()
+		self.transition_counts = [CounterMap() for _ in xrange(label_history_size)]
+		self.token_count = 0
+		# Running digest of everything trained on, so cached artifacts
+		# derived from the data can be keyed by it
+		self.data_digest = ""
+
+		# Where expensive artifacts (the fallback model) are cached; None for
+		# artifactcache.default_cache()
+		self.cache = cache
 
 		# Multinomial distribution over emissions given label
 		self.emission = CounterMap()
 		# p(label | emission)
 		self.label_emissions = CounterMap()
 
+		# Emission => labels it was seen with, for emissions seen at least
+		# tag_dictionary_threshold times (None for no dictionary); see
+		# candidate_states
+		self.tag_dictionary_threshold = tag_dictionary_threshold
+		self.tag_dictionary = dict()
+		self._candidate_states = dict()
+
+		# Coarse-to-fine decoding: with a coarse_threshold (and a history of
+		# two or more labels), training also derives a first order model,
+		# and label only decodes the labels whose first order posterior is
+		# at least coarse_threshold
+		self.coarse_threshold = coarse_threshold
+		self.coarse_model = None
+
+		# Fallback distributions for unseen emissions, bounded and dropped on retraining
+		self.emission_cache = LRUCache(emission_cache_size)
+		self.uniform_fallback = None
+
+		# Dense, int-indexed copies of the score tables (see score_tables),
+		# and the (transitions, emission scores) fixed point scales of
+		# compiled int16 tables
+		self._score_tables = None
+		self.score_scales = (1.0, 1.0)
+		# Cumulative distributions for sample_many (see sampling_tables)
+		self._sampling_tables = None
+		# Loaded with load_compiled: the score tables are all there is
+		self.compiled = False
+
 	def _pad_sequence(self, sequence, pairs=False):
 		if pairs: yield (START_LABEL, START_LABEL)
 		else: yield START_LABEL
@@ -79,65 +159,191 @@ class HiddenMarkovModel:
 	def stop_label(self):
 		return '::'.join(repeat(STOP_LABEL, self.label_history_size))
 
-	def push_label(self, history, label):
+	@staticmethod
+	def _push_label(history, label):
 		return '::'.join(history.split('::')[1:] + [label,])
 
-	@classmethod
-	def _linear_smooth(cls, labels, fallback_transition, label_history_size):
-		transition = CounterMap()
-		linear_smoothing_weights = [1.0 - 0.1 * (label_history_size-1)]
-		linear_smoothing_weights.extend(0.1 for _ in xrange(label_history_size-1))
-
-		# This is super inefficient - it should be caching smoothings involving the less-specific counters
-		# e.g. smoothed['NN']['CD'] = cnter['NN']['CD'] * \lambda * smoothed['NN'] and so on
-		all_label_histories = set(permutations(labels, label_history_size-1))
-		for label_history in all_label_histories:
-			histories = [history for history in (label_history[i:] for i in xrange(label_history_size))]
-			# >>> label_history = ('WDT', 'RBR')
-			# histories = [('WDT', 'RBR'), ('RBR')]
+	def push_label(self, history, label):
+		return HiddenMarkovModel._push_label(history, label)
 
-			history_strings = ['::'.join(history) for history in histories]
-			history_scores = [fallback_transition[len(history)][history_string] for history, history_string in izip(histories, history_strings)]
+	@classmethod
+	def _linear_smooth(cls, fallback_transition, label_history_size):
+		"""
+		Interpolates each observed history's next-label distribution with the
+		distributions conditioned on its shorter suffixes, e.g.
+		p(B::C | A::B) = 0.9 p(C | A::B) + 0.1 p(C | B)
+
+		Each order's rows are packed into a sparse (histories x next label)
+		matrix once, so smoothing is one gather-and-add per order rather than
+		a Counter rebuild per history. Only histories that occur in training
+		get rows, and only transitions into observed states are kept.
+		"""
+		weights = [1.0 - 0.1 * (label_history_size-1)]
+		weights.extend(0.1 for _ in xrange(label_history_size-1))
+
+		histories = list(fallback_transition[-1].iterkeys())
+		states = set(state for row in fallback_transition[-1].itervalues() for state in row.iterkeys())
+		next_labels = list(set(state.split('::')[-1] for state in states))
+		next_idx = dict((label, idx) for idx, label in enumerate(next_labels))
+
+		smoothed = sparse.csr_matrix((len(histories), len(next_labels)))
+		for history_size, weight in izip(xrange(label_history_size-1, -1, -1), weights):
+			order = fallback_transition[history_size]
+			order_histories = list(order.iterkeys())
+			order_idx = dict((history, idx) for idx, history in enumerate(order_histories))
+
+			values, rows, cols = [], [], []
+			for row, history in enumerate(order_histories):
+				for state, prob in order[history].iteritems():
+					values.append(prob)
+					rows.append(row)
+					cols.append(next_idx[state.split('::')[-1]])
+			# Duplicate (row, col) entries are summed, marginalizing out the
+			# part of the next state this order doesn't condition on
+			distributions = sparse.csr_matrix((values, (rows, cols)),
+											  shape=(len(order_histories), len(next_labels)))
+
+			# Select each full history's suffix row at this order
+			suffixes = [order_idx.get('::'.join(history.split('::')[-(history_size+1):]))
+						for history in histories]
+			selected = [(row, idx) for row, idx in enumerate(suffixes) if idx is not None]
+			selection = sparse.csr_matrix(([weight] * len(selected),
+										   ([row for row, _ in selected], [idx for _, idx in selected])),
+										  shape=(len(histories), len(order_histories)))
+
+			smoothed = smoothed + selection * distributions
 
-			transition[history_strings[0]] = Counter()
-			for smoothing, history_score in izip(linear_smoothing_weights, history_scores):
-				transition[history_strings[0]] += history_score * smoothing
+		transition = CounterMap()
+		for row, history in enumerate(histories):
+			counter = transition[history]
+			for pos in xrange(smoothed.indptr[row], smoothed.indptr[row+1]):
+				state = cls._push_label(history, next_labels[smoothed.indices[pos]])
+				if state in states:
+					counter[state] = smoothed.data[pos]
 
 		transition.normalize()
 
 		return transition
 
 	def train(self, labeled_sequence, fallback_model=None, fallback_training_limit=None, use_linear_smoothing=True):
-		label_counts = [Counter() for _ in xrange(self.label_history_size)]
-		self.fallback_transition = [CounterMap() for _ in xrange(self.label_history_size)]
-		self.fallback_reverse_transition = [CounterMap() for _ in xrange(self.label_history_size)]
+		"""
+		Trains on labeled_sequence, an iterable of (label, emission) pairs
+		consumed in a single pass. Only counts are kept, so memory is bounded
+		by the model rather than the corpus.
+		"""
+		self.state_space = StateSpace(self.label_history_size, START_LABEL, STOP_LABEL)
+		self.emission_counts = CounterMap()
+		self.transition_counts = [CounterMap() for _ in xrange(self.label_history_size)]
+		self.token_count = 0
+		self.data_digest = ""
+		self.fallback_training_limit = fallback_training_limit if fallback_model else None
+		self.fallback_pairs = list()
+		self.use_linear_smoothing = use_linear_smoothing
+
+		self._accumulate(labeled_sequence)
+		self._estimate(use_linear_smoothing=use_linear_smoothing)
+
+		# Train the fallback model on the label-emission pairs
+		if fallback_model:
+			self._train_fallback(fallback_model)
+
+		self._train_coarse()
+		self._post_training()
+
+	def partial_fit(self, labeled_sequence, use_linear_smoothing=None, retrain_fallback=False):
+		"""
+		Adds the counts from labeled_sequence to an already trained model and
+		re-derives its distributions, without revisiting earlier data.
+		Transitions are smoothed as in train unless use_linear_smoothing is
+		given, which then holds for later calls too.
+
+		The fallback emissions model is kept as it was, so it knows nothing of
+		labels first seen here. With retrain_fallback it's retrained from
+		scratch on all the data so far, which costs as much as training it in
+		train and misses the artifact cache as the data changed (with a
+		fallback_training_limit, it's the same model once the limit is met)
+		"""
+		if use_linear_smoothing is not None: self.use_linear_smoothing = use_linear_smoothing
+
+		self._accumulate(labeled_sequence)
+		self._estimate(use_linear_smoothing=self.use_linear_smoothing)
 
-		labeled_sequence = self._pad_sequence(labeled_sequence, pairs=True)
-		labeled_sequence = list(HiddenMarkovModel._extend_labels(labeled_sequence, self.label_history_size+1))
+		if retrain_fallback and self.fallback_emissions_model:
+			self._train_fallback(self.fallback_emissions_model.__class__)
+
+		self._train_coarse()
+		self._post_training()
+
+	def _accumulate(self, labeled_sequence):
+		space = self.state_space
+		names = space.names
+		state = space.start
+		digest = hashlib.sha1(self.data_digest)
+		limit = self.fallback_training_limit
+		fallback_pairs = self.fallback_pairs
 
 		# Load emission and transition counters from the raw data
-		for label, label_histories, emission in labeled_sequence:
-			full_label = self.push_label(label_histories[-1], label)
+		for label, emission in self._pad_boundaries(self._pad_sequence(labeled_sequence, pairs=True)):
+			if label == START_LABEL:
+				history = full_state = space.start
+			else:
+				history, full_state = state, space.push(state, space.label(label))
+
+			full_label = names[full_state]
+			self.emission_counts[full_label][emission] += 1.0
+
+			for history_size, label_history in enumerate(space.suffix_names(history)):
+				self.transition_counts[history_size][label_history][full_label] += 1.0
+
+			if limit and len(fallback_pairs) < limit and label not in (START_LABEL, STOP_LABEL):
+				fallback_pairs.append((full_label, emission))
+
+			state = full_state
+			self.token_count += 1
+			digest.update("%s\0%s\0" % (label, emission))
+
+		self.data_digest = digest.hexdigest()
+
+	def _pad_boundaries(self, labeled_sequence):
+		"""
+		Sentences in a stream are separated by a single <STOP> <START>, but
+		the end of a sentence is decoded with label_history_size stops; pads
+		the boundaries to match, so the stop state can be reached from the
+		end of every sentence rather than just the last
+		"""
+		stops = 0
+
+		for label, emission in labeled_sequence:
+			if label == START_LABEL and stops:
+				for _ in xrange(self.label_history_size - stops):
+					yield (STOP_LABEL, STOP_LABEL)
+
+			yield (label, emission)
+			stops = stops + 1 if label == STOP_LABEL else 0
 
-			self.emission[full_label][emission] += 1.0
-			self.label_emissions[emission][full_label] += 1.0
+	@classmethod
+	def _normalized(cls, counts):
+		distribution = CounterMap()
+		for key, counter in counts.iteritems():
+			distribution[key] = copy(counter)
+		distribution.normalize()
 
-			for history_size, label_history in enumerate(label_histories):
-				label_counts[history_size][label_history] += 1.0
-				self.fallback_transition[history_size][label_history][full_label] += 1.0
+		return distribution
 
+	def _estimate(self, use_linear_smoothing=True):
 		# Make the counters distributions
-		for transition in self.fallback_transition:	transition.normalize()
-		self.label_emissions.normalize()
-		self.emission.normalize()
+		self.fallback_transition = [HiddenMarkovModel._normalized(counts) for counts in self.transition_counts]
+		self.fallback_reverse_transition = [CounterMap() for _ in xrange(self.label_history_size)]
+		self.emission = HiddenMarkovModel._normalized(self.emission_counts)
+		self.label_emissions = HiddenMarkovModel._normalized(self.emission_counts.inverted())
 		self.labels = self.emission.keys()
+		self.tag_dictionary = self._build_tag_dictionary()
 
 		# Smooth transitions using fallback data
 		# Doesn't work with label history size 1!
 		if use_linear_smoothing and self.label_history_size > 1:
 			self.transition = \
-				HiddenMarkovModel._linear_smooth(self.labels,
-												 self.fallback_transition,
+				HiddenMarkovModel._linear_smooth(self.fallback_transition,
 												 self.label_history_size)
 		else:
 			self.transition = self.fallback_transition[-1]
@@ -148,56 +354,305 @@ class HiddenMarkovModel:
 		self.emission.log()
 
 		self.reverse_transition = self.transition.inverted()
+		# Unseen states can't be reached
+		self.reverse_transition.default = float("-inf")
 
-		# Train the fallback model on the label-emission pairs
-		if fallback_model:
-			try:
-				start = time()
-				pickle_file = open("fallback_model.pickle")
-				self.fallback_emissions_model, training_pairs_length = pickle.load(pickle_file)
-				pickle_file.close()
+	def _build_tag_dictionary(self):
+		if self.tag_dictionary_threshold is None: return dict()
 
-				if fallback_training_limit and fallback_training_limit != training_pairs_length:
-					raise IOError()
-				elif not fallback_training_limit and len(labeled_sequence) != training_pairs_length:
-					raise IOError()
+		tags = dict()
+		counts = dict()
+		for full_label, emissions in self.emission_counts.iteritems():
+			label = self.state_space.last_label_of(full_label)
+			for emission, count in emissions.iteritems():
+				tags.setdefault(emission, set()).add(label)
+				counts[emission] = counts.get(emission, 0.0) + count
 
-				print "Unpickling fallback model: %f" % (time() - start)
-			except (IOError, EOFError), e:
-				print "Training fallback model"
-				self.fallback_emissions_model = fallback_model()
+		return dict((emission, frozenset(labels)) for emission, labels in tags.iteritems()
+					if counts[emission] >= self.tag_dictionary_threshold)
 
-				emissions_training_pairs = [(emission_history[-1] + '::' + label, emission) for label, emission_history, emission in labeled_sequence if label != START_LABEL and label != STOP_LABEL]
+	def candidate_states(self, emission):
+		"""
+		Returns the states emission can be labelled with according to the tag
+		dictionary, or None if it may take any (unknown and rare emissions)
+		"""
+		tags = self.tag_dictionary.get(emission)
+		if tags is None: return None
 
-				if fallback_training_limit:
-					emissions_training_pairs = islice(emissions_training_pairs, fallback_training_limit)
+		states = self._candidate_states.get(tags)
+		if states is None:
+			states = self._candidate_states[tags] = [label for label in self.labels
+													 if self.state_space.last_label_of(label) in tags]
+		return states
 
-				self.fallback_emissions_model.train(emissions_training_pairs)
+	def _fallback_training_pairs(self):
+		"""
+		Regenerates the (state, emission) training pairs from the emission
+		counts, skipping the start / stop padding; grouped by state, so only
+		for unlimited fallback training (see fallback_pairs)
+		"""
+		for full_label, emissions in self.emission_counts.iteritems():
+			if full_label.split('::')[-1] in (START_LABEL, STOP_LABEL): continue
+
+			for emission, count in emissions.iteritems():
+				for _ in xrange(int(count)):
+					yield (full_label, emission)
+
+	def _train_fallback(self, fallback_model):
+		limit = self.fallback_training_limit
+
+		def train_fallback():
+			model = fallback_model()
+			model.train(iter(self.fallback_pairs) if limit else self._fallback_training_pairs())
+			return model
+
+		# The fallback model is determined by the pairs it's trained on and its
+		# class (and the state encoding, through label_history_size)
+		if limit:
+			digest = hashlib.sha1()
+			for full_label, emission in self.fallback_pairs:
+				digest.update("%s\0%s\0" % (full_label, emission))
+			data_digest = digest.hexdigest()
+		else:
+			data_digest = self.data_digest
 
-				serialized = (self.fallback_emissions_model, len(labeled_sequence))
-				pickle_file = open("fallback_model.pickle", "w")
-				pickle.dump(serialized, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
-				pickle_file.close()
+		key = make_key("fallback_emissions_model", fallback_model, limit,
+					   self.label_history_size, data_digest)
+		cache = self.cache if self.cache is not None else default_cache()
 
-		self._post_training()
+		self.fallback_emissions_model = cache.lookup(key, train_fallback, "fallback model")
+
+	def _train_coarse(self):
+		"""
+		Derives the first order model coarse-to-fine decoding prunes with from
+		this model's counts, so the data isn't read twice
+		"""
+		if self.coarse_threshold is None or self.label_history_size < 2:
+			self.coarse_model = None
+			return
+
+		coarse = HiddenMarkovModel(label_history_size=1, emission_cache_size=self.emission_cache.max_size,
+								   cache=self.cache, tag_dictionary_threshold=self.tag_dictionary_threshold)
+		last_label_of = self.state_space.last_label_of
+
+		for full_label, emissions in self.emission_counts.iteritems():
+			counts = coarse.emission_counts[last_label_of(full_label)]
+			for emission, count in emissions.iteritems():
+				counts[emission] += count
+
+		# First order counts are conditioned on the last label already
+		for history, row in self.transition_counts[0].iteritems():
+			counts = coarse.transition_counts[0][history]
+			for full_label, count in row.iteritems():
+				counts[last_label_of(full_label)] += count
+
+		coarse.token_count = self.token_count
+		for label in coarse.emission_counts.iterkeys():
+			coarse.state_space.state_of(label)
+
+		coarse.fallback_emissions_model = self._coarse_fallback()
+		coarse._estimate(use_linear_smoothing=False)
+		coarse._post_training()
+		self.coarse_model = coarse
+
+	def _coarse_fallback(self):
+		# Unknown words are where pruning matters most, so the coarse model
+		# falls back on the fine fallback summed over histories
+		fallback = self.fallback_emissions_model
+		last_label_of = self.state_space.last_label_of
+		if hasattr(fallback, "collapsed"):
+			return fallback.collapsed(last_label_of)
+		elif fallback is not None:
+			return CollapsedFallback(fallback, last_label_of)
+		return None
+
+	def coarse_tag_mask(self, emission_sequence):
+		"""
+		Returns the (padded positions x state_space labels) mask of labels the
+		first order model gives a posterior of at least coarse_threshold, or
+		None (no pruning) without a coarse model or a path through it
+		"""
+		if self.coarse_model is None: return None
+
+		coarse = self.coarse_model
+		posteriors = coarse.cyhmm.state_posteriors(coarse, emission_sequence)
+		if posteriors is None: return None
+
+		space = self.state_space
+		columns = [(space.label_idx[label], idx) for idx, label in enumerate(coarse.cyhmm.idx_label)
+				   if label in space.label_idx]
+
+		tag_mask = numpy.ones((posteriors.shape[0], len(space.labels)), dtype=bool)
+		tag_mask[:, [column for column, _ in columns]] = \
+			posteriors[:, [idx for _, idx in columns]] >= self.coarse_threshold
+
+		return tag_mask
 
 	def _post_training(self):
+		# Cached fallbacks and score tables were computed against the old tables
+		self.emission_cache.clear()
+		self.uniform_fallback = None
+		self._candidate_states = dict()
+		self._score_tables = None
+		self._sampling_tables = None
+
+		# Make sure every state is encoded (labels may have been set by hand)
+		for label in self.labels:
+			self.state_space.state_of(label)
+		self.state_space.freeze()
+
 		# Build the cython backing model
 		if __using_cython_viterbi__:
-			self.cyhmm = cyhmm.CyHMM(self.labels, self.reverse_transition)
+			self.cyhmm = cyhmm.CyHMM(self.labels, self.state_space, self.score_tables()[0],
+									 fallback_cache_size=self.emission_cache.max_size)
+
+	def compile(self, path, precision='float64', check_sequences=None):
+		"""
+		Writes the trained model's score tables, state space and fallback
+		model (and those of its coarse model, with its threshold) to path as
+		a single file load_compiled can memory-map.
+
+		precision is how the transition and emission scores are stored:
+		'float64', 'float32' or 'int16' (fixed point, see quantize.py); the
+		loaded model decodes at that precision. Returns a report of what it
+		costs: table sizes, the largest score error and, given labelled
+		check_sequences, the compiled model's accuracy next to this one's and
+		how often they agree.
+		"""
+		arrays, metadata = self._compiled_tables(precision)
+		if self.coarse_model is not None:
+			coarse_arrays, metadata['coarse'] = self.coarse_model._compiled_tables(precision)
+			arrays.update(('coarse_' + name, array) for name, array in coarse_arrays.iteritems())
+			# load_compiled rebuilds it from the fine fallback model
+			metadata['coarse']['fallback_emissions_model'] = None
+			metadata['coarse_threshold'] = self.coarse_threshold
+
+		write_arrays(path, arrays, metadata)
+
+		transitions, _, _, emission_scores = self.score_tables()
+		stored_transitions, stored_emissions = arrays['transitions'], arrays['emission_scores']
+		transition_scale, emission_scale = metadata['score_scales']
+
+		def largest_error(scores, stored, scale):
+			finite = numpy.isfinite(scores)
+			if not finite.any(): return 0.0
+			return float(numpy.abs(dequantize_scores(stored[finite], scale) - scores[finite]).max())
+
+		report = {
+			'precision' : precision,
+			'table_bytes' : (transitions.nbytes + emission_scores.nbytes,
+							 stored_transitions.nbytes + stored_emissions.nbytes),
+			'max_transition_error' : largest_error(transitions, stored_transitions, transition_scale),
+			'max_emission_error' : largest_error(emission_scores, stored_emissions, emission_scale),
+		}
+
+		if check_sequences is not None:
+			check_sequences = [list(sequence) for sequence in check_sequences]
+			emission_sequences = [[emission for _, emission in sequence] for sequence in check_sequences]
+			gold = [label for sequence in check_sequences for label, _ in sequence]
+
+			compiled = self.load_compiled(path, emission_cache_size=self.emission_cache.max_size)
+			labels = [label for labelling in self.label_many(emission_sequences) for label in labelling]
+			compiled_labels = [label for labelling in compiled.label_many(emission_sequences) for label in labelling]
+
+			def fraction(matches):
+				return float(sum(matches)) / max(len(gold), 1)
+
+			report['tokens'] = len(gold)
+			report['accuracy'] = fraction(label == gold_label for label, gold_label in izip(labels, gold))
+			report['compiled_accuracy'] = fraction(label == gold_label for label, gold_label in izip(compiled_labels, gold))
+			report['agreement'] = fraction(label == compiled_label for label, compiled_label in izip(labels, compiled_labels))
+
+		return report
+
+	def _compiled_tables(self, precision):
+		# The (arrays, metadata) compile writes for this model alone
+		transitions, emission_vocabulary, emission_keys, emission_scores = self.score_tables()
+		stored_transitions, transition_scale = quantize_scores(transitions, precision)
+		stored_emissions, emission_scale = quantize_scores(emission_scores, precision)
+		space = self.state_space
+
+		vocabulary = [None] * len(emission_vocabulary)
+		for emission, emission_id in emission_vocabulary.iteritems():
+			vocabulary[emission_id] = emission
+
+		arrays = {
+			'histories' : numpy.array(space.histories, dtype=numpy.int32).reshape(len(space), self.label_history_size),
+			'push_table' : space.push_table,
+			'last_label_table' : space.last_label_table,
+			'decoded_states' : numpy.array([space.state_of(label) for label in self.labels], dtype=numpy.int32),
+			'transitions' : stored_transitions,
+			'emission_keys' : emission_keys,
+			'emission_scores' : stored_emissions,
+		}
+		metadata = {
+			'label_history_size' : self.label_history_size,
+			'labels' : space.labels,
+			'emission_vocabulary' : vocabulary,
+			'fallback_emissions_model' : self.fallback_emissions_model,
+			'tag_dictionary' : self.tag_dictionary,
+			'score_scales' : (transition_scale, emission_scale),
+		}
+
+		return arrays, metadata
+
+	@classmethod
+	def load_compiled(cls, path, emission_cache_size=10000):
+		"""
+		Loads a model written by compile. The tables are mapped read-only
+		rather than read, so loading is fast and processes labelling with the
+		same file share its pages. The model can label and score but not be
+		retrained.
+		"""
+		arrays, metadata = read_arrays(path)
+		model = cls._from_compiled(arrays, metadata, emission_cache_size)
+
+		if metadata.get('coarse') is not None:
+			coarse_arrays = dict((name[len('coarse_'):], array) for name, array in arrays.iteritems()
+								 if name.startswith('coarse_'))
+			model.coarse_model = cls._from_compiled(coarse_arrays, metadata['coarse'], emission_cache_size,
+													fallback_emissions_model=model._coarse_fallback())
+			model.coarse_threshold = metadata['coarse_threshold']
+
+		return model
+
+	@classmethod
+	def _from_compiled(cls, arrays, metadata, emission_cache_size, fallback_emissions_model=None):
+		model = cls(label_history_size=metadata['label_history_size'], emission_cache_size=emission_cache_size)
+		model.state_space = StateSpace.from_arrays(metadata['label_history_size'], START_LABEL, STOP_LABEL,
+												   metadata['labels'], arrays['histories'],
+												   arrays['push_table'], arrays['last_label_table'])
+		model.labels = [model.state_space.names[state] for state in arrays['decoded_states'].tolist()]
+		model.fallback_emissions_model = metadata['fallback_emissions_model']
+		if model.fallback_emissions_model is None: model.fallback_emissions_model = fallback_emissions_model
+		model.tag_dictionary = metadata.get('tag_dictionary', dict())
+		model.score_scales = metadata.get('score_scales', (1.0, 1.0))
+
+		emission_vocabulary = dict((emission, emission_id)
+								   for emission_id, emission in enumerate(metadata['emission_vocabulary']))
+		model._score_tables = (arrays['transitions'], emission_vocabulary,
+							   arrays['emission_keys'], arrays['emission_scores'])
+		model.compiled = True
+
+		if __using_cython_viterbi__:
+			model.cyhmm = cyhmm.CyHMM(model.labels, model.state_space, arrays['transitions'],
+									  fallback_cache_size=emission_cache_size, transition_scale=model.score_scales[0])
+
+		return model
 
 	def emission_fallback_probs(self, emission):
 		if self.fallback_emissions_model:
 			return self.fallback_emissions_model.label_distribution(emission)
 
-		fallback = Counter()
-		uniform = log(1.0 / len(self.labels))
-		for label in self.labels: fallback[label] = uniform
+		# The uniform fallback is the same for every emission
+		if self.uniform_fallback is None:
+			self.uniform_fallback = Counter()
+			uniform = log(1.0 / len(self.labels))
+			for label in self.labels: self.uniform_fallback[label] = uniform
 
-		return fallback
+		return self.uniform_fallback
 
 
-	@memoized
 	def emission_scores(self, emission):
 		"""
 		Returns a counter of P(state | emission)
@@ -210,8 +665,25 @@ class HiddenMarkovModel:
 
 		if self.label_emissions.get(emission):
 			return self.label_emissions[emission]
+		elif self.compiled and emission in self._score_tables[1]:
+			return self.emission_cache.lookup(emission, self._table_emission_scores)
 		else:
-			return self.emission_fallback_probs(emission)
+			return self.emission_cache.lookup(emission, self.emission_fallback_probs)
+
+	def _table_emission_scores(self, emission):
+		transitions, emission_vocabulary, emission_keys, emission_scores = self._score_tables
+		state_count = transitions.shape[0]
+		emission_id = emission_vocabulary[emission]
+
+		scores = Counter()
+		scores.default = float("-inf")
+
+		low, high = emission_keys.searchsorted((emission_id * state_count, (emission_id + 1) * state_count))
+		row = dequantize_scores(emission_scores[low:high], self.score_scales[1])
+		for key, score in izip(emission_keys[low:high].tolist(), row.tolist()):
+			scores[self.state_space.names[key - emission_id * state_count]] = score
+
+		return scores
 
 	def transition_scores(self, label):
 		"""
@@ -221,44 +693,182 @@ class HiddenMarkovModel:
 		return self.reverse_transition[label]
 
 	def score(self, labeled_sequence, debug=False):
+		# Compiled models only have the int-indexed tables
+		if self.compiled: return self.score_many([labeled_sequence])[0]
+
+		space = self.state_space
+		names = space.names
 		score = 0.0
 		last_score = 0.0
-		last_labels = self.start_label
+		state = space.start
 
 		if debug: print "*** SCORE (%s) ***" % labeled_sequence
 
 		# Start with the probability of emitting the start emission
-		score += self.emission_scores(START_LABEL)[START_LABEL]
+		score += self.emission_scores(START_LABEL)[names[state]]
+
+		# Walk the labels, then the stop padding the decoder adds
+		labeled_sequence = list(labeled_sequence)
+		padding = [(STOP_LABEL, STOP_LABEL)] * self.label_history_size
+
+		for pos, (label, emission) in enumerate(labeled_sequence + padding):
+			next_state = space.push(state, space.label(label))
 
-		for pos, (label, emission) in enumerate(labeled_sequence):
 			# Transition
-			score += self.transition_scores(label)[last_labels]
-			if debug: print " ++ TRANSITION (%s => %s): %f" % (last_labels, label, score - last_score)
+			score += self.transition_scores(names[next_state])[names[state]]
+			if debug: print " ++ TRANSITION (%s => %s): %f" % (names[state], names[next_state], score - last_score)
 			t_score = score
 
 			# Emission
-			score += self.emission_scores(emission)[label]
+			score += self.emission_scores(emission)[names[next_state]]
 			if debug: print " ++ EMISSION: %f" % (score - t_score)
 
 			if debug: print "  @ %d ::  score after label %s emits %s: %f (change %f)" % (pos, label, emission, score, score - last_score)
 
 			# Bookkeeping
-			last_labels = self.push_label(last_labels, label)
+			state = next_state
 			last_score = score
 
-		# Add in the probability of transitioning to the stop state
-		score += self.transition_scores(STOP_LABEL)[last_labels]
-
-		# And the normalizing probability of emitting the stop emission
-		score += self.emission_scores(STOP_LABEL)[STOP_LABEL]
-
 		if debug: print "*** SCORE => %f ***" % score
 		
 		return score
 
-	def label(self, emission_sequence, debug=False, return_score=False):
+	def score_tables(self):
+		"""
+		Returns (transitions, emission_vocabulary, emission_keys, emission_scores),
+		int-indexed copies of the score tables:
+
+		transitions[state, label] is the score of moving from state to
+		state_space.push(state, label) (-inf if it can't be reached)
+
+		emission_scores[i] is the score of emission e in state s, where
+		emission_keys[i] == emission_vocabulary[e] * len(state_space) + s and
+		emission_keys is sorted
+
+		A compiled model's score tables are as compile stored them (see
+		score_scales and quantize.dequantize_scores)
+		"""
+		space = self.state_space
+
+		if self._score_tables and (self.compiled or self._score_tables[0].shape == (len(space), len(space.labels))):
+			return self._score_tables
+
+		# Encode every state the tables mention before sizing anything
+		transition_entries = [(space.state_of(prev), space.state_of(next_label), score)
+							  for next_label, row in self.reverse_transition.iteritems()
+							  for prev, score in row.iteritems()]
+		emission_vocabulary = dict()
+		emission_entries = [(emission_vocabulary.setdefault(emission, len(emission_vocabulary)),
+							 space.state_of(state), score)
+							for emission, row in self.label_emissions.iteritems()
+							for state, score in row.iteritems()]
+		space.freeze()
+
+		transitions = numpy.empty((len(space), len(space.labels)))
+		transitions.fill(float("-inf"))
+		for prev, next_state, score in transition_entries:
+			label = space.last_label[next_state]
+			if space.push_table[prev, label] == next_state:
+				transitions[prev, label] = score
+
+		emission_keys = numpy.array([emission * len(space) + state for emission, state, _ in emission_entries],
+									dtype=numpy.int64)
+		emission_scores = numpy.array([score for _, _, score in emission_entries], dtype=numpy.float64)
+		order = numpy.argsort(emission_keys)
+
+		self._score_tables = (transitions, emission_vocabulary, emission_keys[order], emission_scores[order])
+
+		return self._score_tables
+
+	def score_many(self, labeled_sequences):
+		"""
+		Scores a batch of labelled sequences (as score does), stepping all of
+		them through the int-indexed score tables together. Returns a numpy
+		array of scores.
+		"""
+		transitions, emission_vocabulary, emission_keys, emission_scores = self.score_tables()
+		space = self.state_space
+		state_count = transitions.shape[0]
+		ninf = float("-inf")
+
+		padding = [(STOP_LABEL, STOP_LABEL)] * self.label_history_size
+		sequences = [list(sequence) + padding for sequence in labeled_sequences]
+		if not sequences: return numpy.zeros(0)
+
+		length = max(len(sequence) for sequence in sequences)
+		labels = numpy.zeros((len(sequences), length), dtype=numpy.int32)
+		emissions = numpy.zeros((len(sequences), length), dtype=numpy.int64)
+		active = numpy.zeros((len(sequences), length), dtype=bool)
+
+		# Emissions outside the vocabulary get rows from emission_scores,
+		# indexed by -(row + 1)
+		unknown = dict()
+		for row, sequence in enumerate(sequences):
+			active[row, :len(sequence)] = True
+			for pos, (label, emission) in enumerate(sequence):
+				label_id = space.label_idx.get(label, -1)
+				labels[row, pos] = label_id if label_id < transitions.shape[1] else -1
+				if emission in emission_vocabulary:
+					emissions[row, pos] = emission_vocabulary[emission]
+				else:
+					emissions[row, pos] = -1 - unknown.setdefault(emission, len(unknown))
+
+		unknown_scores = numpy.empty((max(len(unknown), 1), state_count))
+		unknown_scores.fill(ninf)
+		for emission, row in unknown.iteritems():
+			fallback = self.emission_scores(emission)
+			for state, name in enumerate(space.names[:state_count]):
+				unknown_scores[row, state] = fallback[name]
+
+		states = numpy.empty(len(sequences), dtype=numpy.int64)
+		states.fill(space.start)
+		scores = numpy.empty(len(sequences))
+		scores.fill(self.emission_scores(START_LABEL)[space.names[space.start]])
+
+		for pos in xrange(length):
+			step_labels = labels[:, pos]
+			valid = active[:, pos] & (step_labels >= 0) & (states >= 0)
+			safe_states, safe_labels = numpy.maximum(states, 0), numpy.maximum(step_labels, 0)
+
+			next_states = numpy.where(valid, space.push_table[safe_states, safe_labels], -1)
+			step_scores = dequantize_scores(transitions[safe_states, safe_labels], self.score_scales[0])
+			step_scores = numpy.where(next_states >= 0, step_scores, ninf)
+			safe_next = numpy.maximum(next_states, 0)
+
+			# Known emissions: binary search for (emission, state) in emission_keys
+			step_emissions = emissions[:, pos]
+			keys = step_emissions * state_count + safe_next
+			found = numpy.minimum(numpy.searchsorted(emission_keys, keys), len(emission_keys) - 1)
+			known = (step_emissions >= 0) & (emission_keys[found] == keys)
+			emission_step = numpy.where(known, dequantize_scores(emission_scores[found], self.score_scales[1]), ninf)
+
+			unknown_rows = numpy.maximum(-1 - step_emissions, 0)
+			emission_step = numpy.where(step_emissions < 0, unknown_scores[unknown_rows, safe_next], emission_step)
+
+			step_scores = numpy.where(next_states >= 0, step_scores + emission_step, ninf)
+
+			inactive = ~active[:, pos]
+			scores = numpy.where(inactive, scores, scores + step_scores)
+			states = numpy.where(inactive, states, next_states)
+
+		return scores
+
+	def label(self, emission_sequence, debug=False, return_score=False, beam_size=None):
+		"""
+		Returns the best label sequence for emission_sequence. With beam_size,
+		decoding only extends the beam_size best states at each position
+		(cython decoder only).
+		"""
 		if __using_cython_viterbi__:
-			labelling = self.cyhmm.label(self, emission_sequence, debug=debug)
+			tag_mask = self.coarse_tag_mask(emission_sequence)
+			if tag_mask is None:
+				labelling = self.cyhmm.label(self, emission_sequence, debug=debug, beam_size=beam_size)
+			else:
+				labelling, lattice_score = self.cyhmm.label(self, emission_sequence, debug=debug, return_score=True,
+															beam_size=beam_size, tag_mask=tag_mask)
+				# Pruning can cut every path; decode everything then
+				if lattice_score == float("-inf"):
+					labelling = self.cyhmm.label(self, emission_sequence, debug=debug, beam_size=beam_size)
 
 			if return_score:
 				score = self.score(zip(labelling, emission_sequence))
@@ -268,6 +878,48 @@ class HiddenMarkovModel:
 		else:
 			return self._label(emission_sequence, debug=debug, return_score=return_score)
 
+	def label_within(self, emission_sequence, max_seconds=None, max_operations=None):
+		"""
+		Labels emission_sequence within a latency budget, degrading from exact
+		decoding to a beam narrow enough to fit, down to greedy decoding.
+		Returns (labelling, mode, beam_size), mode being 'exact', 'beam' or
+		'greedy' (see CyHMM.label_within). Without the cython decoder, always
+		decodes exactly.
+		"""
+		if not __using_cython_viterbi__:
+			return self._label(emission_sequence), 'exact', None
+
+		labelling, _, mode, beam_size = self.cyhmm.label_within(self, emission_sequence, max_operations=max_operations,
+																 max_seconds=max_seconds)
+		return labelling, mode, beam_size
+
+	def label_many(self, emission_sequences, threads=None, beam_size=None):
+		"""
+		Labels a batch of emission sequences, using a pool of decoding threads
+		when the cython decoder is available
+		"""
+		if __using_cython_viterbi__ and self.coarse_model is not None:
+			pool = ThreadPool(threads)
+			try:
+				return pool.map(lambda emission_sequence: self.label(emission_sequence, beam_size=beam_size),
+								emission_sequences)
+			finally:
+				pool.close()
+		elif __using_cython_viterbi__:
+			return self.cyhmm.label_many(self, emission_sequences, threads=threads, beam_size=beam_size)
+		else:
+			return [self._label(emission_sequence) for emission_sequence in emission_sequences]
+
+	def streaming_labeller(self, lag=8):
+		"""
+		Returns a labeller that takes emissions one at a time (push) and
+		hands back tags as soon as they're settled: once every surviving
+		path agrees on them, or lag emissions later at the latest. finish()
+		ends the sequence. With lag at least the sequence length, the tags
+		are those label gives.
+		"""
+		return cyhmm.StreamingLabeller(self.cyhmm, self, lag)
+
 	def _label(self, emission_sequence, debug=False, return_score=False):
 		# This needs to perform viterbi decoding on the the emission sequence
 		emission_length = len(emission_sequence)
@@ -290,7 +942,10 @@ class HiddenMarkovModel:
 				# Transition probs (prob of arriving in this state)
 				prev_scores = scores[pos-1]
 
-				for label in self.labels:
+				candidates = self.candidate_states(emission)
+				if candidates is None: candidates = self.labels
+
+				for label in candidates:
 					transition_scores = prev_scores + self.transition_scores(label)
 
 					last = transition_scores.arg_max()
@@ -323,9 +978,9 @@ class HiddenMarkovModel:
 				current = backtrack[pos][current]
 
 			if not current:
-				current = UNK_LABEL
-
-			states.append(current.split('::')[-1])
+				states.append(UNK_LABEL)
+			else:
+				states.append(self.state_space.last_label_of(current))
 
 		# Pop all the extra start & stop states
 		states.reverse()
@@ -340,8 +995,6 @@ class HiddenMarkovModel:
 
 	def __sample_transition(self, label):
 		sample = random.random()
-		print "Label: \"" + label + "\""
-		print "Transition: \"" + str(self.transition) + "\""
 
 		for next, prob in self.transition[label].iteritems():
 			sample -= exp(prob)
@@ -368,6 +1021,111 @@ class HiddenMarkovModel:
 			yield (state, self.__sample_emission(state))
 			state = self.__sample_transition(state)
 
+	def sampling_tables(self):
+		"""
+		Returns (transition_cdf, emission_cdf, emission_ids, vocabulary), the
+		cumulative distributions sample_many draws from. Row s of
+		transition_cdf is offset by s (so the whole table is sorted and one
+		searchsorted draws next labels for many states), and likewise
+		emission_cdf holds each state's emission distribution offset by the
+		state, with emission_ids[i] indexing vocabulary.
+		"""
+		if self._sampling_tables is not None: return self._sampling_tables
+		if self.compiled: raise ValueError("Compiled models keep no emission distributions to sample from")
+
+		transitions = self.score_tables()[0]
+		space = self.state_space
+		state_count = transitions.shape[0]
+
+		probabilities = numpy.exp(transitions)
+		# Moves into the start label are padding (the start state loops on
+		# itself), and sequences in states nothing else can follow just end
+		probabilities[:, space.label_idx[START_LABEL]] = 0.0
+		probabilities[probabilities.sum(axis=1) == 0.0, space.label_idx[STOP_LABEL]] = 1.0
+		totals = probabilities.sum(axis=1)
+		transition_cdf = numpy.cumsum(probabilities / totals[:, numpy.newaxis], axis=1)
+		transition_cdf[:, -1] = 1.0
+		transition_cdf += numpy.arange(state_count)[:, numpy.newaxis]
+
+		emission_idx = dict()
+		emission_cdf, emission_ids = list(), list()
+
+		for state in xrange(state_count):
+			distribution = self.emission.get(space.names[state])
+			if not distribution: continue
+
+			emissions = sorted(distribution.iterkeys())
+			cdf = numpy.cumsum(numpy.exp([distribution[emission] for emission in emissions]))
+			cdf /= cdf[-1]
+			emission_cdf.append(cdf + state)
+			emission_ids.extend(emission_idx.setdefault(emission, len(emission_idx)) for emission in emissions)
+
+		vocabulary = [None] * len(emission_idx)
+		for emission, emission_id in emission_idx.iteritems():
+			vocabulary[emission_id] = emission
+
+		emission_cdf = numpy.concatenate(emission_cdf) if emission_cdf else numpy.zeros(0)
+		self._sampling_tables = (transition_cdf.ravel(), emission_cdf,
+								 numpy.array(emission_ids, dtype=numpy.int64), vocabulary)
+
+		return self._sampling_tables
+
+	def sample_many(self, n_sequences, max_length=100, rng=None):
+		"""
+		Samples n_sequences labelled sequences, lists of (label, emission)
+		pairs like those train takes, without the start / stop padding. All
+		sequences are drawn together, one position at a time; a sequence ends
+		when it reaches the stop label or max_length. rng is a
+		numpy.random.RandomState or a seed for one.
+		"""
+		if not isinstance(rng, numpy.random.RandomState):
+			rng = numpy.random.RandomState(rng)
+
+		transition_cdf, emission_cdf, emission_ids, vocabulary = self.sampling_tables()
+		space = self.state_space
+		label_count = len(space.labels)
+		stop = space.label_idx[STOP_LABEL]
+
+		states = numpy.zeros((n_sequences, max_length), dtype=numpy.int64)
+		lengths = numpy.zeros(n_sequences, dtype=numpy.int64)
+		state = numpy.empty(n_sequences, dtype=numpy.int64)
+		state.fill(space.start)
+		active = numpy.arange(n_sequences)
+
+		for pos in xrange(max_length):
+			if not len(active): break
+
+			current = state[active]
+			labels = numpy.searchsorted(transition_cdf, current + rng.random_sample(len(active)), side='right')
+			labels -= current * label_count
+			# Guard against the last cumulative value rounding below 1.0
+			labels = numpy.minimum(labels, label_count - 1)
+
+			ended = labels == stop
+			active, current, labels = active[~ended], current[~ended], labels[~ended]
+
+			state[active] = space.push_table[current, labels]
+			states[active, pos] = state[active]
+			lengths[active] = pos + 1
+
+		# Emissions only depend on the state, so draw them all at once
+		rows, positions = numpy.nonzero(numpy.arange(max_length) < lengths[:, numpy.newaxis])
+		drawn = states[rows, positions]
+		emissions = emission_ids[numpy.minimum(numpy.searchsorted(emission_cdf, drawn + rng.random_sample(len(drawn)),
+																   side='right'), len(emission_ids) - 1)]
+
+		last_labels = space.last_label_table[drawn].tolist()
+		emissions = emissions.tolist()
+		sequences = list()
+		offset = 0
+
+		for length in lengths.tolist():
+			sequences.append([(space.labels[label], vocabulary[emission])
+							  for label, emission in izip(last_labels[offset:offset+length], emissions[offset:offset+length])])
+			offset += length
+
+		return sequences
+
 def debug_problem(args):
 	#pragma: no cover
 	# Very simple chain for debugging purposes
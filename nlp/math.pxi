@@ -1,5 +1,6 @@
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
 	double log(double x)
+	double exp(double x)
 	double erf(double x)
 	double abs(double x)
 	double sqrt(double x)
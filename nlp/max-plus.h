@@ -0,0 +1,106 @@
+#ifndef _MAX_PLUS_H_
+#define _MAX_PLUS_H_
+
+#include <math.h>
+
+/* Max-plus kernels for the viterbi inner loop.
+ *
+ * max_plus computes max_k(prev[k] + row[k]) over two contiguous arrays,
+ * writes it to *best and returns the first k attaining it (-1 if every sum
+ * is -inf). The reduction runs over MAX_PLUS_BLOCK independent lanes using
+ * selects rather than branches, so there is no data-dependent jump and no
+ * single loop-carried dependency.
+ *
+ * max_plus_float and max_plus_int16 do the same over float32 and int16
+ * fixed point rows (row[k] * scale), widening each entry to double.
+ *
+ * max_plus_scalar is the original gather-and-branch loop over a list of
+ * predecessor indices; it is kept for benchmarking.
+ */
+
+#define MAX_PLUS_BLOCK 4
+
+/* The blocked kernel for a row type, reading row[k] through LOAD */
+#define MAX_PLUS_KERNEL(NAME, ROW_TYPE, LOAD) \
+static inline int NAME(const double *restrict prev, const ROW_TYPE *restrict row, \
+					   int width, double scale, double *best) \
+{ \
+  double m[MAX_PLUS_BLOCK]; \
+  int arg[MAX_PLUS_BLOCK]; \
+  int k = 0, lane; \
+ \
+  for (lane = 0; lane < MAX_PLUS_BLOCK; lane++) \
+  { \
+	m[lane] = -INFINITY; \
+	arg[lane] = -1; \
+  } \
+ \
+  for (; k + MAX_PLUS_BLOCK <= width; k += MAX_PLUS_BLOCK) \
+  { \
+	for (lane = 0; lane < MAX_PLUS_BLOCK; lane++) \
+	{ \
+	  double v = prev[k+lane] + LOAD(row[k+lane], scale); \
+	  int greater = v > m[lane]; \
+	  arg[lane] = greater ? k + lane : arg[lane]; \
+	  m[lane] = greater ? v : m[lane]; \
+	} \
+  } \
+ \
+  for (; k < width; k++) \
+  { \
+	double v = prev[k] + LOAD(row[k], scale); \
+	int greater = v > m[0]; \
+	arg[0] = greater ? k : arg[0]; \
+	m[0] = greater ? v : m[0]; \
+  } \
+ \
+  /* Combine lanes, preferring the earliest index on ties */ \
+  for (lane = 1; lane < MAX_PLUS_BLOCK; lane++) \
+  { \
+	if (arg[lane] < 0) continue; \
+	if (m[lane] > m[0] || (m[lane] == m[0] && (arg[0] < 0 || arg[lane] < arg[0]))) \
+	{ \
+	  m[0] = m[lane]; \
+	  arg[0] = arg[lane]; \
+	} \
+  } \
+ \
+  *best = m[0]; \
+  return arg[0]; \
+}
+
+#define LOAD_DOUBLE(value, scale) (value)
+#define LOAD_FLOAT(value, scale) ((double)(value))
+/* -32768 is -inf in fixed point rows (see quantize.py) */
+#define LOAD_INT16(value, scale) ((value) == -32768 ? -INFINITY : (value) * (scale))
+
+MAX_PLUS_KERNEL(max_plus_double, double, LOAD_DOUBLE)
+MAX_PLUS_KERNEL(max_plus_float, float, LOAD_FLOAT)
+MAX_PLUS_KERNEL(max_plus_int16, short, LOAD_INT16)
+
+static inline int max_plus(const double *restrict prev, const double *restrict row, int width, double *best)
+{
+  return max_plus_double(prev, row, width, 1.0, best);
+}
+
+static inline int max_plus_scalar(const double *prev, const int *pred_idx, const double *pred_scores,
+								  int count, double *best)
+{
+  int k, last = -1;
+  double score = -INFINITY;
+
+  for (k = 0; k < count; k++)
+  {
+	double label_score = prev[pred_idx[k]] + pred_scores[k];
+	if (label_score > score)
+	{
+	  last = pred_idx[k];
+	  score = label_score;
+	}
+  }
+
+  *best = score;
+  return last;
+}
+
+#endif
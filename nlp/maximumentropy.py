@@ -3,6 +3,11 @@ from __future__ import with_statement
 __maxent_functions__ = "C"
 
 from math import exp
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+from scipy.sparse import csr_matrix
 
 # python modules
 from countermap import CounterMap
@@ -136,20 +141,256 @@ class MaxEntWeightFunction(Function):
 
 		return objective
 
+# The shards, shared weights and shared per-shard gradients maxent worker
+# processes evaluate with, inherited when the pool forks. The pool gets these
+# rather than the weight function, so the function never references its own
+# pool and can close it when collected.
+_worker_state = None
+
+def _set_worker_state(state):
+	global _worker_state
+	_worker_state = state
+
+def _worker_shard_value(task):
+	shard, with_gradient = task
+	shards, weights, gradients = _worker_state
+	data, data_t, gold = shards[shard]
+
+	objective, gradient = SparseMaxEntWeightFunction._data_value(data, data_t, gold, weights, with_gradient)
+	if with_gradient: gradients[shard] = gradient
+	return objective
+
+def _worker_add_gradients(task):
+	target, source = task
+	gradients = _worker_state[2]
+	gradients[target] += gradients[source]
+
+def _tree_pairs(count):
+	# The pairs _tree_sum adds, one list per round, as (target, source)
+	# indices where each sum is kept in its first partial's place
+	rounds = list()
+	step = 1
+	while step < count:
+		rounds.append([(index, index + step) for index in xrange(0, count - step, 2 * step)])
+		step *= 2
+	return rounds
+
+def _tree_sum(partials):
+	# Pairwise, so rounding error grows with the log of the number of shards
+	partials = list(partials)
+	while len(partials) > 1:
+		partials = [partials[index] + partials[index+1] if index + 1 < len(partials) else partials[index]
+					for index in xrange(0, len(partials), 2)]
+	return partials[0] + 0
+
+class SparseMaxEntWeightFunction(Function):
+	"""
+	MaxEntWeightFunction over arrays: the data's feature counts are a CSR
+	matrix X (data x features) and weights are a dense (features x labels)
+	array W, so with P the label distributions and Y the gold labels the
+	objective is the negative log likelihood plus |W|^2 / 2sigma^2 and the
+	gradient is X'(P - Y) + W / sigma^2. With buckets, features are already
+	hashed bucket ids, which are the columns of X as they are.
+
+	With more than one process (None for one per core), the rows of X are
+	split into a shard per process and evaluated by a pool of workers that
+	inherit the shards when it forks. Each evaluation only copies the
+	weights into shared memory; workers write their partial gradients into
+	their shard's slot of a shared array, and the partial gradients and
+	objectives are both summed pairwise, each round of gradient sums split
+	over the pool. close() (or leaving a with block, or collection) stops
+	the pool.
+	"""
+	sigma = 1.0
+
+	def __init__(self, labeled_extracted_features, labels, features=None, buckets=None, processes=1):
+		self.labels = list(labels)
+		self.label_idx = dict((label, idx) for idx, label in enumerate(self.labels))
+		self.feature_idx = dict()
+		self.buckets = buckets
+
+		rows, cols, counts, gold = list(), list(), list(), list()
+		for index, (datum_label, datum_features) in enumerate(labeled_extracted_features):
+			gold.append(self.label_idx[datum_label])
+			for feature, cnt in datum_features.iteritems():
+				rows.append(index)
+				cols.append(feature if buckets else self.feature_idx.setdefault(feature, len(self.feature_idx)))
+				counts.append(cnt)
+
+		self.features = [None] * len(self.feature_idx)
+		for feature, idx in self.feature_idx.iteritems():
+			self.features[idx] = feature
+
+		self.gold = numpy.array(gold, dtype=numpy.int64)
+		self.data = csr_matrix((numpy.array(counts, dtype=numpy.float64), (rows, cols)),
+							   shape=(len(gold), self.shape[0]))
+		self.data_t = self.data.T.tocsr()
+
+		self.processes = cpu_count() if processes is None else processes
+		self.pool = None
+		if self.processes > 1:
+			bounds = numpy.linspace(0, len(gold), self.processes + 1).astype(int).tolist()
+			self.shards = [(self.data[begin:end], self.data[begin:end].T.tocsr(), self.gold[begin:end])
+						   for begin, end in izip(bounds[:-1], bounds[1:])]
+
+			size = self.shape[0] * self.shape[1]
+			self.shared_weights = numpy.frombuffer(RawArray('d', size)).reshape(self.shape)
+			# Allocated once; the pairwise sums need every partial at once
+			self.shared_gradients = numpy.frombuffer(RawArray('d', size * len(self.shards))) \
+				.reshape((len(self.shards),) + self.shape)
+
+	@property
+	def shape(self):
+		"""
+		The shape of the weight arrays, (features or buckets, labels)
+		"""
+		return (self.buckets or len(self.features), len(self.labels))
+
+	def weight_map(self, weights):
+		"""
+		Returns a weight array as a CounterMap of label to feature weights
+		"""
+		weight_map = CounterMap()
+		for idx, label in enumerate(self.labels):
+			weight_map[label] = Counter(izip(self.features, weights[:, idx].tolist()))
+		return weight_map
+
+	@classmethod
+	def _data_value(cls, data, data_t, gold, weights, with_gradient):
+		# The unpenalized objective (and gradient) over some rows of X
+		scores = numpy.asarray(data * weights)
+		if not len(gold): return 0.0, (numpy.zeros_like(weights) if with_gradient else None)
+
+		scores -= scores.max(axis=1)[:, numpy.newaxis]
+		scores -= numpy.log(numpy.exp(scores).sum(axis=1))[:, numpy.newaxis]
+		objective = -scores[numpy.arange(len(gold)), gold].sum()
+		if not with_gradient: return objective, None
+
+		# Expected minus empirical counts
+		probs = numpy.exp(scores)
+		probs[numpy.arange(len(gold)), gold] -= 1.0
+		return objective, numpy.asarray(data_t * probs)
+
+	def _value(self, weights, with_gradient):
+		if self.processes == 1:
+			return self._data_value(self.data, self.data_t, self.gold, weights, with_gradient)
+
+		if self.pool is None:
+			state = (self.shards, self.shared_weights, self.shared_gradients)
+			self.pool = Pool(self.processes, initializer=_set_worker_state, initargs=(state,))
+
+		self.shared_weights[:] = weights
+		objectives = self.pool.map(_worker_shard_value, [(shard, with_gradient) for shard in xrange(len(self.shards))])
+		if not with_gradient: return _tree_sum(objectives), None
+
+		for pairs in _tree_pairs(len(self.shards)):
+			self.pool.map(_worker_add_gradients, pairs)
+		return _tree_sum(objectives), self.shared_gradients[0].copy()
+
+	def _penalty(self, weights):
+		if not self.sigma: return 0.0
+		return numpy.vdot(weights, weights) / (2 * self.sigma**2)
+
+	def close(self):
+		if getattr(self, "pool", None) is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __del__(self):
+		self.close()
+
+	last_vg_weights = None
+	last_vg = (None, None)
+	def value_and_gradient(self, weights, verbose=False):
+		if self.last_vg_weights is not None and numpy.array_equal(weights, self.last_vg_weights):
+			return self.last_vg
+
+		objective, gradient = self._value(weights, True)
+		if verbose: print "Raw objective: %f" % objective
+
+		if self.sigma:
+			objective += self._penalty(weights)
+			gradient += weights / self.sigma**2
+			if verbose: print "Penalized objective: %f" % objective
+
+		self.last_vg_weights = weights.copy()
+		self.last_vg = (objective, gradient)
+		return (objective, gradient)
+
+	def value(self, weights, verbose=False):
+		return self._value(weights, False)[0] + self._penalty(weights)
+
 class MaximumEntropyClassifier(object):
 	labels = None
 	features = None
 	weights = None
 
-	def __init__(self, labels=None, features=None):
+	def __init__(self, labels=None, features=None, buckets=None, signed=True, processes=1):
+		"""
+		With buckets, ngram features are hashed (with a sign, unless signed
+		is False) into that many buckets. No feature set is kept, and the
+		weights are a (buckets x labels) array. processes is how many worker
+		processes evaluate the training objective (None for one per core).
+		"""
 		self.labels = labels
 		self.features = features		
+		self.buckets = buckets
+		self.signed = signed
+		self.processes = processes
+
+	def extract_features(self, datum):
+		features = Counter()
+		if self.buckets:
+			for bucket, value in ngrams(datum, 1, buckets=self.buckets, signed=self.signed):
+				features[bucket] += value
+		else:
+			for feature in ngrams(datum, 1):
+				features[tuple(feature)] += 1.0
+		return features
 
 	def get_log_probabilities(self, datum_features):
-		return get_log_probs(datum_features, self.weights, self.labels)
+		if not self.buckets: return get_log_probs(datum_features, self.weights, self.labels)
+
+		scores = numpy.zeros(len(self.labels))
+		for bucket, value in datum_features.iteritems():
+			scores += value * self.weights[bucket]
+
+		log_probs = Counter(izip(self.labels, scores.tolist()))
+		log_probs.log_normalize()
+		return log_probs
 	
-	def train_with_features(self, labeled_features, sigma=None, quiet=False):
+	def train_with_features(self, labeled_features, sigma=None, quiet=False, sparse=True, processes=None):
+		"""
+		Fits the weights to labeled_features, (label, feature Counter) pairs.
+		Unless sparse is False, the objective is evaluated over arrays with
+		SparseMaxEntWeightFunction instead of over CounterMaps, by processes
+		worker processes (by default the classifier's processes).
+		"""
+		if processes is None: processes = self.processes
 		print "Optimizing weights..."
+		if sparse or self.buckets:
+			weight_function = SparseMaxEntWeightFunction(labeled_features, self.labels, self.features, self.buckets,
+														 processes=processes)
+			weight_function.sigma = sigma
+
+			print "Training on %d labelled features" % (len(labeled_features))
+
+			print "Minimizing..."
+			with weight_function:
+				weights = Minimizer.minimize(weight_function, numpy.zeros(weight_function.shape), quiet=quiet)
+			if self.buckets:
+				self.labels, self.weights = weight_function.labels, weights
+			else:
+				self.weights = weight_function.weight_map(weights)
+			return
+
 		weight_function = MaxEntWeightFunction(labeled_features, self.labels, self.features)
 		weight_function.sigma = sigma
 
@@ -162,40 +403,30 @@ class MaximumEntropyClassifier(object):
 		self.weights = Minimizer.minimize(weight_function, initial_weights, quiet=quiet)
 
 	def train(self, labeled_data):
-		self.labels, self.features = set(), set()
+		self.labels, self.features = set(), None if self.buckets else set()
 
 		print "Building features..."
 		labeled_features = []
 		for label, datum in labeled_data:
 			self.labels.add(label)
-			features = Counter()
-
-			for feature in ngrams(datum, 1):
-				features[feature] += 1.0
-				self.features.add(feature)
+			features = self.extract_features(datum)
+			if not self.buckets: self.features.update(features.iterkeys())
 
 			labeled_features.append((label, features))
 
-		print "%d features" % len(self.features)
+		if self.buckets: print "%d buckets" % self.buckets
+		else: print "%d features" % len(self.features)
 		print "%d labels" % len(self.labels)
 			
 		self.train_with_features(labeled_features)
 
 	def label(self, datum):
-		datum_features = Counter()
-		for feature in ngrams(datum, 1):
-			datum_features[feature] += 1.0
-
-		log_probs = self.get_log_probabilities(datum_features)
+		log_probs = self.get_log_probabilities(self.extract_features(datum))
 
 		return log_probs.arg_max()
 		
 	def label_distribution(self, datum):
-		datum_features = Counter()
-		for feature in ngrams(datum, 1):
-			datum_features[feature] += 1.0
-
-		log_probs = self.get_log_probabilities(datum_features)
+		log_probs = self.get_log_probabilities(self.extract_features(datum))
 
 		return log_probs
 
@@ -0,0 +1,228 @@
+# Maximum entropy markov model tagger: p(tag | previous tag, sentence) from a
+# MaximumEntropyClassifier, decoded with the shared chain decoder
+
+from itertools import izip
+
+import numpy
+from scipy import sparse
+
+from counter import Counter
+from cychain import ChainDecoder
+from features import hashed_features
+from maximumentropy import MaximumEntropyClassifier
+from utilities import LRUCache
+
+START_LABEL = "<START>"
+STOP_LABEL = "<STOP>"
+
+class MaxEntMarkovModel(object):
+	"""
+	First-order MEMM. The local distribution at each position depends on the
+	previous tag and on observation features of the sentence around the
+	position (see observation_features).
+
+	The observation features at a position are its signature: the local
+	distributions for every previous tag are computed together, as one
+	sparse (previous tags x features) by (features x tags) product, and
+	memoized per signature.
+
+	With buckets, features are hashed like a MaximumEntropyClassifier's
+	with buckets (signed), and the weight rows are buckets.
+	"""
+
+	def __init__(self, cache_size=50000, buckets=None):
+		self.classifier = None
+		self.labels = list()
+		self.buckets = buckets
+		self.signed = True
+
+		# features x labels weights, and feature => row (unless hashed)
+		self.feature_idx = dict()
+		self.weight_matrix = None
+
+		self.decoder = None
+		self.local_cache = LRUCache(cache_size)
+
+	@classmethod
+	def observation_features(cls, sentence, pos):
+		"""
+		Returns the features of the word at pos that don't depend on tags
+		"""
+		word = sentence[pos]
+		lower = word.lower()
+
+		features = ['bias', 'w=' + lower, 'suf1=' + lower[-1:], 'suf2=' + lower[-2:],
+					'suf3=' + lower[-3:], 'pre1=' + lower[:1]]
+
+		if word[:1].isupper(): features.append('capitalized')
+		if any(char.isdigit() for char in word): features.append('digit')
+		if '-' in word: features.append('hyphen')
+
+		features.append('pw=' + (sentence[pos-1].lower() if pos > 0 else START_LABEL))
+		features.append('nw=' + (sentence[pos+1].lower() if pos + 1 < len(sentence) else STOP_LABEL))
+
+		return features
+
+	@classmethod
+	def previous_feature(cls, previous_label):
+		return 'pt=' + previous_label
+
+	def feature_values(self, features):
+		"""
+		Returns the (weight rows, values) of features: their rows (skipping
+		unknown features) with value 1.0, or if hashed, their buckets and
+		signs
+		"""
+		if self.buckets:
+			pairs = list(hashed_features(features, self.buckets, self.signed))
+			return [bucket for bucket, _ in pairs], [value for _, value in pairs]
+
+		rows = [self.feature_idx[feature] for feature in features if feature in self.feature_idx]
+		return rows, [1.0] * len(rows)
+
+	def classifier_features(self, features):
+		"""
+		Returns features as the Counter the local classifier takes
+		"""
+		counts = Counter()
+		if self.buckets:
+			for bucket, value in hashed_features(features, self.buckets, self.signed):
+				counts[bucket] += value
+		else:
+			for feature in features:
+				counts[feature] += 1.0
+		return counts
+
+	def train(self, tagged_sentences, sigma=1.0, quiet=True):
+		"""
+		Trains the local classifier on (tags, words) pairs
+		"""
+		labeled_features = list()
+		self.signed = True
+
+		for tags, sentence in tagged_sentences:
+			for pos, (tag, previous) in enumerate(izip(tags, [START_LABEL] + list(tags[:-1]))):
+				features = self.observation_features(sentence, pos) + [self.previous_feature(previous)]
+				labeled_features.append((tag, self.classifier_features(features)))
+
+		classifier = MaximumEntropyClassifier(buckets=self.buckets)
+		classifier.labels = set(tag for tag, _ in labeled_features)
+		if not self.buckets:
+			classifier.features = set(feature for _, features in labeled_features for feature in features)
+		classifier.train_with_features(labeled_features, sigma=sigma, quiet=quiet)
+
+		self.use_classifier(classifier)
+
+	def use_classifier(self, classifier):
+		"""
+		Takes the local distributions from a trained MaximumEntropyClassifier
+		whose features are observation_features plus previous_feature. A
+		classifier with buckets hashes them, and its weight array rows are
+		used as they are.
+		"""
+		self.classifier = classifier
+		self.labels = sorted(classifier.labels)
+		label_idx = dict((label, idx) for idx, label in enumerate(self.labels))
+
+		self.buckets = getattr(classifier, "buckets", None)
+		if self.buckets:
+			self.signed = classifier.signed
+			self.feature_idx = dict()
+			self.weight_matrix = classifier.weights[:, [list(classifier.labels).index(label) for label in self.labels]]
+		else:
+			features = sorted(set(feature for weights in classifier.weights.itervalues() for feature in weights))
+			self.feature_idx = dict((feature, idx) for idx, feature in enumerate(features))
+
+			self.weight_matrix = numpy.zeros((len(features), len(self.labels)))
+			for label, weights in classifier.weights.iteritems():
+				for feature, weight in weights.iteritems():
+					self.weight_matrix[self.feature_idx[feature], label_idx[label]] = weight
+
+		# States are the labels plus a start state; every label can follow
+		# the start or any other label
+		self.start = len(self.labels)
+		self.previous_features = [self.feature_values([self.previous_feature(label)])
+								  for label in self.labels + [START_LABEL]]
+
+		prev_states, next_states = numpy.meshgrid(numpy.arange(len(self.labels) + 1),
+												  numpy.arange(len(self.labels)), indexing='ij')
+		self.decoder = ChainDecoder(len(self.labels) + 1, prev_states.ravel(), next_states.ravel(),
+									numpy.zeros(prev_states.size))
+		self.edge_prev, self.edge_next = self.decoder.edges()
+
+		self.local_cache.clear()
+
+	def local_distributions(self, signature):
+		"""
+		Returns the (previous states x labels) log distributions for a
+		position with observation features signature
+		"""
+		observed, observed_values = self.feature_values(signature)
+
+		# One row per previous state: the shared observation features plus
+		# that state's previous-tag feature
+		rows, cols, values = [], [], []
+		for row, (previous, previous_values) in enumerate(self.previous_features):
+			rows.extend(row for _ in xrange(len(observed) + len(previous)))
+			cols.extend(observed)
+			cols.extend(previous)
+			values.extend(observed_values)
+			values.extend(previous_values)
+
+		features = sparse.csr_matrix((values, (rows, cols)),
+									 shape=(len(self.previous_features), self.weight_matrix.shape[0]))
+		scores = features * self.weight_matrix
+
+		# Log-normalize each row
+		top = scores.max(axis=1)[:, numpy.newaxis]
+		return scores - (top + numpy.log(numpy.exp(scores - top).sum(axis=1))[:, numpy.newaxis])
+
+	def _edge_scores(self, signature):
+		return self.local_distributions(signature)[self.edge_prev, self.edge_next]
+
+	def edge_scores(self, sentence):
+		"""
+		Returns the (positions x edges) transition scores the decoder uses
+		for sentence, position 0 being the start state
+		"""
+		scores = numpy.zeros((len(sentence) + 1, self.decoder.transition_count))
+
+		for pos in xrange(len(sentence)):
+			signature = tuple(self.observation_features(sentence, pos))
+			scores[pos+1] = self.local_cache.lookup(signature, self._edge_scores)
+
+		return scores
+
+	def label(self, sentence, beam_size=None, return_score=False):
+		if not sentence:
+			return ([], 0.0) if return_score else []
+
+		# All of the score is in the transitions
+		local_scores = numpy.zeros((len(sentence) + 1, self.decoder.state_count))
+		edge_scores = self.edge_scores(sentence)
+
+		if beam_size:
+			path, score = self.decoder.beam(local_scores, beam_size, start=self.start, edge_scores=edge_scores)
+		else:
+			path, score = self.decoder.viterbi(local_scores, start=self.start, edge_scores=edge_scores)
+
+		labels = [self.labels[state] for state in path[1:].tolist()]
+
+		if return_score:
+			return labels, score
+		return labels
+
+	def score(self, labels, sentence):
+		"""
+		Returns log p(labels | sentence)
+		"""
+		label_idx = dict((label, idx) for idx, label in enumerate(self.labels))
+		score = 0.0
+		previous = self.start
+
+		for pos, label in enumerate(labels):
+			distributions = self.local_distributions(self.observation_features(sentence, pos))
+			score += distributions[previous, label_idx[label]]
+			previous = label_idx[label]
+
+		return score
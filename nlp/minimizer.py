@@ -2,6 +2,13 @@ from copy import copy
 from itertools import izip
 from time import time
 
+import numpy
+
+def _inner_product(left, right):
+	# Counters and CounterMaps, or numpy arrays
+	if isinstance(left, numpy.ndarray): return float(numpy.vdot(left, right))
+	return left.inner_product(right)
+
 class Minimizer(object):
 	min_iterations = 0
 	max_iterations = 25
@@ -14,7 +21,7 @@ class Minimizer(object):
 		step_size = 1
 
 		(value, gradient) = function.value_and_gradient(start)
-		derivative = direction.inner_product(gradient)
+		derivative = _inner_product(direction, gradient)
 
 		guess = None
 		guess_value = 0.0
@@ -44,16 +51,18 @@ class Minimizer(object):
 	def __implicit_multiply(cls, scale, gradient, delta_history, verbose=False):
 		rho = list()
 		alpha = list()
-		right = type(gradient)()
-
-		for key, counter in gradient.iteritems():
-			right[key] = copy(counter)
+		if isinstance(gradient, numpy.ndarray):
+			right = gradient.copy()
+		else:
+			right = type(gradient)()
+			for key, counter in gradient.iteritems():
+				right[key] = copy(counter)
 
 		for (point_delta, derivative_delta) in reversed(delta_history):
-			rho.append(point_delta.inner_product(derivative_delta))
+			rho.append(_inner_product(point_delta, derivative_delta))
 			if rho[-1] == 0.0:
 				raise Exception("Curvature problem")
-			alpha.append(point_delta.inner_product(right) / rho[-1])
+			alpha.append(_inner_product(point_delta, right) / rho[-1])
 			right += derivative_delta * (-alpha[-1])
 
 		if verbose: print "Right: %s" % repr(right)
@@ -64,7 +73,7 @@ class Minimizer(object):
 		left = right * scale
 
 		for alpha, rho, (point_delta, derivative_delta) in izip(alpha, rho, delta_history):
-			left += point_delta * (alpha - derivative_delta.inner_product(left) / rho)
+			left += point_delta * (alpha - _inner_product(derivative_delta, left) / rho)
 
 		if verbose: print "Left: %s" % repr(left)
 
@@ -88,12 +97,15 @@ class Minimizer(object):
 
 			# Calculate inverse hessian scaling
 			hessian_scale = 1.0
-			if derivative_delta:
-				hessian_scale = derivative_delta.inner_product(point_delta) / derivative_delta.inner_product(derivative_delta)
+			if derivative_delta is not None and _inner_product(derivative_delta, derivative_delta):
+				hessian_scale = _inner_product(derivative_delta, point_delta) / _inner_product(derivative_delta, derivative_delta)
 			if verbose: print "Found hessian scaling: %f" % hessian_scale
 
 			# Find and invert direction
-			direction = type(start_map)() - cls.__implicit_multiply(hessian_scale, gradient, history)
+			if isinstance(start_map, numpy.ndarray):
+				direction = -cls.__implicit_multiply(hessian_scale, gradient, history)
+			else:
+				direction = type(start_map)() - cls.__implicit_multiply(hessian_scale, gradient, history)
 			if verbose: print "Found Direction"
 
 			# Line search in the direction found
@@ -4,13 +4,24 @@ from countermap import CounterMap
 from features import ngrams
 
 class NaiveBayesClassifier:
+	def __init__(self, buckets=None):
+		"""
+		With buckets, features are hashed into that many buckets and the
+		feature distribution is keyed on bucket, not on every distinct ngram
+		"""
+		self.buckets = buckets
+
+	def features(self, datum):
+		if self.buckets: return (bucket for bucket, _ in ngrams(datum, 3, buckets=self.buckets))
+		return (tuple(feature) for feature in ngrams(datum, 3))
+
 	def train(self, labeled_data):
 		self.feature_distribution = CounterMap()
 		labels = set()
 
 		for label, datum in labeled_data:
 			labels.add(label)
-			for feature in ngrams(datum, 3)
+			for feature in self.features(datum):
 				self.feature_distribution[feature][label] += 1
 
 		for feature in self.feature_distribution.iterkeys():
@@ -22,7 +33,7 @@ class NaiveBayesClassifier:
 	def label_distribution(self, datum):
 		distribution = None
 
-		for feature in ngrams(datum, 3):
+		for feature in self.features(datum):
 			if distribution:
 				distribution += self.feature_distribution[feature]
 			else:
@@ -35,7 +46,7 @@ class NaiveBayesClassifier:
 	def label(self, datum):
 		distribution = None
 
-		for feature in ngrams(datum, 3):
+		for feature in self.features(datum):
 			if distribution:
 				distribution += self.feature_distribution[feature]
 			else:
@@ -1,39 +1,120 @@
+import bz2
+import gzip
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Pool, cpu_count
 from os import walk
 from os.path import join
 import re
 
+# One pass over a file finds both tree boundaries (an open paren at the
+# start of a line) and leaves ("(TAG word)")
+TOKENS_RE = re.compile(r"(\n\()|\(\s*([^()\s]+)\s+([^()\s]+)\s*\)")
+
+# Compressed files are read in blocks of this many bytes
+BLOCK_SIZE = 1 << 20
+
+def _load_pos_tags(file_path):
+	return PennTreebankReader.load_pos_tags(file_path)
+
 class PennTreebankReader:
 	@classmethod
-	def read_pos_tags_from_directory(cls, path):
+	def tree_files(cls, path):
+		"""
+		Returns the files under path, in sorted order
+		"""
+		paths = []
 		for root, dirs, files in walk(path):
-			for file in files:
-				trees = cls.load_pos_tags(join(root, file))
-				for tree in trees: yield tree
+			dirs.sort()
+			paths.extend(join(root, file) for file in sorted(files))
+		return paths
+
+	@classmethod
+	def read_pos_tags_from_directory(cls, path, processes=1):
+		"""
+		Yields the (tags, words) of every sentence of every file under path,
+		files in sorted order. With more than one process (None for one per
+		core), files are parsed by a pool of workers, in the same order.
+		"""
+		files = cls.tree_files(path)
+		if processes is None: processes = cpu_count()
+
+		if processes == 1:
+			for file_path in files:
+				for sentence in cls.iter_pos_tags(file_path): yield sentence
+			return
+
+		pool = Pool(processes)
+		try:
+			for sentences in pool.imap(_load_pos_tags, files):
+				for sentence in sentences: yield sentence
+		finally:
+			# Also when the caller stops early
+			pool.terminate()
+			pool.join()
 
 	@classmethod
 	def load_pos_tags(cls, file_path):
-		tree_file = open(file_path)
-
-		tree_split_re = re.compile("\n\(")
-		tags_re = re.compile("\([^\(\)]+\)")
-		trees = tree_split_re.split(tree_file.read())
-
-		raw_tags = []
-		for tree in trees:
-			if len(tree) == 0: continue
-			tree = "".join(line.rstrip() for line in tree.split("\n"))
-			raw_tags.append(tags_re.findall(tree))
-
-		sentences = []
-		for sentence in raw_tags:
-			tags, words = [], []
-			for pair in sentence:
-				tag, word = pair.strip("()").split()
+		return list(cls.iter_pos_tags(file_path))
+
+	@classmethod
+	def iter_pos_tags(cls, file_path, block_size=BLOCK_SIZE):
+		"""
+		Yields the (tags, words) of each sentence in file_path. Plain files
+		are memory-mapped; .gz and .bz2 files are decompressed a block at a
+		time.
+		"""
+		if file_path.endswith(".gz"): stream = gzip.open(file_path, "rb")
+		elif file_path.endswith(".bz2"): stream = bz2.BZ2File(file_path, "rb")
+		else: stream = None
+
+		if stream is not None:
+			try:
+				for block in cls._tree_blocks(stream, block_size):
+					for sentence in cls._scan(block): yield sentence
+			finally:
+				stream.close()
+			return
+
+		with open(file_path, "rb") as tree_file:
+			# Empty files can't be mapped
+			tree_file.seek(0, 2)
+			if not tree_file.tell(): return
+
+			tree_map = mmap(tree_file.fileno(), 0, access=ACCESS_READ)
+			try:
+				for sentence in cls._scan(tree_map): yield sentence
+			finally:
+				tree_map.close()
+
+	@classmethod
+	def _tree_blocks(cls, stream, block_size):
+		# Cuts the stream at tree boundaries, so no tree spans two blocks
+		carry = ""
+		while True:
+			data = stream.read(block_size)
+			if not data: break
+
+			data = carry + data
+			cut = data.rfind("\n(")
+			if cut <= 0:
+				carry = data
+				continue
+
+			yield data[:cut]
+			carry = data[cut:]
+
+		if carry: yield carry
+
+	@classmethod
+	def _scan(cls, text):
+		tags, words = [], []
+
+		for boundary, tag, word in TOKENS_RE.findall(text):
+			if boundary:
+				if tags: yield (tags, words)
+				tags, words = [], []
+			else:
 				tags.append(tag)
 				words.append(word)
-			if len(tags) > 0:
-				sentences.append((tags, words))
-
-		tree_file.close()
 
-		return sentences
+		if tags: yield (tags, words)
@@ -0,0 +1,19 @@
+# Micro-benchmark for the viterbi inner loop (max-plus over predecessors)
+import sys
+
+import cychain
+
+def main(args):
+	label_count = int(args[0]) if len(args) >= 1 else 2000
+	width = int(args[1]) if len(args) >= 2 else 45
+	iterations = int(args[2]) if len(args) >= 3 else 200
+
+	blocked, scalar = cychain.benchmark_max_plus(label_count, width, iterations)
+	steps = label_count * iterations
+
+	print "%d states, %d predecessors each, %d positions" % (label_count, width, iterations)
+	print "blocked: %f (%.1f ns / state)" % (blocked, 1e9 * blocked / steps)
+	print "scalar:  %f (%.1f ns / state)" % (scalar, 1e9 * scalar / steps)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,55 @@
+'''
+Compact storage for log score tables: float32, or int16 fixed point with
+one scale per table. int16 tables map the largest finite score magnitude
+to INT16_MAX and keep INT16_NINF for -inf.
+'''
+
+import numpy
+
+PRECISIONS = ('float64', 'float32', 'int16')
+
+INT16_MAX = 32767
+INT16_NINF = -32768
+
+def quantize_scores(scores, precision, scale=None):
+	"""
+	Returns (table, scale), scores stored at precision: scores ~= table *
+	scale, with -inf kept (as INT16_NINF in int16 tables). int16 tables
+	pick their own scale unless given one; raises ValueError if a finite
+	score doesn't fit at the given scale.
+	"""
+	if precision not in PRECISIONS:
+		raise ValueError("Unknown score precision %r (expected one of %s)" % (precision, ", ".join(PRECISIONS)))
+
+	scores = numpy.asarray(scores, dtype=numpy.float64)
+	if precision != 'int16':
+		return scores.astype(precision), 1.0
+
+	finite = numpy.isfinite(scores)
+	if scale is None:
+		largest = numpy.abs(scores[finite]).max() if finite.any() else 0.0
+		scale = largest / INT16_MAX if largest > 0.0 else 1.0
+
+	# INT16_NINF is taken, so finite scores must fit in +-INT16_MAX
+	fixed = numpy.round(scores[finite] / scale)
+	if fixed.size and numpy.abs(fixed).max() > INT16_MAX:
+		raise ValueError("Scores up to %g in magnitude overflow int16 at scale %g" %
+						 (numpy.abs(scores[finite]).max(), scale))
+
+	table = numpy.empty(scores.shape, dtype=numpy.int16)
+	table.fill(INT16_NINF)
+	table[finite] = fixed
+
+	return table, scale
+
+def dequantize_scores(table, scale):
+	"""
+	Returns the float64 scores a quantize_scores table stands for
+	"""
+	table = numpy.asarray(table)
+	if table.dtype != numpy.int16:
+		return table.astype(numpy.float64)
+
+	scores = table * scale
+	scores[table == INT16_NINF] = float("-inf")
+	return scores
@@ -0,0 +1,136 @@
+'''
+Integer encoding of the label histories a higher-order chain model uses as
+states. A state is a tuple of label_history_size label ids; its string name
+('A::B') is only built once, when the state is first seen.
+'''
+
+import numpy
+
+class StateSpace(object):
+	def __init__(self, label_history_size, start_label, stop_label):
+		self.label_history_size = label_history_size
+
+		self.label_idx = dict()
+		self.labels = list()
+
+		self.state_idx = dict()
+		self.histories = list()
+		self.names = list()
+		self.name_idx = dict()
+		self.last_label = list()
+
+		# (state, label id) => state
+		self._push = dict()
+		self._suffix_names = dict()
+
+		# Frozen numpy copies of push / last_label (see freeze)
+		self.push_table = None
+		self.last_label_table = None
+
+		self.start = self.state((self.label(start_label),) * label_history_size)
+		self.stop = self.state((self.label(stop_label),) * label_history_size)
+
+	def __len__(self):
+		return len(self.histories)
+
+	def label(self, label):
+		"""
+		Returns the id of label, assigning one if it's new
+		"""
+		try:
+			return self.label_idx[label]
+		except KeyError:
+			idx = self.label_idx[label] = len(self.labels)
+			self.labels.append(label)
+			return idx
+
+	def state(self, history):
+		"""
+		Returns the id of the state for history (a tuple of label ids),
+		assigning one if it's new
+		"""
+		try:
+			return self.state_idx[history]
+		except KeyError:
+			idx = self.state_idx[history] = len(self.histories)
+			name = '::'.join(self.labels[label] for label in history)
+
+			self.histories.append(history)
+			self.names.append(name)
+			self.name_idx[name] = idx
+			self.last_label.append(history[-1])
+			return idx
+
+	def state_of(self, name):
+		"""
+		Returns the id of the state named name (e.g. 'A::B')
+		"""
+		try:
+			return self.name_idx[name]
+		except KeyError:
+			return self.state(tuple(self.label(label) for label in name.split('::')))
+
+	def push(self, state, label):
+		"""
+		Returns the state reached from state after label (a label id)
+		"""
+		try:
+			return self._push[state, label]
+		except KeyError:
+			next_state = self._push[state, label] = self.state(self.histories[state][1:] + (label,))
+			return next_state
+
+	def suffix_names(self, state):
+		"""
+		Returns the names of the 1, 2, ... label_history_size label suffixes
+		of state (the histories lower-order transitions are conditioned on)
+		"""
+		try:
+			return self._suffix_names[state]
+		except KeyError:
+			history = self.histories[state]
+			names = self._suffix_names[state] = \
+				tuple('::'.join(self.labels[label] for label in history[-length:])
+					  for length in xrange(1, self.label_history_size+1))
+			return names
+
+	def last_label_of(self, name):
+		return self.labels[self.last_label[self.state_of(name)]]
+
+	def freeze(self):
+		"""
+		Builds dense push_table (states x labels, -1 for unseen states) and
+		last_label_table arrays over the current states
+		"""
+		self.push_table = numpy.empty((len(self.histories), len(self.labels)), dtype=numpy.int32)
+		self.push_table.fill(-1)
+
+		# Only states sharing a prefix with a state's suffix can follow it
+		extensions = dict()
+		for state, history in enumerate(self.histories):
+			extensions.setdefault(history[:-1], []).append((history[-1], state))
+
+		for state, history in enumerate(self.histories):
+			for label, next_state in extensions.get(history[1:], ()):
+				self.push_table[state, label] = next_state
+
+		self.last_label_table = numpy.array(self.last_label, dtype=numpy.int32)
+
+	@classmethod
+	def from_arrays(cls, label_history_size, start_label, stop_label, labels, histories, push_table, last_label_table):
+		"""
+		Rebuilds a frozen state space from its labels and (states x
+		label_history_size) histories array, keeping the given tables (which
+		may be memory-mapped) rather than rebuilding them
+		"""
+		space = cls(label_history_size, start_label, stop_label)
+
+		for label in labels:
+			space.label(label)
+		for history in histories.tolist():
+			space.state(tuple(history))
+
+		space.push_table = push_table
+		space.last_label_table = last_label_table
+
+		return space
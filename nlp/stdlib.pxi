@@ -1,4 +1,4 @@
-cdef extern from "stdlib.h":
+cdef extern from "stdlib.h" nogil:
 	ctypedef unsigned long size_t
 	void free(void *ptr)
 	void *malloc(size_t size)
@@ -6,3 +6,4 @@ cdef extern from "stdlib.h":
 	void *realloc(void *ptr, size_t size)
 	size_t strlen(char *s)
 	char *strcpy(char *dest, char *src)
+	int posix_memalign(void **memptr, size_t alignment, size_t size)
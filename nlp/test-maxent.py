@@ -2,6 +2,8 @@ from itertools import chain
 from math import exp, log
 import time
 
+import numpy
+
 from counter import Counter
 import maxent
 import maximumentropy
@@ -39,6 +41,100 @@ class MaximumEntropyClassifierTestToyProblem(unittest.TestCase):
 #			for label in ['cat', 'bear']:
 #				print "P[%s | %s] = %f" % (label, test_datum[1].keys(), exp(maxent_log_probs[label]))
 
+	def test_processes(self):
+		self.classifier.train_with_features(self.training_data, sigma=1.0, quiet=True, processes=2)
+		maxent_log_probs = self.classifier.get_log_probabilities(self.test_data[0][1])
+		self.assertAlmostEqual(exp(maxent_log_probs['cat']), 0.73, 2)
+		self.assertAlmostEqual(exp(maxent_log_probs['bear']), 0.27, 2)
+
+		# Or set on the classifier, for train
+		classifier = maximumentropy.MaximumEntropyClassifier(processes=2)
+		classifier.train([('vowel', 'aeiou'), ('consonant', 'bcdfg')])
+		self.assertEqual(classifier.label('eio'), 'vowel')
+
+	def test_counter_weights(self):
+		self.classifier.train_with_features(self.training_data, sigma=1.0, quiet=True, sparse=False)
+		maxent_log_probs = self.classifier.get_log_probabilities(self.test_data[0][1])
+		self.assertAlmostEqual(exp(maxent_log_probs['cat']), 0.73, 2)
+		self.assertAlmostEqual(exp(maxent_log_probs['bear']), 0.27, 2)
+
+class MaximumEntropyClassifierHashingTest(unittest.TestCase):
+	training_data = (('vowel', 'aeiou'), ('vowel', 'eaoei'), ('vowel', 'uoiae'),
+					 ('consonant', 'bcdfg'), ('consonant', 'gtdbk'), ('consonant', 'pqrst'))
+
+	def test_hashed_features(self):
+		classifier = maximumentropy.MaximumEntropyClassifier()
+		classifier.train(self.training_data)
+		hashed_classifier = maximumentropy.MaximumEntropyClassifier(buckets=256)
+		hashed_classifier.train(self.training_data)
+
+		self.assertEqual(hashed_classifier.features, None)
+		self.assertEqual(hashed_classifier.weights.shape, (256, 2))
+		for datum in ('aeu', 'iooa', 'bdk', 'ftsr'):
+			self.assertEqual(hashed_classifier.label(datum), classifier.label(datum))
+
+		self.assertEqual(hashed_classifier.label('aeu'), 'vowel')
+		distribution = hashed_classifier.label_distribution('aeu')
+		self.assertAlmostEqual(sum(exp(value) for value in distribution.itervalues()), 1.0)
+
+class SparseMaxEntWeightFunctionTest(unittest.TestCase):
+	def setUp(self):
+		self.labeled_extracted_features = (('cat', Counter({'fuzzy' : 1.0, 'claws' : 2.0, 'small' : 1.0})),
+										   ('bear', Counter({'fuzzy' : 1.0, 'claws' : 1.0, 'big' : 3.0})),
+										   ('cat', Counter({'claws' : 1.0, 'medium' : 1.0})),
+										   ('dog', Counter({'fuzzy' : 2.0, 'medium' : 1.0})))
+		self.labels = set(label for label, _ in self.labeled_extracted_features)
+
+	def test_matches_counter_function(self):
+		function = maximumentropy.SparseMaxEntWeightFunction(self.labeled_extracted_features, self.labels)
+		counter_function = maximumentropy.MaxEntWeightFunction(self.labeled_extracted_features, self.labels, None)
+		self.assertEqual(function.shape, (5, 3))
+
+		weights = numpy.random.RandomState(0).normal(size=function.shape)
+		weight_map = function.weight_map(weights)
+
+		for sigma in (0.0, 2.0):
+			function.sigma = counter_function.sigma = sigma
+			function.last_vg_weights = counter_function.last_vg_weights = None
+
+			value, gradient = function.value_and_gradient(weights)
+			counter_value, counter_gradient = counter_function.value_and_gradient(weight_map)
+
+			self.assertAlmostEqual(value, counter_value)
+			self.assertAlmostEqual(function.value(weights), counter_function.value(weight_map))
+			for label, label_gradient in function.weight_map(gradient).iteritems():
+				for feature, partial in label_gradient.iteritems():
+					self.assertAlmostEqual(partial, counter_gradient[label][feature])
+
+	def test_sharded(self):
+		function = maximumentropy.SparseMaxEntWeightFunction(self.labeled_extracted_features, self.labels)
+		# More shards than data, so one is empty
+		sharded_function = maximumentropy.SparseMaxEntWeightFunction(self.labeled_extracted_features, self.labels, processes=5)
+		weights = numpy.random.RandomState(0).normal(size=function.shape)
+
+		with sharded_function:
+			for sigma in (0.0, 2.0):
+				function.sigma = sharded_function.sigma = sigma
+				value, gradient = function.value_and_gradient(weights + sigma)
+				sharded_value, sharded_gradient = sharded_function.value_and_gradient(weights + sigma)
+
+				self.assertAlmostEqual(value, sharded_value)
+				self.assertTrue(numpy.allclose(gradient, sharded_gradient))
+				self.assertAlmostEqual(function.value(weights), sharded_function.value(weights))
+
+			# One shared slot per shard, summed in the same pairs as the objective
+			self.assertEqual(sharded_function.shared_gradients.shape, (5,) + function.shape)
+			self.assertEqual(maximumentropy._tree_pairs(5), [[(0, 1), (2, 3)], [(0, 2)], [(0, 4)]])
+		self.assertEqual(sharded_function.pool, None)
+
+	def test_pool_closed_when_collected(self):
+		function = maximumentropy.SparseMaxEntWeightFunction(self.labeled_extracted_features, self.labels, processes=2)
+		function.value(numpy.zeros(function.shape))
+		workers = list(function.pool._pool)
+
+		del function
+		self.assertFalse(any(worker.is_alive() for worker in workers))
+
 class MaximumEntropyExpectedCountsTest(unittest.TestCase):
 	def setUp(self):
 		self.labeled_extracted_features = (('cat', Counter((key, 1.0) for key in ('fuzzy', 'claws', 'small'))),
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from artifactcache import ArtifactCache, fingerprint_files, make_key
+
+class ArtifactCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cache = ArtifactCache(os.path.join(self.directory, "cache"), verbose=False)
+		self.computed = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def compute(self, value):
+		def thunk():
+			self.computed += 1
+			return value
+		return thunk
+
+	def test_lookup(self):
+		key = make_key("artifact", 1)
+
+		self.assertEqual(self.cache.lookup(key, self.compute([1, 2])), [1, 2])
+		self.assertEqual(self.cache.lookup(key, self.compute([3])), [1, 2])
+		self.assertEqual(self.computed, 1)
+		self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+		# No temporary files are left behind
+		self.assertEqual(os.listdir(self.cache.directory), [key + ".pickle"])
+
+	def test_keys(self):
+		self.assertEqual(make_key("a", 1, ArtifactCache), make_key("a", 1, ArtifactCache))
+		self.assertNotEqual(make_key("a", 1), make_key("a", 2))
+		self.assertNotEqual(make_key("a", ArtifactCache), make_key("a", unittest.TestCase))
+
+	def test_unreadable_entry(self):
+		key = make_key("artifact")
+		self.cache.lookup(key, self.compute("value"))
+
+		with open(self.cache.path(key), "wb") as entry:
+			entry.write("not a pickle")
+
+		self.assertEqual(self.cache.lookup(key, self.compute("value")), "value")
+		self.assertEqual(self.computed, 2)
+		self.assertEqual(self.cache.lookup(key, self.compute("other")), "value")
+
+	def test_eviction(self):
+		keys = [make_key("artifact", index) for index in xrange(3)]
+		for age, key in enumerate(keys):
+			self.cache.store(key, "x" * 1000)
+			os.utime(self.cache.path(key), (age, age))
+
+		# Using the oldest entry makes the next oldest the one to go
+		self.cache.lookup(keys[0], self.compute(None))
+		self.cache.max_bytes = 2500
+		self.cache.evict()
+
+		self.assertTrue(keys[0] in self.cache)
+		self.assertFalse(keys[1] in self.cache)
+		self.assertTrue(keys[2] in self.cache)
+		self.assertEqual(self.cache.stats()['evictions'], 1)
+
+	def test_file_entries(self):
+		def write(path):
+			self.computed += 1
+			with open(path, "wb") as entry:
+				entry.write("x" * 1000)
+
+		key = make_key("corpus")
+		path = self.cache.lookup_file(key, write, ".corpus")
+		self.assertEqual(path, self.cache.path(key, ".corpus"))
+		self.assertEqual(self.cache.lookup_file(key, write, ".corpus"), path)
+		self.assertEqual(self.computed, 1)
+		self.assertEqual(os.listdir(self.cache.directory), [key + ".corpus"])
+		self.assertRaises(ValueError, self.cache.lookup_file, key, write, ".txt")
+
+		# File entries count against max_bytes, and are evicted and cleared
+		self.cache.store(make_key("artifact"), "x" * 1000)
+		self.assertEqual(self.cache.stats()['entries'], 2)
+		os.utime(path, (0, 0))
+		self.cache.max_bytes = 1500
+		self.cache.evict()
+		self.assertFalse(os.path.exists(path))
+
+		# A new entry is kept even if it alone is over the limit
+		self.cache.max_bytes = 0
+		path = self.cache.lookup_file(key, write, ".corpus")
+		self.assertTrue(os.path.exists(path))
+		self.cache.clear()
+		self.assertEqual(os.listdir(self.cache.directory), [])
+
+	def test_fingerprint_files(self):
+		with open(os.path.join(self.directory, "corpus"), "w") as corpus:
+			corpus.write("(DT the)")
+		fingerprint = fingerprint_files(self.directory)
+		self.assertEqual(fingerprint_files(self.directory), fingerprint)
+
+		with open(os.path.join(self.directory, "corpus"), "a") as corpus:
+			corpus.write("(NN dog)")
+		self.assertNotEqual(fingerprint_files(self.directory), fingerprint)
+
+if __name__ == "__main__":
+	unittest.main()
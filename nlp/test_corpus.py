@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from corpus import Corpus
+
+class CorpusTest(unittest.TestCase):
+	sentences = [(['DT', 'NN'], ['the', 'dog']), (['NN', 'VBZ', 'NN'], ['dog', 'bites', 'man']),
+				 ([], []), (['DT', 'NN', '.'], ['the', 'man', '.'])]
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "test.corpus")
+		self.corpus = Corpus.from_sentences(self.sentences)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_encoding(self):
+		self.assertEqual(self.corpus.vocabulary, ['the', 'dog', 'bites', 'man', '.'])
+		self.assertEqual(self.corpus.tagset, ['DT', 'NN', 'VBZ', '.'])
+		self.assertEqual(self.corpus.words.dtype, numpy.int32)
+		self.assertEqual(self.corpus.offsets.tolist(), [0, 2, 5, 5, 8])
+
+		tag_ids, word_ids = self.corpus.sentence_ids(1)
+		self.assertEqual((tag_ids.tolist(), word_ids.tolist()), ([1, 2, 1], [1, 2, 3]))
+
+		self.assertRaises(ValueError, Corpus.from_sentences, [(['DT'], ['the', 'dog'])])
+
+	def test_access(self):
+		self.assertEqual(len(self.corpus), 4)
+		self.assertEqual(list(self.corpus), self.sentences)
+		self.assertEqual(self.corpus[-1], self.sentences[-1])
+		self.assertRaises(IndexError, self.corpus.__getitem__, 4)
+
+		split = self.corpus[1:3]
+		self.assertEqual(list(split), self.sentences[1:3])
+		self.assertEqual(split.word_ids.tolist(), [1, 2, 3])
+		self.assertTrue(split.words is self.corpus.words)
+		self.assertEqual(len(self.corpus[3:1]), 0)
+		self.assertEqual(list(self.corpus[:None]), self.sentences)
+
+	def test_write_load(self):
+		self.corpus.write(self.path)
+		corpus = Corpus.load(self.path)
+
+		self.assertTrue(isinstance(corpus.words, numpy.memmap))
+		self.assertEqual(list(corpus), self.sentences)
+
+		# A slice is written on its own
+		self.corpus[1:].write(self.path)
+		self.assertEqual(list(Corpus.load(self.path)), self.sentences[1:])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,203 @@
+from itertools import product
+from math import exp, log
+import random
+import unittest
+
+import numpy
+
+import cychain
+from cychain import ChainDecoder, StreamingDecoder
+from quantize import quantize_scores, dequantize_scores
+
+class ChainDecoderTest(unittest.TestCase):
+	state_count = 4
+	length = 5
+
+	def setUp(self):
+		random.seed(0)
+		ninf = float("-inf")
+
+		# Random transitions with a few missing
+		self.transitions = numpy.array([[log(random.random()) if random.random() < 0.7 else ninf
+										 for _ in xrange(self.state_count)]
+										for _ in xrange(self.state_count)])
+		self.local = numpy.array([[log(random.random()) for _ in xrange(self.state_count)]
+								  for _ in xrange(self.length)])
+		self.decoder = ChainDecoder.from_matrix(self.transitions)
+
+	def path_score(self, path, transitions=None):
+		score = self.local[0, path[0]]
+		for pos in xrange(1, len(path)):
+			if transitions is None: score += self.transitions[path[pos-1], path[pos]]
+			else: score += transitions[pos][path[pos-1], path[pos]]
+			score += self.local[pos, path[pos]]
+		return score
+
+	def paths(self, start=-1, stop=-1):
+		for path in product(range(self.state_count), repeat=self.length):
+			if start >= 0 and path[0] != start: continue
+			if stop >= 0 and path[-1] != stop: continue
+			yield path
+
+	def test_viterbi(self):
+		for start, stop in ((-1, -1), (0, -1), (1, 2)):
+			best = max(self.paths(start, stop), key=self.path_score)
+			path, score = self.decoder.viterbi(self.local, start=start, stop=stop)
+
+			self.assertEqual(tuple(path), best)
+			self.assertAlmostEqual(score, self.path_score(best))
+
+	def test_masked_states(self):
+		# -inf local scores take states out of the running at a position
+		self.local[1, :2] = float("-inf")
+		self.local[3, 2] = float("-inf")
+
+		best = max(self.paths(start=0), key=self.path_score)
+		path, score = self.decoder.viterbi(self.local, start=0)
+		self.assertEqual(tuple(path), best)
+		self.assertAlmostEqual(score, self.path_score(best))
+		self.assertTrue(path[1] >= 2 and path[3] != 2)
+
+	def test_beam(self):
+		path, score = self.decoder.viterbi(self.local, start=0)
+
+		# A beam as wide as the state space is exact
+		beam_path, beam_score = self.decoder.beam(self.local, self.state_count, start=0)
+		self.assertEqual(list(beam_path), list(path))
+		self.assertAlmostEqual(beam_score, score)
+
+		# A beam of one is greedy
+		greedy_path, greedy_score = self.decoder.beam(self.local, 1, start=0)
+		self.assertTrue(greedy_score <= score)
+		for pos in xrange(1, self.length):
+			successors = self.transitions[greedy_path[pos-1]] + self.local[pos]
+			self.assertEqual(greedy_path[pos], numpy.argmax(successors))
+
+	def test_forward_backward(self):
+		scores = [self.path_score(path) for path in self.paths(start=0)]
+		top = max(scores)
+		log_z = top + log(sum(exp(score - top) for score in scores))
+
+		decoded_log_z, posteriors = self.decoder.forward_backward(self.local, start=0)
+		self.assertAlmostEqual(decoded_log_z, log_z)
+		self.assertTrue(numpy.allclose(posteriors.sum(axis=1), 1.0))
+
+		expected = sum(exp(self.path_score(path) - log_z) for path in self.paths(start=0) if path[2] == 1)
+		self.assertAlmostEqual(posteriors[2, 1], expected)
+
+	def test_forward_backward_scaling(self):
+		# Scores far outside exp's range, a stop state and masked states
+		self.local = self.local * 400.0
+		self.local[3, 2] = float("-inf")
+
+		scores = [self.path_score(path) for path in self.paths(start=0, stop=1)]
+		top = max(scores)
+		log_z = top + log(sum(exp(score - top) for score in scores))
+
+		decoded_log_z, posteriors = self.decoder.forward_backward(self.local, start=0, stop=1)
+		self.assertAlmostEqual(decoded_log_z / log_z, 1.0)
+		self.assertTrue(numpy.allclose(posteriors.sum(axis=1), 1.0))
+		self.assertEqual(posteriors[3, 2], 0.0)
+
+		# Nothing gets through position 2
+		self.local[2, :] = float("-inf")
+		decoded_log_z, _ = self.decoder.forward_backward(self.local, start=0, stop=1)
+		self.assertEqual(decoded_log_z, float("-inf"))
+
+	def test_precision(self):
+		# Smaller tables decode the scores they can hold
+		for precision in ('float32', 'int16'):
+			decoder = ChainDecoder.from_matrix(self.transitions, precision=precision)
+			self.transitions = dequantize_scores(*quantize_scores(self.transitions, precision))
+
+			best = max(self.paths(start=0), key=self.path_score)
+			path, score = decoder.viterbi(self.local, start=0)
+			self.assertEqual(tuple(path), best)
+			self.assertAlmostEqual(score, self.path_score(best))
+
+			beam_path, _ = decoder.beam(self.local, self.state_count, start=0)
+			self.assertEqual(tuple(beam_path), best)
+
+		self.assertRaises(ValueError, ChainDecoder.from_matrix, self.transitions, precision='float16')
+
+	def test_state_ranges(self):
+		self.assertRaises(ValueError, ChainDecoder, 2, [0, 2], [1, 1], [0.0, 0.0])
+		self.assertRaises(ValueError, ChainDecoder, 2, [0, 1], [-1, 1], [0.0, 0.0])
+		self.assertRaises(ValueError, ChainDecoder, 2, [0, 1], [1], [0.0, 0.0])
+		self.assertEqual(ChainDecoder(2, [], [], []).transition_count, 0)
+
+	def test_edge_scores(self):
+		# Per-position transitions, given in edges() order
+		prev_states, next_states = self.decoder.edges()
+		tensor = [self.transitions * (pos + 1) for pos in xrange(self.length)]
+		edge_scores = numpy.array([matrix[prev_states, next_states] for matrix in tensor])
+
+		best = max(self.paths(), key=lambda path: self.path_score(path, tensor))
+		path, score = self.decoder.viterbi(self.local, edge_scores=edge_scores)
+		self.assertEqual(tuple(path), best)
+		self.assertAlmostEqual(score, self.path_score(best, tensor))
+
+		beam_path, _ = self.decoder.beam(self.local, self.state_count, edge_scores=edge_scores)
+		self.assertEqual(tuple(beam_path), best)
+
+	def test_predecessors(self):
+		for state in xrange(self.state_count):
+			expected = [(prev, self.transitions[prev, state]) for prev in xrange(self.state_count)
+						if self.transitions[prev, state] > float("-inf")]
+			self.assertEqual(self.decoder.predecessors(state), expected)
+
+	def test_max_plus_kernels_agree(self):
+		# benchmark_max_plus asserts the blocked and scalar kernels pick the
+		# same maxima
+		cychain.benchmark_max_plus(label_count=60, width=7, iterations=2)
+
+class StreamingDecoderTest(unittest.TestCase):
+	state_count = 5
+	length = 40
+
+	def setUp(self):
+		random.seed(0)
+		self.transitions = numpy.array([[log(random.random()) for _ in xrange(self.state_count)]
+										for _ in xrange(self.state_count)])
+		self.local = numpy.array([[log(random.random()) for _ in xrange(self.state_count)]
+								  for _ in xrange(self.length)])
+		self.decoder = ChainDecoder.from_matrix(self.transitions)
+
+	def stream(self, stream, rows, stop=-1):
+		committed = list()
+		for row in rows:
+			states = stream.push(row)
+			self.assertTrue(stream.pending <= stream.lag)
+			committed.append(states)
+		committed.append(stream.finish(stop))
+		return committed
+
+	def test_long_lag_is_exact(self):
+		path, _ = self.decoder.viterbi(self.local)
+		committed = self.stream(StreamingDecoder(self.decoder, lag=self.length), self.local)
+		self.assertEqual(sum(committed, []), list(path))
+
+		# Paths converge long before the end of the chain
+		self.assertTrue(sum(len(states) for states in committed[:-1]) > 0)
+
+	def test_anchored(self):
+		path, _ = self.decoder.viterbi(self.local, start=0, stop=2)
+		stream = StreamingDecoder(self.decoder, start=0, lag=self.length)
+		self.assertEqual(sum(self.stream(stream, self.local[1:], stop=2), []), list(path[1:]))
+
+		# The decoder resets after finish
+		self.assertEqual(sum(self.stream(stream, self.local[1:], stop=2), []), list(path[1:]))
+
+		# finish reads the stop state's score, so it must be a state
+		stream.push(self.local[1])
+		self.assertRaises(ValueError, stream.finish, self.state_count)
+		self.assertRaises(ValueError, stream.finish, -2)
+
+	def test_short_lag(self):
+		# stream() checks nothing waits more than the lag
+		committed = self.stream(StreamingDecoder(self.decoder, lag=2), self.local)
+		self.assertEqual(len(sum(committed, [])), self.length)
+		self.assertTrue(len(committed[-1]) <= 2)
+
+if __name__ == "__main__":
+	unittest.main()
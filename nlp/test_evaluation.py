@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+
+from evaluation import evaluate
+from hmm import HiddenMarkovModel
+
+class UpperTagger(object):
+	"""
+	Tags each word with its upper case, except 'x', which it calls 'Y'
+	"""
+	def label(self, emissions):
+		return ['Y' if emission == 'x' else emission.upper() for emission in emissions]
+
+class EvaluateTest(unittest.TestCase):
+	sentences = [(['A', 'B', 'X'], ['a', 'b', 'x']), (['X', 'X'], ['x', 'x']), (['C'], ['c'])]
+
+	def test_metrics(self):
+		evaluation = evaluate(UpperTagger(), self.sentences, processes=1, known_emissions=set(['a', 'b', 'x']))
+
+		self.assertEqual((evaluation.tokens, evaluation.sentences), (6, 3))
+		self.assertAlmostEqual(evaluation.accuracy, 3.0 / 6.0)
+		self.assertEqual(evaluation.unknown_accuracy, 1.0)
+		self.assertEqual(evaluation.confusions(), [('X', 'Y', 3)])
+		self.assertEqual(evaluation.confusion.sum(), 6)
+
+		self.assertEqual(len(evaluation.latencies), 3)
+		self.assertTrue(0.0 <= evaluation.latency(50) <= evaluation.latency(99))
+		self.assertTrue(evaluation.tokens_per_second > 0)
+		self.assertTrue("3 correct" in evaluation.report())
+
+		self.assertEqual(evaluate(UpperTagger(), self.sentences, processes=1).unknown_accuracy, None)
+
+	def test_process_pool(self):
+		sequence = [('N', 'fish'), ('V', 'can'), ('V', 'fish'), ('N', 'fish'), ('V', 'can'),
+					('N', 'dogs'), ('V', 'fish'), ('N', 'fish'), ('V', 'can'), ('V', 'fish')]
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(sequence, fallback_model=None)
+
+		labels, emissions = zip(*sequence)
+		sentences = [(labels[:length], emissions[:length]) for length in xrange(1, len(labels) + 1)]
+
+		serial = evaluate(model, sentences, processes=1)
+		parallel = evaluate(model, sentences, processes=2, chunk_size=3)
+		self.assertEqual(parallel.labels, serial.labels)
+		self.assertTrue(numpy.array_equal(parallel.guessed, serial.guessed))
+		self.assertTrue(numpy.array_equal(parallel.confusion, serial.confusion))
+
+if __name__ == "__main__":
+	unittest.main()
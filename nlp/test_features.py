@@ -33,6 +33,28 @@ class NGramTest(unittest.TestCase):
 			self.assertTrue(f in expected_features)
 
 
+class FeatureHashTest(unittest.TestCase):
+	def test_feature_hash(self):
+		bucket, sign = features.feature_hash(['h', 'e'], 16)
+		self.assertTrue(0 <= bucket < 16)
+		self.assertTrue(sign in (1.0, -1.0))
+
+		# Stable, and ngrams hash as their joined chunks, not their concatenation
+		self.assertEqual(features.feature_hash(('h', 'e'), 16), (bucket, sign))
+		self.assertEqual(features.feature_hash(['he'], 1 << 20), features.feature_hash('he', 1 << 20))
+		self.assertNotEqual(features.feature_hash(['h', 'e'], 1 << 20), features.feature_hash('he', 1 << 20))
+
+	def test_hashed_ngrams(self):
+		test_string = "hello"
+		hashed = list(features.ngrams(test_string, 2, buckets=8))
+		expected = [features.feature_hash(gram, 8)[0] for gram in features.ngrams(test_string, 2)]
+
+		self.assertEqual([bucket for bucket, _ in hashed], expected)
+		self.assertEqual(set(value for _, value in hashed), set([1.0]))
+
+		signs = [features.feature_hash(gram, 8)[1] for gram in features.ngrams(test_string, 2)]
+		self.assertEqual([value for _, value in features.ngrams(test_string, 2, buckets=8, signed=True)], signs)
+
 class ContextTest(unittest.TestCase):
 	def test_three_context(self):
 		test_string = "godspeed"
@@ -1,9 +1,35 @@
 from itertools import cycle, izip, repeat
 from math import log, exp
+import os
 from pprint import pformat
+import random
+import shutil
+import tempfile
 import unittest
 
-from hmm import HiddenMarkovModel, START_LABEL, STOP_LABEL
+import numpy
+
+from artifactcache import ArtifactCache
+from counter import Counter
+from hmm import CollapsedFallback, HiddenMarkovModel, START_LABEL, STOP_LABEL
+from unknownwords import UnknownWordModel
+
+class CountingFallback(object):
+	"""
+	Uniform fallback model that counts how often it's trained
+	"""
+	trained = 0
+
+	def train(self, labeled_data):
+		CountingFallback.trained += 1
+		self.pairs = list(labeled_data)
+		self.labels = sorted(set(label for label, _ in self.pairs))
+
+	def label_distribution(self, emission):
+		distribution = Counter()
+		for label in self.labels:
+			distribution[label] = log(1.0 / len(self.labels))
+		return distribution
 
 class ScoreLabelTest(unittest.TestCase):
 
@@ -74,6 +100,7 @@ class ScoreLabelTest(unittest.TestCase):
 		if debug: print "Guessed score: %f" % guessed_score
 		self.assertAlmostEqual(guessed_score, score, 4)
 		self.assertAlmostEqual(score, labelling_score, 4)
+		self.assertAlmostEqual(model.score_many([zip(guessed_labels, emissions)])[0], score, 4)
 		
 	def setUp(self):
 		self.defaults = {START_LABEL : float("-inf"), STOP_LABEL : float("-inf")}
@@ -252,6 +279,375 @@ class TrainingLabellingTest(unittest.TestCase):
 		self.assertEqual(model.label(alternating(6)), [label for label, _ in alternating(6)])
 
 
+class SparseDecoderTest(unittest.TestCase):
+	def test_only_history_consistent_predecessors(self):
+		sequence = (('A', 'A'), ('B', 'B'),
+					('A', 'A'), ('B', 'B'),
+					('A', 'A'), ('B', 'B'))
+
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(sequence, fallback_model=None, use_linear_smoothing=False)
+
+		self.assertEqual(model.cyhmm.predecessors('B::A'), [('A::B', log(2.0 / 3.0))])
+		self.assertEqual(set(label for label, _ in model.cyhmm.predecessors('A::B')),
+						 set(['<START>::A', 'B::A']))
+		self.assertTrue(all(label.split('::')[1:] == state.split('::')[:-1]
+							for state in model.labels
+							for label, _ in model.cyhmm.predecessors(state)))
+		self.assertTrue(model.cyhmm.transition_count < len(model.labels) ** 2)
+
+
+class BatchLabellingTest(unittest.TestCase):
+	def test_label_many_matches_label(self):
+		alternating = lambda n: [(l, e) for l, e, _ in izip(cycle(('A', 'B')), cycle(('A', 'B')),
+															xrange(n))]
+
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(alternating(6), fallback_model=None, use_linear_smoothing=False)
+
+		sequences = [[emission for _, emission in alternating(n)] for n in xrange(1, 12)]
+		sequences.append(['A', 'C', 'B'])
+
+		self.assertEqual(model.label_many(sequences, threads=4),
+						 [model.label(sequence) for sequence in sequences])
+
+		# A beam as wide as the state space decodes exactly
+		self.assertEqual(model.label_many(sequences, beam_size=len(model.labels)),
+						 [model.label(sequence) for sequence in sequences])
+
+	def test_score_matches_decoder(self):
+		sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'),
+					('A', 'a'), ('B', 'b'), ('A', 'b'))
+
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(sequence, fallback_model=None)
+
+		emissions = ['a', 'b', 'a', 'b']
+		labels, lattice_score = model.cyhmm.label(model, emissions, return_score=True)
+		self.assertAlmostEqual(model.score(zip(labels, emissions)), lattice_score)
+
+	def test_score_many_matches_score(self):
+		sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'),
+					('A', 'a'), ('B', 'b'), ('A', 'b'))
+		batch = [[('A', 'a'), ('B', 'b')],
+				 [('A', 'a'), ('B', 'b'), ('B', 'a'), ('A', 'b')],
+				 [('B', 'b'), ('B', 'c'), ('A', 'a')],
+				 [('A', 'a'), ('C', 'a')],
+				 []]
+
+		for history in (1, 2):
+			model = HiddenMarkovModel(label_history_size=history)
+			model.train(sequence, fallback_model=None)
+
+			scores = model.score_many(batch)
+			self.assertEqual(len(scores), len(batch))
+			for labeled, score in zip(batch, scores):
+				expected = model.score(labeled)
+				if expected == float("-inf"):
+					self.assertEqual(score, expected)
+				else:
+					self.assertAlmostEqual(score, expected)
+
+	def test_workspace_reused(self):
+		model = HiddenMarkovModel(label_history_size=1)
+		model.train(zip(repeat('A', 6), repeat('A', 6)), use_linear_smoothing=False)
+
+		model.label(list(repeat('A', 20)))
+		workspace = model.cyhmm.workspace()
+		capacity = workspace.capacity
+
+		model.label(list(repeat('A', 3)))
+		self.assertTrue(model.cyhmm.workspace() is workspace)
+		self.assertEqual(workspace.capacity, capacity)
+
+
+class StreamingLabellerTest(unittest.TestCase):
+	sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'), ('A', 'a'), ('B', 'b'),
+				('A', 'b'), ('A', 'a'), ('B', 'a'), ('B', 'b'), ('A', 'a'))
+
+	def stream(self, labeller, emissions):
+		tags = list()
+		for emission in emissions:
+			tags.extend(labeller.push(emission))
+		early = len(tags)
+		return tags + labeller.finish(), early
+
+	def test_streaming_matches_label(self):
+		for history in (1, 2):
+			model = HiddenMarkovModel(label_history_size=history)
+			model.train(self.sequence, fallback_model=None)
+			labeller = model.streaming_labeller(lag=100)
+
+			for emissions in (['a'], ['a', 'b', 'a', 'a', 'b', 'b', 'a'], list('ab' * 20)):
+				# Ties may break differently, so compare path scores
+				tags, _ = self.stream(labeller, emissions)
+				self.assertAlmostEqual(model.score(zip(tags, emissions)),
+									   model.score(zip(model.label(emissions), emissions)))
+
+	def test_tags_before_finish(self):
+		model = HiddenMarkovModel(label_history_size=1)
+		model.train(self.sequence, fallback_model=None)
+
+		emissions = list('ab' * 20)
+		tags, early = self.stream(model.streaming_labeller(lag=3), emissions)
+		self.assertEqual(len(tags), len(emissions))
+		self.assertTrue(early >= len(emissions) - 3)
+
+class TagDictionaryTest(unittest.TestCase):
+	# "can" is always a verb after a noun, "fish" both a noun and a verb;
+	# "dogs" is rare
+	sequence = [('N', 'fish'), ('V', 'can'), ('V', 'fish'), ('N', 'fish'), ('V', 'can'),
+				('N', 'dogs'), ('V', 'fish'), ('N', 'fish'), ('V', 'can'), ('V', 'fish')]
+
+	def test_dictionary(self):
+		model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=3)
+		model.train(self.sequence, fallback_model=None)
+
+		self.assertEqual(model.tag_dictionary['fish'], frozenset(['N', 'V']))
+		self.assertEqual(model.tag_dictionary['can'], frozenset(['V']))
+		self.assertFalse('dogs' in model.tag_dictionary)
+
+		self.assertEqual(model.candidate_states('dogs'), None)
+		self.assertEqual(sorted(model.candidate_states('can')),
+						 sorted(label for label in model.labels if label.endswith('::V')))
+
+		model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=None)
+		model.train(self.sequence, fallback_model=None)
+		self.assertEqual(model.tag_dictionary, dict())
+
+	def test_constrained_decoders_agree(self):
+		for history in (1, 2):
+			model = HiddenMarkovModel(label_history_size=history, tag_dictionary_threshold=2)
+			model.train(self.sequence, fallback_model=None)
+
+			for emissions in (['fish', 'can', 'fish'], [emission for _, emission in self.sequence]):
+				labels = model.label(emissions)
+				self.assertEqual(model._label(emissions), labels)
+				self.assertTrue(all(label in model.tag_dictionary[emission]
+									for label, emission in zip(labels, emissions)
+									if emission in model.tag_dictionary))
+
+class CoarseToFineTest(unittest.TestCase):
+	sequence = TagDictionaryTest.sequence + [('<STOP>', '<STOP>'), ('<START>', '<START>'),
+											 ('N', 'dogs'), ('V', 'can'), ('V', 'fish')]
+
+	def train(self, **kwargs):
+		model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=None, **kwargs)
+		model.train(self.sequence, fallback_model=None)
+		return model
+
+	def test_coarse_model(self):
+		self.assertEqual(self.train().coarse_model, None)
+
+		model = HiddenMarkovModel(label_history_size=1, coarse_threshold=0.01)
+		model.train(self.sequence, fallback_model=None)
+		self.assertEqual(model.coarse_model, None)
+
+		coarse = self.train(coarse_threshold=0.01).coarse_model
+		self.assertEqual(coarse.label_history_size, 1)
+		self.assertEqual(sorted(coarse.labels), sorted(['N', 'V', '<START>', '<STOP>']))
+		self.assertEqual(coarse.emission_counts['V']['can'], 4.0)
+		self.assertEqual(coarse.transition_counts[0]['N']['V'], 5.0)
+
+	def test_coarse_fallback(self):
+		model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=None, coarse_threshold=0.01)
+		model.train(self.sequence, fallback_model=UnknownWordModel)
+		fine, coarse = model.fallback_emissions_model, model.coarse_model.fallback_emissions_model
+
+		# The fine fallback's probabilities summed over histories
+		self.assertEqual(coarse.labels, ['N', 'V'])
+		fine_scores = fine.label_distribution('zebras')
+		for label in coarse.labels:
+			expected = sum(exp(score) for full_label, score in fine_scores.iteritems() if full_label.endswith(label))
+			self.assertAlmostEqual(exp(coarse.label_distribution('zebras')[label]), expected)
+
+		# Also for fallback models without collapsed()
+		collapsed = CollapsedFallback(fine, model.state_space.last_label_of)
+		for label in coarse.labels:
+			self.assertAlmostEqual(collapsed.label_distribution('zebras')[label], coarse.label_distribution('zebras')[label])
+
+		self.assertEqual(self.train(coarse_threshold=0.01).coarse_model.fallback_emissions_model, None)
+
+	def test_tag_mask(self):
+		model = self.train(coarse_threshold=0.5)
+		emissions = ['dogs', 'can', 'fish']
+		tag_mask = model.coarse_tag_mask(emissions)
+
+		# Padded for the first order model; positions past its end are free
+		self.assertEqual(tag_mask.shape, (len(emissions) + 2, len(model.state_space.labels)))
+		label_idx = model.state_space.label_idx
+		self.assertTrue(tag_mask[2, label_idx['V']])
+		self.assertFalse(tag_mask[2, label_idx['N']])
+
+	def test_agrees_with_exact(self):
+		exact = self.train()
+		emission_sequences = [['fish', 'can', 'fish'], ['dogs', 'can', 'fish', 'fish'],
+							  [emission for _, emission in TagDictionaryTest.sequence]]
+
+		for threshold in (1e-6, 1.0):
+			# Pruning everything falls back to the full decode
+			model = self.train(coarse_threshold=threshold)
+			expected = [exact.label(emissions) for emissions in emission_sequences]
+
+			self.assertEqual([model.label(emissions) for emissions in emission_sequences], expected)
+			self.assertEqual(model.label_many(emission_sequences, threads=2), expected)
+
+class LatencyBudgetTest(unittest.TestCase):
+	def setUp(self):
+		# Enough labels that a narrow beam is much cheaper than the lattice
+		rng = random.Random(0)
+		labels = 'ABCDEFG'
+		sequence = [(label, label.lower() * rng.randint(1, 3)) for label in (rng.choice(labels) for _ in xrange(500))]
+
+		self.model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=None)
+		self.model.train(sequence)
+		# Unknown words keep every state live
+		self.emissions = ['a', 'zebras', 'bb', 'quux', 'blorp', 'c', 'ddd']
+
+	def test_modes(self):
+		exact = self.model.label(self.emissions)
+		self.assertEqual(self.model.label_within(self.emissions), (exact, 'exact', None))
+
+		# No room for anything: the best step out of each position
+		labelling, mode, beam_size = self.model.label_within(self.emissions, max_operations=0)
+		self.assertEqual((mode, beam_size), ('greedy', 1))
+		self.assertEqual(labelling, self.model.label(self.emissions, beam_size=1))
+
+		# Enough for a beam of two, but not everything
+		length = len(self.emissions) + 3
+		budget = length * (len(self.model.labels) + 2.5 * float(self.model.cyhmm.transition_count) / len(self.model.labels))
+		labelling, mode, beam_size = self.model.label_within(self.emissions, max_operations=budget)
+		self.assertEqual((mode, beam_size), ('beam', 2))
+		self.assertEqual(labelling, self.model.label(self.emissions, beam_size=2))
+
+	def test_time_budget(self):
+		# Calibrated with the model, not by the first budgeted call
+		self.assertTrue(self.model.cyhmm.operation_rate > 0.0)
+		self.assertEqual(self.model.label_within(self.emissions, max_seconds=60.0)[1:], ('exact', None))
+
+		# Already out of time
+		self.assertEqual(self.model.label_within(self.emissions, max_seconds=0.0)[1:], ('greedy', 1))
+
+class SamplingTest(unittest.TestCase):
+	def test_sample_many_follows_model(self):
+		sequence = [('A', 'a'), ('B', 'b'), ('A', 'a'), ('B', 'b'), ('A', 'a'), ('B', 'c')]
+		model = HiddenMarkovModel(label_history_size=1)
+		model.train(sequence, fallback_model=None, use_linear_smoothing=False)
+
+		samples = model.sample_many(2000, max_length=50, rng=0)
+		self.assertEqual(len(samples), 2000)
+
+		b_count = 0
+		for sample in samples:
+			labels = [label for label, _ in sample]
+			self.assertEqual(labels, ['A', 'B'] * (len(labels) / 2))
+			self.assertTrue(all(emission == 'a' for label, emission in sample if label == 'A'))
+			b_count += labels.count('B')
+
+		# p(<STOP> | B) = 1/3, p(c | B) = 1/3
+		self.assertAlmostEqual(float(len(samples)) / b_count, 1.0 / 3.0, delta=0.03)
+		c_count = sum(1 for sample in samples for _, emission in sample if emission == 'c')
+		self.assertAlmostEqual(float(c_count) / b_count, 1.0 / 3.0, delta=0.03)
+
+	def test_sample_many_seeded(self):
+		sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'), ('A', 'a'), ('B', 'b'), ('A', 'b'))
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(sequence, fallback_model=None)
+
+		self.assertEqual(model.sample_many(20, rng=1), model.sample_many(20, rng=numpy.random.RandomState(1)))
+
+		self.assertTrue(all(model.score(sample) > float("-inf") for sample in model.sample_many(200, rng=2)))
+		self.assertTrue(all(len(sample) <= 3 for sample in model.sample_many(200, max_length=3, rng=2)))
+
+class CompiledModelTest(unittest.TestCase):
+	sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'),
+				('A', 'a'), ('B', 'b'), ('A', 'b'))
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "model.hmm")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_compiled_model_matches(self):
+		sequences = [['a', 'b', 'a', 'b'], ['b', 'b'], ['a', 'c', 'b'], []]
+
+		for history in (1, 2, 3):
+			model = HiddenMarkovModel(label_history_size=history)
+			model.train(self.sequence, fallback_model=None)
+			model.compile(self.path)
+
+			compiled = HiddenMarkovModel.load_compiled(self.path)
+			self.assertTrue(compiled.compiled)
+			self.assertEqual(compiled.cyhmm.transition_count, model.cyhmm.transition_count)
+
+			for emissions in sequences:
+				labels = model.label(emissions)
+				self.assertEqual(compiled.label(emissions), labels)
+				self.assertAlmostEqual(compiled.score(zip(labels, emissions)), model.score(zip(labels, emissions)))
+
+			finite = lambda scores: dict((state, score) for state, score in scores.iteritems() if score > float("-inf"))
+			self.assertEqual(finite(compiled.emission_scores('a')), finite(model.emission_scores('a')))
+
+	def test_coarse_model_compiled(self):
+		model = HiddenMarkovModel(label_history_size=2, tag_dictionary_threshold=None, coarse_threshold=0.5)
+		model.train(CoarseToFineTest.sequence, fallback_model=UnknownWordModel)
+		model.compile(self.path)
+
+		compiled = HiddenMarkovModel.load_compiled(self.path)
+		self.assertEqual(compiled.coarse_threshold, 0.5)
+		self.assertTrue(compiled.coarse_model.compiled)
+		self.assertEqual(compiled.coarse_model.fallback_emissions_model.labels, ['N', 'V'])
+
+		for emissions in (['dogs', 'can', 'fish'], ['zebras', 'can', 'fish']):
+			self.assertTrue(numpy.array_equal(compiled.coarse_tag_mask(emissions), model.coarse_tag_mask(emissions)))
+			self.assertEqual(compiled.label(emissions), model.label(emissions))
+
+		# Models without one still load without one
+		plain = HiddenMarkovModel(label_history_size=2)
+		plain.train(self.sequence, fallback_model=None)
+		plain.compile(self.path)
+		self.assertEqual(HiddenMarkovModel.load_compiled(self.path).coarse_model, None)
+
+	def test_tables_are_mapped(self):
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(self.sequence, fallback_model=None)
+		model.compile(self.path)
+
+		transitions = HiddenMarkovModel.load_compiled(self.path).score_tables()[0]
+		self.assertTrue(isinstance(transitions, numpy.memmap))
+		self.assertFalse(transitions.flags.writeable)
+
+	def test_quantized_tables(self):
+		sequences = [['a', 'b', 'a', 'b'], ['b', 'b'], ['a', 'c', 'b']]
+		check = [zip(['A', 'B', 'A', 'B'], sequences[0]), zip(['B', 'A'], sequences[1])]
+
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(self.sequence, fallback_model=None)
+
+		for precision, ratio, tolerance in (('float32', 2, 1e-6), ('int16', 4, 1e-3)):
+			report = model.compile(self.path, precision=precision, check_sequences=check)
+			self.assertEqual(report['precision'], precision)
+			full_bytes, stored_bytes = report['table_bytes']
+			self.assertEqual(full_bytes, ratio * stored_bytes)
+			self.assertTrue(0.0 < report['max_transition_error'] < tolerance)
+			self.assertEqual(report['tokens'], 6)
+			self.assertEqual(report['agreement'], 1.0)
+			self.assertEqual(report['compiled_accuracy'], report['accuracy'])
+
+			compiled = HiddenMarkovModel.load_compiled(self.path)
+			self.assertEqual(compiled.score_tables()[0].dtype, numpy.dtype(precision))
+
+			for emissions in sequences:
+				labels = model.label(emissions)
+				self.assertEqual(compiled.label(emissions), labels)
+				self.assertAlmostEqual(compiled.score(zip(labels, emissions)), model.score(zip(labels, emissions)),
+									   delta=10 * tolerance)
+
+		self.assertRaises(ValueError, model.compile, self.path, precision='float16')
+
+
 class TrainingTest(unittest.TestCase):
 	""" Test that training produces expected probability outcomes
 	"""
@@ -355,10 +751,81 @@ class TrainingTest(unittest.TestCase):
 		self.assertEqual(model.transition['<START>::A::B::A']['A::B::A::B'], 0.0)
 		self.assertEqual(model.transition['A::B::A::B']['B::A::B::A'], log(0.5))
 
+	def test_sentence_boundaries(self):
+		# Every sentence end gets label_history_size stops, not just the last
+		model = HiddenMarkovModel(label_history_size=2)
+		sequence = [('N', 'dogs'), ('V', 'bark'), ('<STOP>', '<STOP>'), ('<START>', '<START>'), ('N', 'dogs')]
+		labels = [label for label, _ in model._pad_boundaries(model._pad_sequence(sequence, pairs=True))]
+		boundary = labels.index('<START>', 2)
+		self.assertEqual(labels[boundary-3:boundary+2], ['V', '<STOP>', '<STOP>', '<START>', 'N'])
+
+		model.train(sequence)
+		self.assertEqual(model.transition_counts[1]['V::<STOP>']['<STOP>::<STOP>'], 1.0)
+
+
+class IncrementalTrainingTest(unittest.TestCase):
+	sequence = (('A', 'A'), ('B', 'B'), ('B', 'C'),
+				('A', 'A'), ('B', 'B'), ('A', 'C'))
+
+	def test_train_from_generator(self):
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train((pair for pair in self.sequence), fallback_model=None)
+
+		reference = HiddenMarkovModel(label_history_size=2)
+		reference.train(self.sequence, fallback_model=None)
+
+		self.assertEqual(model.token_count, len(self.sequence) + 3)
+		self.assertEqual(dict(model.transition['A::B']), dict(reference.transition['A::B']))
+		self.assertEqual(dict(model.label_emissions['C']), dict(reference.label_emissions['C']))
+
+	def test_partial_fit(self):
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(self.sequence, fallback_model=None)
+		model.partial_fit(iter(self.sequence))
+
+		reference = HiddenMarkovModel(label_history_size=2)
+		reference.train(self.sequence, fallback_model=None)
+
+		# Seeing the same data twice doubles the counts but not the distributions
+		self.assertEqual(model.emission_counts['A::B']['B'], 2 * reference.emission_counts['A::B']['B'])
+		for history in reference.transition:
+			for next_label, score in reference.transition[history].iteritems():
+				self.assertAlmostEqual(model.transition[history][next_label], score)
+		self.assertAlmostEqual(model.label_emissions['C']['B::A'], reference.label_emissions['C']['B::A'])
+		self.assertEqual(model.label(['A', 'B', 'C']), reference.label(['A', 'B', 'C']))
+
+	def test_partial_fit_new_labels(self):
+		model = HiddenMarkovModel(label_history_size=1)
+		model.train(self.sequence, fallback_model=None, use_linear_smoothing=False)
+		model.partial_fit([('D', 'D'), ('D', 'D'), ('D', 'D')], use_linear_smoothing=False)
+
+		self.assertTrue('D' in model.labels)
+		self.assertEqual(model.label(['D', 'D']), ['D', 'D'])
+
+	def test_partial_fit_keeps_smoothing(self):
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(self.sequence, fallback_model=None, use_linear_smoothing=False)
+		model.partial_fit(iter(self.sequence))
+
+		# Unsmoothed transitions stay the maximum likelihood estimates
+		self.assertEqual(dict(model.transition), dict(model.fallback_transition[-1]))
+
 
 class HMMSmoothingTest(unittest.TestCase):
 	def test_linear_smoothing_training(self):
-		pass
+		sequence = (('A', 'A'), ('B', 'B'), ('B', 'B'),
+					('A', 'A'), ('B', 'B'), ('A', 'A'))
+
+		model = HiddenMarkovModel(label_history_size=2)
+		model.train(sequence, fallback_model=None, use_linear_smoothing=True)
+
+		# p(B::A | A::B) = 0.9 * p(B::A | A::B) + 0.1 * p(B::A | B)
+		self.assertAlmostEqual(exp(model.transition['A::B']['B::A']), 0.9 * 0.5 + 0.1 * (2.0 / 3.0))
+		self.assertAlmostEqual(exp(model.transition['A::B']['B::B']), 0.9 * 0.5 + 0.1 * (1.0 / 3.0))
+		self.assertAlmostEqual(sum(exp(score) for score in model.transition['B::B'].itervalues()), 1.0)
+
+		# Only observed histories are materialized
+		self.assertEqual(set(model.transition.iterkeys()), set(model.fallback_transition[-1].iterkeys()))
 
 	def test_linear_smoothing_no_op(self):
 		pass
@@ -367,10 +834,124 @@ class HMMSmoothingTest(unittest.TestCase):
 		pass
 
 	def test_linear_smoothing_triple_history(self):
-		pass
+		sequence = (('A', 'A'), ('B', 'B'), ('A', 'A'), ('A', 'A'), ('B', 'B'),
+					('A', 'A'), ('A', 'A'), ('A', 'A'))
+
+		model = HiddenMarkovModel(label_history_size=3)
+		model.train(sequence, fallback_model=None, use_linear_smoothing=True)
+
+		# p(. | B::A::A) = 0.8 p(. | B::A::A) + 0.1 p(. | A::A) + 0.1 p(. | A)
+		# where p(B | A) sums over <START>::A::B and A::A::B
+		self.assertAlmostEqual(exp(model.transition['B::A::A']['A::A::B']),
+							   0.8 * 0.5 + 0.1 * (1.0 / 3.0) + 0.1 * (1.0 / 3.0))
+		self.assertAlmostEqual(exp(model.transition['B::A::A']['A::A::<STOP>']),
+							   0.1 * (1.0 / 3.0) + 0.1 * (1.0 / 6.0))
+		self.assertTrue(all(next_label.split('::')[:-1] == history.split('::')[1:]
+							for history, row in model.transition.iteritems()
+							for next_label in row.iterkeys()))
 
 	def test_fallback_emission_model(self):
-		pass
+		sequence = [('V', 'walking'), ('D', 'the'), ('N', 'dog'), ('V', 'talking'), ('D', 'the'),
+					('N', 'cat'), ('V', 'running'), ('D', 'the'), ('N', 'dog')]
+		directory = tempfile.mkdtemp()
+
+		try:
+			model = HiddenMarkovModel(label_history_size=1, cache=ArtifactCache(directory, verbose=False))
+			model.train(sequence, fallback_model=UnknownWordModel, use_linear_smoothing=False)
+		finally:
+			shutil.rmtree(directory)
+
+		# The decoder reads the fallback's signature rows directly; scoring
+		# goes through emission_scores, and the two agree
+		emissions = ['jumping', 'the', 'dog']
+		labels, lattice_score = model.cyhmm.label(model, emissions, return_score=True)
+		self.assertEqual(labels, ['V', 'D', 'N'])
+		self.assertAlmostEqual(model.score(zip(labels, emissions)), lattice_score)
+		self.assertTrue(model.emission_scores('jumping') is model.emission_scores('singing'))
+
+
+class FallbackCacheTest(unittest.TestCase):
+	sequence = (('A', 'a'), ('B', 'b'), ('B', 'a'), ('A', 'b'))
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cache = ArtifactCache(self.directory, verbose=False)
+		CountingFallback.trained = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def train(self, sequence):
+		model = HiddenMarkovModel(label_history_size=1, cache=self.cache)
+		model.train(sequence, fallback_model=CountingFallback, use_linear_smoothing=False)
+		return model
+
+	def test_fallback_model_cached_by_data(self):
+		first = self.train(self.sequence)
+		second = self.train(self.sequence)
+		self.assertEqual(CountingFallback.trained, 1)
+		self.assertEqual(second.fallback_emissions_model.labels, first.fallback_emissions_model.labels)
+		self.assertEqual(second.label(['a', 'c']), first.label(['a', 'c']))
+
+		# Same length, different data
+		swapped = [(label, emission.upper()) for label, emission in self.sequence]
+		self.train(swapped)
+		self.assertEqual(CountingFallback.trained, 2)
+
+		model = HiddenMarkovModel(label_history_size=1, cache=self.cache)
+		model.train(self.sequence, fallback_model=CountingFallback, fallback_training_limit=2,
+					use_linear_smoothing=False)
+		self.assertEqual(CountingFallback.trained, 3)
+
+	def test_partial_fit_keeps_fallback(self):
+		model = self.train(self.sequence)
+		fallback = model.fallback_emissions_model
+
+		model.partial_fit(self.sequence)
+		self.assertEqual(CountingFallback.trained, 1)
+		self.assertTrue(model.fallback_emissions_model is fallback)
+
+		model.partial_fit([('C', 'c')], retrain_fallback=True)
+		self.assertEqual(CountingFallback.trained, 2)
+		self.assertEqual(model.fallback_emissions_model.labels, ['A', 'B', 'C'])
+
+	def test_limit_in_corpus_order(self):
+		# The limit takes the first tokens, not the first states' counts
+		sequence = [('B', 'b'), ('C', 'c')] + [('A', 'a')] * 5
+		model = HiddenMarkovModel(label_history_size=1, cache=self.cache)
+		model.train(sequence, fallback_model=CountingFallback, fallback_training_limit=3,
+					use_linear_smoothing=False)
+		self.assertEqual(model.fallback_emissions_model.pairs, [('B', 'b'), ('C', 'c'), ('A', 'a')])
+
+
+class EmissionCacheTest(unittest.TestCase):
+	def test_fallbacks_cached_per_model(self):
+		sequence = zip(repeat('A', 6), repeat('A', 6))
+
+		first = HiddenMarkovModel(label_history_size=1, emission_cache_size=1)
+		first.train(sequence, fallback_model=None, use_linear_smoothing=False)
+		second = HiddenMarkovModel(label_history_size=1)
+		second.train(sequence, fallback_model=None, use_linear_smoothing=False)
+
+		first.emission_scores('X')
+		first.emission_scores('X')
+		first.emission_scores('Y')
+		self.assertEqual(first.emission_cache.stats()['hits'], 1)
+		self.assertEqual(first.emission_cache.stats()['evictions'], 1)
+		self.assertEqual(len(second.emission_cache), 0)
+
+		# Known emissions come straight from the trained tables
+		first.emission_scores('A')
+		self.assertFalse('A' in first.emission_cache)
+
+	def test_retraining_invalidates(self):
+		model = HiddenMarkovModel(label_history_size=1)
+		model.train(zip(repeat('A', 6), repeat('A', 6)), use_linear_smoothing=False)
+		model.emission_scores('X')
+
+		model.train(zip(repeat('B', 6), repeat('B', 6)), use_linear_smoothing=False)
+		self.assertEqual(len(model.emission_cache), 0)
+		self.assertTrue('B' in model.emission_scores('X'))
 
 
 class HMMUtilityTest(unittest.TestCase):
@@ -0,0 +1,78 @@
+from itertools import product
+import unittest
+
+import numpy
+
+from counter import Counter
+from memm import MaxEntMarkovModel
+
+class MaxEntMarkovModelTest(unittest.TestCase):
+	# "can" and "fish" are nouns after determiners and verbs after nouns
+	tagged_sentences = [(['DT', 'NN', 'VB'], ['the', 'fish', 'can']),
+						(['DT', 'NN', 'VB'], ['the', 'can', 'fish']),
+						(['NN', 'VB', 'NN'], ['fish', 'can', 'fish']),
+						(['DT', 'NN', 'VB', 'DT', 'NN'], ['a', 'dog', 'can', 'the', 'fish']),
+						(['NN', 'VB'], ['dogs', 'fish'])]
+
+	@classmethod
+	def setUpClass(cls):
+		cls.model = MaxEntMarkovModel()
+		cls.model.train(cls.tagged_sentences)
+
+	def test_local_distributions(self):
+		distributions = self.model.local_distributions(self.model.observation_features(['the', 'can'], 1))
+
+		self.assertEqual(distributions.shape, (len(self.model.labels) + 1, len(self.model.labels)))
+		self.assertTrue(numpy.allclose(numpy.exp(distributions).sum(axis=1), 1.0))
+
+		# Same distributions as the classifier, one previous tag at a time
+		features = self.model.observation_features(['the', 'can'], 1) + [self.model.previous_feature('DT')]
+		log_probs = self.model.classifier.get_log_probabilities(Counter((feature, 1.0) for feature in features))
+		for label, score in zip(self.model.labels, distributions[self.model.labels.index('DT')]):
+			self.assertAlmostEqual(score, log_probs[label])
+
+	def test_label(self):
+		for tags, sentence in self.tagged_sentences:
+			self.assertEqual(self.model.label(sentence), tags)
+		self.assertEqual(self.model.label([]), [])
+
+	def test_viterbi_is_exact(self):
+		sentence = ['the', 'fish', 'can', 'fish']
+		labels, score = self.model.label(sentence, return_score=True)
+
+		best = max(product(self.model.labels, repeat=len(sentence)),
+				   key=lambda labels: self.model.score(labels, sentence))
+		self.assertEqual(labels, list(best))
+		self.assertAlmostEqual(score, self.model.score(labels, sentence))
+		self.assertEqual(self.model.label(sentence, beam_size=len(self.model.labels)), labels)
+
+	def test_distributions_memoized(self):
+		self.model.local_cache.clear()
+		self.model.label(['the', 'fish', 'can'])
+		misses = self.model.local_cache.misses
+
+		self.model.label(['the', 'fish', 'can'])
+		self.assertEqual(self.model.local_cache.misses, misses)
+
+	def test_hashed_features(self):
+		model = MaxEntMarkovModel(buckets=1024)
+		model.train(self.tagged_sentences)
+		self.assertEqual(model.weight_matrix.shape, (1024, len(model.labels)))
+
+		for tags, sentence in self.tagged_sentences:
+			self.assertEqual(model.label(sentence), tags)
+
+		features = model.observation_features(['the', 'can'], 1) + [model.previous_feature('DT')]
+		log_probs = model.classifier.get_log_probabilities(model.classifier_features(features))
+		distributions = model.local_distributions(model.observation_features(['the', 'can'], 1))
+		for label, score in zip(model.labels, distributions[model.labels.index('DT')]):
+			self.assertAlmostEqual(score, log_probs[label])
+
+		# A hashed classifier trained elsewhere is used by its buckets
+		other = MaxEntMarkovModel()
+		other.use_classifier(model.classifier)
+		self.assertEqual(other.buckets, 1024)
+		self.assertEqual(other.label(['the', 'fish', 'can']), model.label(['the', 'fish', 'can']))
+
+if __name__ == "__main__":
+	unittest.main()
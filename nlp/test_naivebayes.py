@@ -43,5 +43,16 @@ class NaiveBayesClassifierTest(unittest.TestCase):
 		self.failUnlessAlmostEqual(distribution['A'], correct_distribution['A'])
 		self.failUnlessAlmostEqual(distribution['B'], correct_distribution['B'])
 
+	def test_hashed_features(self):
+		training_data = (('A', 'aaab'), ('A', 'aab'), ('B', 'bbba'), ('B', 'bba'))
+		classifier = NaiveBayesClassifier()
+		classifier.train(training_data)
+		hashed_classifier = NaiveBayesClassifier(buckets=64)
+		hashed_classifier.train(training_data)
+
+		self.failUnless(all(type(bucket) is int and 0 <= bucket < 64 for bucket in hashed_classifier.feature_distribution))
+		for datum in ('aaa', 'bbb', 'abab'):
+			self.failUnlessEqual(hashed_classifier.label(datum), classifier.label(datum))
+
 if __name__ == "__main__":
 	unittest.main()
@@ -0,0 +1,70 @@
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from penntreebankreader import PennTreebankReader
+
+TREES = """
+( (S 
+    (NP-SBJ (NNP Pierre) (NNP Vinken) )
+    (VP (MD will) 
+      (VP (VB join) (-NONE- *-1) ))
+    (. .) ))
+( (S 
+    (NP-SBJ (NNP Mr.) (NNP Vinken) )
+    (VP (VBZ is) 
+      (NP-PRD (NN chairman) ))
+    (. .) ))
+"""
+
+SENTENCES = [(['NNP', 'NNP', 'MD', 'VB', '-NONE-', '.'], ['Pierre', 'Vinken', 'will', 'join', '*-1', '.']),
+			 (['NNP', 'NNP', 'VBZ', 'NN', '.'], ['Mr.', 'Vinken', 'is', 'chairman', '.'])]
+
+class PennTreebankReaderTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		os.mkdir(os.path.join(self.directory, "01"))
+
+		self.write("01/wsj_0101.mrg", open, TREES)
+		self.write("00/wsj_0001.mrg.gz", gzip.open, TREES)
+		self.write("01/wsj_0102.mrg.bz2", bz2.BZ2File, TREES.replace("Pierre", "Jan"))
+		self.write("01/wsj_0103.mrg", open, "")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write(self, name, opener, text):
+		path = os.path.join(self.directory, name)
+		if not os.path.isdir(os.path.dirname(path)): os.mkdir(os.path.dirname(path))
+		tree_file = opener(path, "wb")
+		tree_file.write(text)
+		tree_file.close()
+
+	def test_load_pos_tags(self):
+		for name in ("01/wsj_0101.mrg", "00/wsj_0001.mrg.gz"):
+			self.assertEqual(PennTreebankReader.load_pos_tags(os.path.join(self.directory, name)), SENTENCES)
+
+		self.assertEqual(PennTreebankReader.load_pos_tags(os.path.join(self.directory, "01/wsj_0103.mrg")), [])
+
+	def test_blocks_split_at_trees(self):
+		path = os.path.join(self.directory, "00/wsj_0001.mrg.gz")
+		for block_size in (1, 7, 64):
+			self.assertEqual(list(PennTreebankReader.iter_pos_tags(path, block_size=block_size)), SENTENCES)
+
+	def test_directory_order(self):
+		jan = [(SENTENCES[0][0], ['Jan'] + SENTENCES[0][1][1:]), SENTENCES[1]]
+		expected = SENTENCES + SENTENCES + jan
+
+		self.assertEqual(list(PennTreebankReader.read_pos_tags_from_directory(self.directory)), expected)
+		self.assertEqual(list(PennTreebankReader.read_pos_tags_from_directory(self.directory, processes=2)), expected)
+
+		# Stopping early shuts the workers down
+		sentences = PennTreebankReader.read_pos_tags_from_directory(self.directory, processes=2)
+		self.assertEqual(sentences.next(), SENTENCES[0])
+		sentences.close()
+
+if __name__ == "__main__":
+	unittest.main()
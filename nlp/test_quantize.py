@@ -0,0 +1,39 @@
+import unittest
+
+import numpy
+
+from quantize import INT16_MAX, INT16_NINF, quantize_scores, dequantize_scores
+
+class QuantizeTest(unittest.TestCase):
+	scores = numpy.array([[0.0, -0.5, float("-inf")], [-12.25, -3.0, -1e-4]])
+
+	def test_float32(self):
+		table, scale = quantize_scores(self.scores, 'float32')
+		self.assertEqual((table.dtype, scale), (numpy.float32, 1.0))
+		self.assertTrue(numpy.allclose(dequantize_scores(table, scale), self.scores, rtol=1e-7))
+
+	def test_int16(self):
+		table, scale = quantize_scores(self.scores, 'int16')
+		self.assertEqual(table.dtype, numpy.int16)
+		self.assertEqual(table[1, 0], -INT16_MAX)
+		self.assertEqual(table[0, 2], INT16_NINF)
+
+		scores = dequantize_scores(table, scale)
+		self.assertEqual(scores[0, 2], float("-inf"))
+		finite = numpy.isfinite(self.scores)
+		self.assertTrue(numpy.abs(scores[finite] - self.scores[finite]).max() <= scale / 2)
+
+		# A given scale is kept
+		table, scale = quantize_scores(self.scores, 'int16', scale=0.01)
+		self.assertEqual((scale, table[1, 1]), (0.01, -300))
+
+		# Scores that don't fit at a given scale are an error, not wrapped
+		self.assertRaises(ValueError, quantize_scores, self.scores, 'int16', scale=1e-4)
+		table, _ = quantize_scores(self.scores, 'int16', scale=12.25 / INT16_MAX)
+		self.assertEqual(table[1, 0], -INT16_MAX)
+
+	def test_unknown_precision(self):
+		self.assertRaises(ValueError, quantize_scores, self.scores, 'float16')
+
+if __name__ == "__main__":
+	unittest.main()
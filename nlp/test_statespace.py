@@ -0,0 +1,45 @@
+import unittest
+
+from statespace import StateSpace
+
+class StateSpaceTest(unittest.TestCase):
+	def setUp(self):
+		self.space = StateSpace(2, '<START>', '<STOP>')
+
+	def test_start_and_stop(self):
+		self.assertEqual(self.space.names[self.space.start], '<START>::<START>')
+		self.assertEqual(self.space.names[self.space.stop], '<STOP>::<STOP>')
+
+	def test_push(self):
+		a, b = self.space.label('A'), self.space.label('B')
+
+		state = self.space.push(self.space.start, a)
+		self.assertEqual(self.space.names[state], '<START>::A')
+
+		state = self.space.push(state, b)
+		self.assertEqual(self.space.names[state], 'A::B')
+		self.assertEqual(self.space.push(self.space.state_of('<START>::A'), b), state)
+		self.assertEqual(self.space.last_label[state], b)
+		self.assertEqual(self.space.suffix_names(state), ('B', 'A::B'))
+
+	def test_state_of(self):
+		state = self.space.state_of('A::B')
+
+		self.assertEqual(self.space.names[state], 'A::B')
+		self.assertEqual(self.space.last_label_of('A::B'), 'B')
+		self.assertEqual(self.space.state_of('A::B'), state)
+
+	def test_freeze(self):
+		a, b = self.space.label('A'), self.space.label('B')
+		ab = self.space.state_of('A::B')
+		ba = self.space.state_of('B::A')
+
+		self.space.freeze()
+
+		self.assertEqual(self.space.push_table[ab, a], ba)
+		self.assertEqual(self.space.push_table[ba, b], ab)
+		self.assertEqual(self.space.push_table[ab, b], -1)
+		self.assertEqual(list(self.space.last_label_table[[ab, ba]]), [b, a])
+
+if __name__ == "__main__":
+	unittest.main()
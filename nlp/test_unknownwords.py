@@ -0,0 +1,58 @@
+from math import exp
+import cPickle as pickle
+import unittest
+
+import numpy
+
+from unknownwords import UnknownWordModel, word_shape
+
+class UnknownWordModelTest(unittest.TestCase):
+	pairs = ([('VBG', word) for word in ('running', 'eating', 'singing', 'walking')] +
+			 [('RB', word) for word in ('quickly', 'slowly', 'badly')] +
+			 [('NNP', word) for word in ('Smith', 'Jones', 'Brown')] +
+			 [('CD', word) for word in ('1984', '12', '3-4')] +
+			 [('DT', 'the')] * 20)
+
+	def setUp(self):
+		self.model = UnknownWordModel(max_suffix=3, min_count=2, rare_count=10)
+		self.model.train(self.pairs)
+
+	def test_rows_are_distributions(self):
+		self.assertEqual(self.model.log_rows.shape, (len(self.model.children), len(self.model.labels)))
+		self.assertTrue(numpy.allclose(numpy.exp(self.model.log_rows).sum(axis=1), 1.0))
+
+	def test_signatures(self):
+		self.assertEqual(self.model.label('jumping'), 'VBG')
+		self.assertEqual(self.model.label('happily'), 'RB')
+		self.assertEqual(self.model.label('Johnson'), 'NNP')
+		self.assertEqual(self.model.label('2001'), 'CD')
+
+		# Same suffix and shape, same signature
+		self.assertEqual(self.model.signature('jumping'), self.model.signature('bing'))
+		self.assertNotEqual(self.model.signature('jumping'), self.model.signature('Jumping'))
+
+		# Nothing to go on: the root
+		self.assertEqual(self.model.signature('Qx-9Z'), 0)
+
+	def test_frequent_words_ignored(self):
+		# "the" is too frequent to count towards its signature, but the root
+		# still sees it, so DT keeps some probability
+		self.assertEqual(self.model.signature('the'), self.model.children[0][word_shape('the')])
+		self.assertTrue(0.0 < exp(self.model.label_distribution('the')['DT']) < 0.5)
+
+	def test_label_distribution(self):
+		distribution = self.model.label_distribution('jumping')
+		self.assertTrue(distribution is self.model.label_distribution('bing'))
+		self.assertAlmostEqual(sum(exp(score) for score in distribution.itervalues()), 1.0)
+		self.assertEqual(distribution['unseen label'], float("-inf"))
+
+	def test_pickle(self):
+		self.model.label_distribution('jumping')
+		model = pickle.loads(pickle.dumps(self.model, 2))
+
+		self.assertEqual(model.distributions, dict())
+		self.assertEqual(model.label('jumping'), 'VBG')
+		self.assertTrue(numpy.array_equal(model.log_rows, self.model.log_rows))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from utilities import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+	def test_hits_and_misses(self):
+		cache = LRUCache(2)
+		calls = []
+		compute = lambda key: calls.append(key) or key * 2
+
+		self.assertEqual(cache.lookup(1, compute), 2)
+		self.assertEqual(cache.lookup(1, compute), 2)
+		self.assertEqual(calls, [1])
+		self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+
+	def test_evicts_least_recently_used(self):
+		cache = LRUCache(2)
+		compute = lambda key: key
+
+		cache.lookup('a', compute)
+		cache.lookup('b', compute)
+		cache.lookup('a', compute)
+		cache.lookup('c', compute)
+
+		self.assertEqual(len(cache), 2)
+		self.assertTrue('a' in cache)
+		self.assertTrue('c' in cache)
+		self.assertFalse('b' in cache)
+		self.assertEqual(cache.evictions, 1)
+
+	def test_zero_size_disables_caching(self):
+		cache = LRUCache(0)
+
+		self.assertEqual(cache.lookup('a', lambda key: 1), 1)
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.stats()['misses'], 1)
+
+	def test_clear(self):
+		cache = LRUCache(2)
+		cache.lookup('a', lambda key: 1)
+		cache.clear()
+
+		self.assertEqual(len(cache), 0)
+		self.assertEqual(cache.lookup('a', lambda key: 2), 2)
+
+if __name__ == "__main__":
+	unittest.main()
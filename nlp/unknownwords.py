@@ -0,0 +1,166 @@
+'''
+Unknown word model. A word's signature is its shape (capitalization, digits,
+hyphens) plus the longest suffix seen often enough in training, found by
+walking a trie of reversed suffixes. The label distribution of every
+signature is computed at training time, so labelling an unseen word costs a
+handful of dictionary lookups.
+'''
+
+from copy import copy
+from itertools import izip
+from math import sqrt
+
+import numpy
+
+from counter import Counter
+from countermap import CounterMap
+
+def word_shape(word):
+	"""
+	Returns the shape part of word's signature: (capitalized, all capitals,
+	has a digit, has a hyphen)
+	"""
+	return (word[:1].isupper(), word.isupper(), any(char.isdigit() for char in word), '-' in word)
+
+class UnknownWordModel(object):
+	"""
+	Fallback emissions model (train / label_distribution, like
+	NaiveBayesClassifier). Only words seen at most rare_count times are
+	counted, as they look the most like unseen words. Suffixes seen fewer
+	than min_count times are dropped, and suffix distributions are smoothed
+	towards the next shorter suffix as in TnT (Brants, 2000).
+
+	Each trie node is a row of log_rows (nodes x labels): node 0 is the
+	root, its children are shapes, and below a shape each level adds the
+	next character from the end of the word.
+	"""
+
+	def __init__(self, max_suffix=5, min_count=2, rare_count=10):
+		self.max_suffix = max_suffix
+		self.min_count = min_count
+		self.rare_count = rare_count
+
+		self.labels = list()
+		self.children = [dict()]
+		self.log_rows = numpy.zeros((1, 0))
+
+		# Node => Counter view of its row, filled as signatures are used
+		self.distributions = dict()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['distributions'] = dict()
+		return state
+
+	def _suffix_keys(self, word):
+		# The (shape, suffix) keys of word's path through the trie, shortest
+		# first
+		shape, lower = word_shape(word), word.lower()
+		return [(shape, lower[len(lower) - length:]) for length in xrange(min(len(lower), self.max_suffix) + 1)]
+
+	def train(self, labeled_data):
+		word_counts = CounterMap()
+		for label, word in labeled_data:
+			word_counts[word][label] += 1.0
+
+		self.labels = sorted(set(label for counts in word_counts.itervalues() for label in counts))
+		label_idx = dict((label, idx) for idx, label in enumerate(self.labels))
+
+		def count_row(counts):
+			row = numpy.zeros(len(self.labels))
+			for label, count in counts.iteritems():
+				row[label_idx[label]] = count
+			return row
+
+		# The root sees every word, so every label gets some probability
+		prior = numpy.zeros(len(self.labels))
+		key_counts = dict()
+
+		for word, counts in word_counts.iteritems():
+			row = count_row(counts)
+			prior += row
+
+			if row.sum() > self.rare_count: continue
+			for key in self._suffix_keys(word):
+				if key in key_counts: key_counts[key] += row
+				else: key_counts[key] = row.copy()
+
+		# Parents (one character shorter) come before their children and have
+		# at least their counts, so pruning never orphans a node
+		keys = sorted((key for key, row in key_counts.iteritems() if row.sum() >= self.min_count),
+					  key=lambda (shape, suffix): len(suffix))
+
+		probabilities = prior / max(prior.sum(), 1.0)
+		# TnT's interpolation weight: the spread of the label probabilities
+		theta = sqrt(((probabilities - probabilities.mean()) ** 2).sum() / max(len(self.labels) - 1, 1))
+
+		self.children = [dict()]
+		rows = [probabilities]
+		node_of = dict()
+
+		for shape, suffix in keys:
+			if suffix: parent, edge = node_of[(shape, suffix[1:])], suffix[0]
+			else: parent, edge = 0, shape
+
+			counts = key_counts[(shape, suffix)]
+			node_of[(shape, suffix)] = len(rows)
+			self.children[parent][edge] = len(rows)
+			self.children.append(dict())
+			rows.append((counts / counts.sum() + theta * rows[parent]) / (1.0 + theta))
+
+		with numpy.errstate(divide='ignore'):
+			self.log_rows = numpy.log(numpy.array(rows))
+		self.distributions = dict()
+
+	def collapsed(self, label_of):
+		"""
+		Returns a model with the same signatures over the labels label_of
+		maps these to (e.g. full states to their last label), each collapsed
+		label's probability the sum of its labels'
+		"""
+		model = copy(self)
+		model.labels = sorted(set(label_of(label) for label in self.labels))
+		label_idx = dict((label, idx) for idx, label in enumerate(model.labels))
+
+		rows = numpy.zeros((self.log_rows.shape[0], len(model.labels)))
+		for column, label in enumerate(self.labels):
+			rows[:, label_idx[label_of(label)]] += numpy.exp(self.log_rows[:, column])
+
+		with numpy.errstate(divide='ignore'):
+			model.log_rows = numpy.log(rows)
+		model.distributions = dict()
+		return model
+
+	def signature(self, word):
+		"""
+		Returns the node (row of log_rows) of word's signature
+		"""
+		node = self.children[0].get(word_shape(word))
+		if node is None: return 0
+
+		for char in reversed(word.lower()[-self.max_suffix:]):
+			child = self.children[node].get(char)
+			if child is None: break
+			node = child
+
+		return node
+
+	def label_distribution(self, word):
+		"""
+		Returns the log distribution over labels for word. Words with the
+		same signature share one (read-only) counter.
+		"""
+		node = self.signature(word)
+		distribution = self.distributions.get(node)
+
+		if distribution is None:
+			distribution = Counter()
+			distribution.default = float("-inf")
+			for label, score in izip(self.labels, self.log_rows[node].tolist()):
+				distribution[label] = score
+			self.distributions[node] = distribution
+
+		return distribution
+
+	def label(self, word):
+		return self.labels[int(numpy.argmax(self.log_rows[self.signature(word)]))]
@@ -2,8 +2,11 @@
 A bunch of random utility functions
 '''
 
-from counter import Counter
+from collections import OrderedDict
 from pprint import pformat
+from threading import Lock
+
+from counter import Counter
 
 try:
 	from itertools import permutations
@@ -66,3 +69,69 @@ def memoized(func, *args):
 			return result
 
 	return wrapper
+
+class LRUCache(object):
+	"""
+	Size-bounded mapping that discards the least recently used entry once
+	max_size entries are held. Keeps hit / miss / eviction counts. Safe to
+	share between threads; compute runs outside the lock.
+	"""
+
+	def __init__(self, max_size=10000):
+		self.max_size = max_size
+		self._entries = OrderedDict()
+		self._lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, key):
+		return key in self._entries
+
+	def lookup(self, key, compute):
+		"""
+		Returns the cached value for key, calling compute(key) (and caching
+		the result) on a miss
+		"""
+		with self._lock:
+			if key in self._entries:
+				# Re-inserting moves key to the most recently used end
+				value = self._entries.pop(key)
+				self._entries[key] = value
+				self.hits += 1
+				return value
+
+			self.misses += 1
+
+		value = compute(key)
+		if self.max_size <= 0:
+			return value
+
+		with self._lock:
+			if key not in self._entries and len(self._entries) >= self.max_size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+			self._entries[key] = value
+
+		return value
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		return {'size' : len(self._entries), 'max_size' : self.max_size,
+				'hits' : self.hits, 'misses' : self.misses,
+				'evictions' : self.evictions}